@@ -0,0 +1,539 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Vectorized agreement statistics for PredPatt calibration results.
+
+Answers are held in a dense (item x worker) matrix with a mask of the
+cells that were actually answered. Fleiss' kappa and pair-wise agreement
+are computed from per-item category counts, and Cohen's kappa for every
+worker pair of every HIT is computed in batches of equally shaped HITs.
+AgreementStats keeps the same statistics incrementally, for result
+batches that arrive over time. bootstrap resamples items or HITs to give
+confidence intervals of the statistics.
+
+"""
+
+import os
+import copy
+import hashlib
+import tempfile
+import cPickle as pickle
+from array import array
+from multiprocessing import Pool
+import numpy as np
+
+
+class AnswerColumns:
+    """
+    Define the array-backed answer columns of a result batch.
+
+    Each judgement is one entry of the parallel workers / items /
+    answers arrays. Worker IDs, items and HITs are interned to small
+    ints; items[j] is a value of item_index and item_hits[items[j]] is
+    the HIT that item was first asked in.
+
+    """
+    def __init__(self):
+        self.workers = array('i')
+        self.items = array('i')
+        self.answers = array('b')
+        self.item_hits = array('i')
+        self.worker_index = {}
+        self.item_index = {}
+        self.hit_index = {}
+
+    def __len__(self):
+        return len(self.answers)
+
+    def add_item(self, hit_id, key, question=None):
+        """
+        Intern an item, recording the HIT it was first asked in. The
+        question dict of the item is there for subclasses to use.
+
+        """
+        item = self.item_index.get(key)
+        if item is None:
+            item = self.item_index[key] = len(self.item_index)
+            hit = self.hit_index.setdefault(hit_id, len(self.hit_index))
+            self.item_hits.append(hit)
+        return item
+
+    def add(self, item, workerid, answer):
+        worker = self.worker_index.get(workerid)
+        if worker is None:
+            worker = self.worker_index[workerid] = len(self.worker_index)
+        self.items.append(item)
+        self.workers.append(worker)
+        self.answers.append(answer)
+
+    @classmethod
+    def from_results(cls, results):
+        """Build the columns from the Sentence objects of load_result."""
+        columns = cls()
+        for sent in results.itervalues():
+            for key, pred in sent.predicates.iteritems():
+                item = columns.add_item(pred.hit_id, (sent.sentid, key))
+                for workerid, answer in pred.gen_workers():
+                    columns.add(item, workerid, answer)
+        return columns
+
+    def arrays(self):
+        """Return copies of the (items, workers, answers) columns."""
+        return (to_numpy(self.items, np.int32),
+                to_numpy(self.workers, np.int32),
+                to_numpy(self.answers, np.int8))
+
+    def last_arrays(self):
+        """
+        Return the (items, workers, answers) columns with only the last
+        answer of a worker on an item, ordered by item and worker.
+
+        """
+        items, workers, answers = self.arrays()
+        cell = items.astype(np.int64) * max(len(self.worker_index), 1) + workers
+        _, last = np.unique(cell[::-1], return_index=True)
+        last = len(cell) - 1 - last
+        return items[last], workers[last], answers[last]
+
+    def without_workers(self, workerids):
+        """
+        Return a copy of the columns without the answers of workerids.
+        Items, HITs and the worker index are shared with the original.
+
+        """
+        ret = copy.copy(self)
+        drop = [self.worker_index[w] for w in workerids
+                if w in self.worker_index]
+        keep = ~np.in1d(to_numpy(self.workers, np.int32), drop)
+        for name, typecode, dtype in (('items', 'i', np.int32),
+                                      ('workers', 'i', np.int32),
+                                      ('answers', 'b', np.int8)):
+            column = array(typecode)
+            column.fromstring(to_numpy(getattr(self, name), dtype)[keep]
+                              .tostring())
+            setattr(ret, name, column)
+        return ret
+
+
+def to_numpy(column, dtype):
+    """Convert an array column to a numpy array."""
+    # Copy, since the array may be reallocated by later appends.
+    if not len(column):
+        return np.zeros(0, dtype=dtype)
+    return np.frombuffer(column, dtype=dtype).copy()
+
+
+class AnswerMatrix:
+    """
+    Define the dense answer matrix of a result batch.
+
+    answers[i, w] is the answer of worker w on item i and is only
+    meaningful where mask[i, w] is set. item_hits[i] is the index of the
+    HIT item i was first asked in.
+
+    """
+    def __init__(self, answers, mask, item_hits, worker_ids, hit_ids):
+        self.answers = answers
+        self.mask = mask
+        self.item_hits = item_hits
+        self.worker_ids = worker_ids
+        self.hit_ids = hit_ids
+
+    @classmethod
+    def from_results(cls, results):
+        """Build the matrix from the Sentence objects of load_result."""
+        return cls.from_columns(AnswerColumns.from_results(results))
+
+    @classmethod
+    def from_columns(cls, columns):
+        """
+        Build the matrix from answer columns. When a worker answered the
+        same item more than once, the last answer wins.
+
+        """
+        items, workers, values = columns.last_arrays()
+        n_workers = len(columns.worker_index)
+        answers = np.zeros((len(columns.item_hits), n_workers), dtype=np.int8)
+        mask = np.zeros(answers.shape, dtype=bool)
+        answers[items, workers] = values
+        mask[items, workers] = True
+        worker_ids = sorted(columns.worker_index,
+                            key=columns.worker_index.get)
+        hit_ids = sorted(columns.hit_index, key=columns.hit_index.get)
+        return cls(answers, mask, to_numpy(columns.item_hits, np.int32),
+                   worker_ids, hit_ids)
+
+    @property
+    def n_categories(self):
+        if not self.mask.any():
+            return 2
+        return max(2, int(self.answers[self.mask].max()) + 1)
+
+    def category_counts(self):
+        """Return the (item x category) matrix of answer counts."""
+        onehot = (self.answers[:, :, None] ==
+                  np.arange(self.n_categories)[None, None, :])
+        return (onehot & self.mask[:, :, None]).sum(axis=1)
+
+    def cohen_kappas(self):
+        return cohen_kappa_by_hit(self)
+
+
+def as_answer_matrix(results):
+    if isinstance(results, (AnswerMatrix, AgreementStats)):
+        return results
+    if isinstance(results, AnswerColumns):
+        return AnswerMatrix.from_columns(results)
+    return AnswerMatrix.from_results(results)
+
+
+def fleiss_kappa(counts):
+    """
+    Fleiss' kappa of an (item x category) count matrix. Items with fewer
+    than two answers carry no agreement information and are left out.
+
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    n = counts.sum(axis=1)
+    counts, n = counts[n > 1], n[n > 1]
+    p = counts.sum(axis=0) / counts.sum()
+    agreement = ((counts ** 2).sum(axis=1) - n) / (n * (n - 1))
+    p_bar, p_e = agreement.mean(), (p ** 2).sum()
+    return (p_bar - p_e) / (1 - p_e)
+
+
+def pairwise_agreement(counts):
+    """
+    Fraction of agreeing answer pairs over all answer pairs on the same
+    item, from an (item x category) count matrix.
+
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    n = counts.sum(axis=1)
+    agreeing = (counts * (counts - 1) / 2).sum()
+    total = (n * (n - 1) / 2).sum()
+    return agreeing / total
+
+
+def _batched_cohen_kappa(onehot, mask):
+    """
+    Unweighted Cohen's kappa for every worker pair of a batch of HITs.
+
+    onehot is (hit x worker x item x category) and mask is
+    (hit x worker x item). Each pair is compared on the items both
+    workers answered. Return the kappas of the upper-triangle pairs,
+    shaped (hit x pair). A pair whose expected disagreement is zero
+    (both always gave the same single answer) gets kappa 1, as in
+    skll.kappa, and a pair that shares no item gets NaN.
+
+    """
+    onehot = onehot * mask[..., None]
+    common = np.einsum('gwi,gvi->gwv', mask, mask)
+    observed = np.einsum('gwic,gvic->gwv', onehot, onehot)
+    # marginals of worker w over the items shared with worker v
+    marginal = np.einsum('gwic,gvi->gwvc', onehot, mask)
+    expected = np.einsum('gwvc,gvwc->gwv', marginal, marginal)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        observed_dis = 1 - observed / common
+        expected_dis = 1 - expected / common.astype(np.float64) ** 2
+        kappa = np.where(expected_dis > 1e-12,
+                         1 - observed_dis / expected_dis, 1.0)
+    kappa[common == 0] = np.nan
+    rows, cols = np.triu_indices(mask.shape[1], k=1)
+    return kappa[:, rows, cols]
+
+
+def cohen_kappa_by_hit(matrix):
+    """
+    Cohen's kappa of every pair of workers within each HIT. HITs with
+    the same number of items and workers are stacked and computed
+    together. Pairs of workers that answered no item in common are
+    left out. Return a flat array of kappas.
+
+    """
+    return _cohen_kappas_with_hits(matrix)[0]
+
+
+def _cohen_kappas_with_hits(matrix):
+    """Return the kappas of cohen_kappa_by_hit and the HIT of each."""
+    n_categories = matrix.n_categories
+    order = np.argsort(matrix.item_hits, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(matrix.item_hits[order])) + 1
+    groups = {}
+    for items in np.split(order, bounds):
+        if not len(items):
+            continue
+        workers = np.flatnonzero(matrix.mask[items].any(axis=0))
+        groups.setdefault((len(items), len(workers)), []).append(
+            (items, workers))
+
+    kappas, hits_of_kappas = [], []
+    for (_, n_workers), hits in sorted(groups.iteritems()):
+        if n_workers < 2:
+            continue
+        answers = np.stack([matrix.answers[np.ix_(items, workers)].T
+                            for items, workers in hits])
+        mask = np.stack([matrix.mask[np.ix_(items, workers)].T
+                         for items, workers in hits]).astype(np.float64)
+        onehot = (answers[..., None] ==
+                  np.arange(n_categories)).astype(np.float64)
+        kappa = _batched_cohen_kappa(onehot, mask)
+        hits_of_kappa = np.repeat([matrix.item_hits[items[0]]
+                                   for items, _ in hits], kappa.shape[1])
+        kappa = kappa.ravel()
+        shared = ~np.isnan(kappa)
+        kappas.append(kappa[shared])
+        hits_of_kappas.append(hits_of_kappa[shared])
+    if not kappas:
+        return np.zeros(0), np.zeros(0, dtype=np.int32)
+    return np.concatenate(kappas), np.concatenate(hits_of_kappas)
+
+
+class AgreementStats:
+    """
+    Define the incremental sufficient statistics of agreement.
+
+    The stats accept answers through the same add_item / add interface
+    as AnswerColumns, and update in time proportional to the answer:
+
+    - counts[i, c] is the number of workers giving item i category c,
+      enough for Fleiss' kappa and pair-wise agreement.
+    - confusion[p, a, b] counts the items of one HIT where the workers
+      of pair p answered a and b, enough for Cohen's kappa. Pairs of a
+      HIT are keyed by (hit, w, v) with w < v in pair_index.
+
+    The answer of each (item, worker) cell is kept, so that an answer
+    given again replaces the earlier one as it does in
+    AnswerMatrix.from_columns. Files holds the digests of the ingested
+    files.
+
+    """
+    def __init__(self, n_categories=2):
+        self.worker_index = {}
+        self.item_index = {}
+        self.hit_index = {}
+        self.item_hits = array('i')
+        self.item_answers = []
+        self.sentids = set()
+        self.counts = np.zeros((64, n_categories), dtype=np.int64)
+        self.pair_index = {}
+        self.confusion = np.zeros((64, n_categories, n_categories),
+                                  dtype=np.int64)
+        self.files = set()
+
+    @property
+    def n_categories(self):
+        return self.counts.shape[1]
+
+    @property
+    def hit_ids(self):
+        return sorted(self.hit_index, key=self.hit_index.get)
+
+    def _grow(self, n_items, n_pairs, n_categories):
+        """Make room for n_items, n_pairs and n_categories."""
+        if n_categories > self.n_categories:
+            k = n_categories - self.n_categories
+            self.counts = np.pad(self.counts, ((0, 0), (0, k)), 'constant')
+            self.confusion = np.pad(self.confusion, ((0, 0), (0, k), (0, k)),
+                                    'constant')
+        if n_items > len(self.counts):
+            self.counts = np.pad(self.counts,
+                                 ((0, max(n_items, 2 * len(self.counts)) -
+                                   len(self.counts)), (0, 0)), 'constant')
+        if n_pairs > len(self.confusion):
+            self.confusion = np.pad(
+                self.confusion,
+                ((0, max(n_pairs, 2 * len(self.confusion)) -
+                  len(self.confusion)), (0, 0), (0, 0)), 'constant')
+
+    def add_item(self, hit_id, key, question=None):
+        """Intern an item, recording the HIT it was first asked in."""
+        item = self.item_index.get(key)
+        if item is None:
+            item = self.item_index[key] = len(self.item_index)
+            hit = self.hit_index.get(hit_id)
+            if hit is None:
+                hit = self.hit_index[hit_id] = len(self.hit_index)
+            self.item_hits.append(hit)
+            self.item_answers.append({})
+            self.sentids.add(key[0])
+            self._grow(item + 1, 0, 0)
+        return item
+
+    def _confuse(self, hit, w, a, v, b, delta):
+        if w > v:
+            w, a, v, b = v, b, w, a
+        pair = self.pair_index.get((hit, w, v))
+        if pair is None:
+            pair = self.pair_index[(hit, w, v)] = len(self.pair_index)
+            self._grow(0, pair + 1, 0)
+        self.confusion[pair, a, b] += delta
+
+    def add(self, item, workerid, answer):
+        worker = self.worker_index.get(workerid)
+        if worker is None:
+            worker = self.worker_index[workerid] = len(self.worker_index)
+        answers = self.item_answers[item]
+        old = answers.get(worker)
+        if old == answer:
+            return
+        self._grow(0, 0, answer + 1)
+        hit = self.item_hits[item]
+        if old is not None:
+            self.counts[item, old] -= 1
+            for v, b in answers.iteritems():
+                if v != worker:
+                    self._confuse(hit, worker, old, v, b, -1)
+        for v, b in answers.iteritems():
+            if v != worker:
+                self._confuse(hit, worker, answer, v, b, 1)
+        self.counts[item, answer] += 1
+        answers[worker] = answer
+
+    def category_counts(self):
+        """Return the (item x category) matrix of answer counts."""
+        return self.counts[:len(self.item_index)]
+
+    def cohen_kappas(self):
+        """
+        Cohen's kappa of every pair of workers within each HIT, from the
+        confusion tables. As in cohen_kappa_by_hit, pairs that share no
+        item are left out.
+
+        """
+        confusion = self.confusion[:len(self.pair_index)].astype(np.float64)
+        common = confusion.sum(axis=(1, 2))
+        observed = np.trace(confusion, axis1=1, axis2=2)
+        expected = (confusion.sum(axis=2) * confusion.sum(axis=1)).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            observed_dis = 1 - observed / common
+            expected_dis = 1 - expected / common ** 2
+            kappa = np.where(expected_dis > 1e-12,
+                             1 - observed_dis / expected_dis, 1.0)
+        return kappa[common > 0]
+
+    def save(self, path):
+        """Pickle the stats to path, atomically."""
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                   suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load the stats pickled at path, or start empty ones."""
+        if not os.path.isfile(path):
+            return cls()
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+def file_digest(filepath):
+    h = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Columns of the per-unit statistics the bootstrap resamples. COUNTS is
+# followed by one column per category.
+(AGREEMENT, N_ITEMS, AGREEING_PAIRS, PAIRS, KAPPA_SUM, N_KAPPAS,
+ COUNTS) = range(7)
+
+
+def unit_statistics(matrix, unit='item'):
+    """
+    Return the additive statistics of every item or HIT, as a
+    (unit x column) matrix. Any metric of a resample is a function of
+    the weighted column sums of its units.
+
+    Per item, AGREEMENT is the Fleiss agreement of items with at least
+    two answers, which also count towards N_ITEMS and COUNTS.
+    AGREEING_PAIRS and PAIRS count answer pairs. Per HIT, the item
+    statistics of its items are summed, and KAPPA_SUM and N_KAPPAS sum
+    the Cohen's kappas of its worker pairs.
+
+    """
+    counts = matrix.category_counts().astype(np.float64)
+    n = counts.sum(axis=1)
+    rated = n > 1
+    stats = np.zeros((len(counts), COUNTS + counts.shape[1]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        agreement = ((counts ** 2).sum(axis=1) - n) / (n * (n - 1))
+    stats[rated, AGREEMENT] = agreement[rated]
+    stats[:, N_ITEMS] = rated
+    stats[:, AGREEING_PAIRS] = (counts * (counts - 1) / 2).sum(axis=1)
+    stats[:, PAIRS] = n * (n - 1) / 2
+    stats[:, COUNTS:] = counts * rated[:, None]
+    if unit == 'item':
+        return stats
+    n_hits = len(matrix.hit_ids)
+    hit_stats = np.zeros((n_hits, stats.shape[1]))
+    np.add.at(hit_stats, matrix.item_hits, stats)
+    kappas, hits = _cohen_kappas_with_hits(matrix)
+    hit_stats[:, KAPPA_SUM] = np.bincount(hits, kappas, minlength=n_hits)
+    hit_stats[:, N_KAPPAS] = np.bincount(hits, minlength=n_hits)
+    return hit_stats
+
+
+def metrics_of_sums(sums):
+    """
+    Compute (fleiss kappa, pair-wise agreement, average Cohen's kappa)
+    from (resample x column) weighted sums of unit statistics.
+
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_bar = sums[:, AGREEMENT] / sums[:, N_ITEMS]
+        p = sums[:, COUNTS:] / sums[:, COUNTS:].sum(axis=1)[:, None]
+        p_e = (p ** 2).sum(axis=1)
+        fleiss = (p_bar - p_e) / (1 - p_e)
+        pairwise = sums[:, AGREEING_PAIRS] / sums[:, PAIRS]
+        cohen = sums[:, KAPPA_SUM] / sums[:, N_KAPPAS]
+    return fleiss, pairwise, cohen
+
+
+def _bootstrap_batch(args):
+    stats, n_resamples, seed, batch = args
+    rng = np.random.RandomState([seed, batch])
+    n_units = len(stats)
+    # multinomial weights, from the counts of units drawn in each resample
+    draws = rng.randint(0, n_units, size=(n_resamples, n_units))
+    draws += np.arange(n_resamples)[:, None] * n_units
+    weights = np.bincount(draws.ravel(), minlength=n_resamples * n_units)
+    weights = weights.reshape(n_resamples, n_units).astype(np.float64)
+    return np.column_stack(metrics_of_sums(weights.dot(stats)))
+
+
+def bootstrap(stats, n_resamples=1000, seed=0, workers=0,
+              batch_weights=2 ** 22):
+    """
+    Resample the units of stats (from unit_statistics) with replacement
+    n_resamples times and return the (resample x metric) matrix of
+    metrics_of_sums. Each resample is a row of unit weights, so a
+    batch of resamples is one matrix product. Batches hold about
+    batch_weights weights and are seeded by (seed, batch number), so the
+    result doesn't depend on the number of workers.
+
+    """
+    batch_size = max(1, batch_weights // max(len(stats), 1))
+    tasks = [(stats, min(batch_size, n_resamples - start), seed, batch)
+             for batch, start in enumerate(xrange(0, n_resamples,
+                                                  batch_size))]
+    if workers > 0:
+        pool = Pool(workers)
+        try:
+            results = pool.map(_bootstrap_batch, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_bootstrap_batch, tasks)
+    return np.concatenate(results)
+
+
+def confidence_interval(values, confidence=0.95):
+    """Percentile interval of values, leaving out undefined ones."""
+    tail = (1 - confidence) / 2 * 100
+    return tuple(np.nanpercentile(values, [tail, 100 - tail]))
@@ -3,72 +3,215 @@
 
 import sys
 import csv
-import json
-from statistics import fleiss_kappa
+import argparse
+import hashlib
 import itertools
-import skll
+import collections
+from array import array
+import numpy as np
+import agreement
+import rules
+import worker_quality
+from payloads import load_questions
 
 
-class Worker:
+class Worker(object):
     """
     Define the worker for PredPatt calibration.
 
     """
+    __slots__ = ('workerid', 'answer')
+
     def __init__(self, workerid, answer):
         self.workerid = workerid
         self.answer = int(answer)
 
 
-class Predicate:
+class WorkerTable:
+    """
+    Define the table interning worker IDs to small ints.
+
+    """
+    def __init__(self):
+        self.ids = []
+        self.index = {}
+
+    def intern(self, workerid):
+        worker = self.index.get(workerid)
+        if worker is None:
+            worker = self.index[workerid] = len(self.ids)
+            self.ids.append(workerid)
+        return worker
+
+
+class PayloadTable:
+    """
+    Define the table of raw HIT payloads.
+
+    The Input.json_variables string of each HIT, in either payload
+    format, is kept undecoded and questions are decoded from it only
+    when a report asks for them. The last cache_size decoded payloads
+    are kept, since questions of one HIT tend to be asked for together
+    and reports go over the predicates of a sentence, whose questions
+    may be spread over a few HITs.
+
+    """
+    def __init__(self, cache_size=64):
+        self.payloads = []
+        self.cache_size = cache_size
+        self._decoded = collections.OrderedDict()
+
+    def add(self, payload):
+        self.payloads.append(payload)
+        return len(self.payloads) - 1
+
+    def question(self, hit, index):
+        questions = self._decoded.pop(hit, None)
+        if questions is None:
+            questions = load_questions(self.payloads[hit])
+            if len(self._decoded) >= self.cache_size:
+                self._decoded.popitem(last=False)
+        self._decoded[hit] = questions
+        return questions[index]
+
+
+class ResultStore:
+    """
+    Define the tables shared by the sentences of a result batch.
+
+    """
+    def __init__(self):
+        self.workers = WorkerTable()
+        self.payloads = PayloadTable()
+
+
+def predicate_key(q):
+    # a digest instead of the predicate HTML itself keeps keys small
+    html = hashlib.md5(q['predicate'].encode('utf-8')).hexdigest()
+    return q['pred_id'] + html
+
+
+class LazyQuestion(object):
+    """
+    Define the base class of objects backed by a question.
+
+    The question is either held as a dict, or as its index in the
+    payload of HIT number _hit of the store, decoded on access.
+
+    """
+    __slots__ = ('_store', '_hit', '_question')
+
+    def __init__(self, store, question, hit=None):
+        self._store = store
+        self._hit = hit
+        self._question = question
+
+    @property
+    def question(self):
+        if self._hit is None:
+            return self._question
+        return self._store.payloads.question(self._hit, self._question)
+
+
+class Predicate(LazyQuestion):
     """
     Define the predicate class.
 
+    Answers are kept in parallel typed arrays of interned workers and
+    their answers, in the order workers first answered.
+
     """
-    def __init__(self, hit_id, pred_id, pred, question, pprint=None):
+    __slots__ = ('hit_id', 'pred_id', '_workers', '_answers')
+
+    def __init__(self, hit_id, pred_id, store, question, hit=None):
+        LazyQuestion.__init__(self, store, question, hit)
         self.hit_id = hit_id
         self.pred_id = pred_id
-        self.pred_html = pred
-        self.workers = {}
-        self.question = question
+        self._workers = array('i')
+        self._answers = array('b')
+
+    @property
+    def pred_html(self):
+        return self.question['predicate']
+
+    @property
+    def pprint(self):
+        pprint = self.question.get('pprint')
         if pprint:
             pprint = pprint.replace('\\t', '\t')
             pprint = pprint.replace('\\n', '\n')
-            self.pprint = pprint
+        return pprint
+
+    @property
+    def answers(self):
+        return self._answers
+
+    def add(self, worker, answer):
+        """Record the answer of an interned worker, replacing an earlier one."""
+        try:
+            i = self._workers.index(worker)
+        except ValueError:
+            self._workers.append(worker)
+            self._answers.append(answer)
+        else:
+            self._answers[i] = answer
+
+    def gen_workers(self):
+        ids = self._store.workers.ids
+        for worker, answer in itertools.izip(self._workers, self._answers):
+            yield ids[worker], answer
+
+    @property
+    def workers(self):
+        """
+        Worker objects keyed by worker ID, built on demand. The dict is a
+        read-only snapshot of the answers: changing it doesn't change the
+        predicate, which records answers with add.
+
+        """
+        return {workerid: Worker(workerid, answer)
+                for workerid, answer in self.gen_workers()}
 
 
-class Sentence:
+class Sentence(LazyQuestion):
     """
     Define the sentence class.
 
     """
+    __slots__ = ('sentid', 'predicates')
 
-    def __init__(self, q):
+    def __init__(self, q, store=None, hit=None, index=None):
+        LazyQuestion.__init__(self, store or ResultStore(),
+                              q if hit is None else index, hit)
         self.sentid = q['sentenceID']
-        self.sentence_html = q.get('sentence')  # q['sentence'])
         self.predicates = {}
 
-    def add_worker(self, hit_id, q, row):
-        # get predicate
-        pred_id = q['pred_id']
-        pred_html = q['predicate']
-        id_ = pred_id + pred_html
-        if id_ not in self.predicates:
-            pred = Predicate(hit_id, pred_id, pred_html, q, q.get('pprint', None))
+    @property
+    def sentence_html(self):
+        return self.question.get('sentence')
+
+    def get_predicate(self, hit_id, q, hit=None, index=None):
+        id_ = predicate_key(q)
+        pred = self.predicates.get(id_)
+        if pred is None:
+            pred = Predicate(hit_id, q['pred_id'], self._store,
+                             q if hit is None else index, hit)
             self.predicates[id_] = pred
-        pred = self.predicates[id_]
+        return pred
+
+    def add_worker(self, hit_id, q, row):
+        pred = self.get_predicate(hit_id, q)
 
         # get the worker number which is consistent with the question number
         i = q['questionID']
 
         # add worker to predicate
-        workerid = row['WorkerId']
-        answer = row['Answer.correctness_' + i]
-        worker = Worker(workerid, answer)
-        pred.workers[workerid] = worker
+        worker = self._store.workers.intern(row['WorkerId'])
+        pred.add(worker, int(row['Answer.correctness_' + i]))
 
     def gen_answers(self):
         for pred in self.predicates.itervalues():
-            answers = [worker.answer for worker in pred.workers.itervalues()]
+            answers = pred.answers.tolist()
             distr = [0, 0]
             for answer in answers:
                 distr[answer] += 1
@@ -76,88 +219,339 @@ class Sentence:
 
     def gen_answer_pairs(self):
         for pred in self.predicates.itervalues():
-            answers = [worker.answer for worker in pred.workers.itervalues()]
+            answers = pred.answers.tolist()
             for s1, s2, in itertools.combinations(answers, 2):
                 yield s1, s2
 
 
+HIT_ID_FIELDS = ('HITId', 'Input.hit_id')
+
+
+def get_hit_id(row):
+    """Key a HIT by its MTurk ID, falling back to the input hit_id."""
+    for field in HIT_ID_FIELDS:
+        if row.get(field):
+            return row[field]
+    return row['Input.json_variables']
+
+
 def load_result(filepath):
+    store = ResultStore()
     results = {}
+    questions_by_hit = {}
     with open(filepath) as csv_file:
         reader = csv.DictReader(csv_file)
-        for i, row in enumerate(reader):
-            json_var = json.loads(row['Input.json_variables'])
-            hit_id = row['Input.json_variables']
-            for q in json_var:
-                if 'normal' not in q['pred_id']:
-                    continue
-                sentid = q['sentenceID']
-                # create sent object if it is not existed
-                if sentid not in results:
-                    sent = Sentence(q)
-                    results[sentid] = sent
-                sent = results[sentid]
-                # add worker
-                sent.add_worker(hit_id, q, row)
+        for row in reader:
+            hit_id = get_hit_id(row)
+            questions = questions_by_hit.get(hit_id)
+            if questions is None:
+                # decode each HIT payload once, not once per assignment,
+                # and keep only the raw payload for later reports
+                payload = row['Input.json_variables']
+                hit = store.payloads.add(payload)
+                questions = []
+                for i, q in enumerate(load_questions(payload)):
+                    if 'normal' not in q['pred_id']:
+                        continue
+                    sentid = q['sentenceID']
+                    # create sent object if it is not existed
+                    if sentid not in results:
+                        results[sentid] = Sentence(q, store, hit, i)
+                    pred = results[sentid].get_predicate(hit_id, q, hit, i)
+                    field = 'Answer.correctness_' + q['questionID']
+                    questions.append((pred, field))
+                questions_by_hit[hit_id] = questions
+            # add worker
+            worker = store.workers.intern(row['WorkerId'])
+            for pred, field in questions:
+                pred.add(worker, int(row[field]))
     print len(results)
     return results
 
 
+def load_result_columns(filepath, columns=None):
+    """
+    Load a result file into array-backed answer columns that the
+    agreement code can use directly, see load_result_rows.
+
+    """
+    with open(filepath) as csv_file:
+        return load_result_rows(csv.reader(csv_file), columns)
+
+
+def load_result_rows(rows, columns=None):
+    """
+    Load result rows, a header followed by the rows of values as a
+    csv.reader gives them, into answer columns. Each distinct HIT payload
+    is decoded once, and only the answer column and item of each question
+    are kept. rows may be streamed, e.g. by mturk.Client.collect.
+
+    Answers are appended to columns when given, which may also be
+    agreement.AgreementStats.
+
+    """
+    if columns is None:
+        columns = agreement.AnswerColumns()
+    questions_by_hit = {}
+    sentids = set()
+    rows = iter(rows)
+    header = next(rows)
+    index = {name: i for i, name in enumerate(header)}
+    hit_fields = [index[f] for f in HIT_ID_FIELDS if f in index]
+    json_field = index['Input.json_variables']
+    worker_field = index['WorkerId']
+    for row in rows:
+        hit_id = next((row[f] for f in hit_fields if row[f]),
+                      row[json_field])
+        questions = questions_by_hit.get(hit_id)
+        if questions is None:
+            questions = []
+            for q in load_questions(row[json_field]):
+                if 'normal' not in q['pred_id']:
+                    continue
+                sentids.add(q['sentenceID'])
+                key = (q['sentenceID'], predicate_key(q))
+                item = columns.add_item(hit_id, key, q)
+                field = index['Answer.correctness_' + q['questionID']]
+                questions.append((item, field))
+            questions_by_hit[hit_id] = questions
+        workerid = row[worker_field]
+        for item, field in questions:
+            columns.add(item, workerid, int(row[field]))
+    print len(sentids)
+    return columns
+
+
 def cal_fleiss_kappa(results):
-    mat = []
-    for sent in results.itervalues():
-        for _, distr, _ in sent.gen_answers():
-            mat.append(distr)
+    matrix = agreement.as_answer_matrix(results)
+    mat = matrix.category_counts()
     print len(mat)
-    ret = fleiss_kappa(mat)
+    ret = agreement.fleiss_kappa(mat)
     print "The fleiss_kappa value of all HITs is %f." %(ret)
 
 
 def cal_pairwise_agreement(results):
-    values = []
-    for sent in results.itervalues():
-        for s1, s2 in sent.gen_answer_pairs():
-            pair_agreement = 1 if s1 == s2 else 0
-            values.append(pair_agreement)
-    avg_kappa = sum(values) / (len(values) + 0.0)
+    matrix = agreement.as_answer_matrix(results)
+    avg_kappa = agreement.pairwise_agreement(matrix.category_counts())
     print "The average pair-wise agreement of all HITs is %f." %(avg_kappa)
 
 
 def cal_cohen_kappa_by_hit(results):
-    # collect predicate by hit_id
-    preds_by_hit = {}
-    for sent in results.itervalues():
-        for pred in sent.predicates.itervalues():
-            if pred.hit_id not in preds_by_hit:
-                preds_by_hit[pred.hit_id] = []
-            preds_by_hit[pred.hit_id].append(pred)
-
-    kappas = []
-    # calculate kappa
-    for preds in preds_by_hit.itervalues():
-        # get answer list for each worker
-        worker_answers_by_hit = {worker_id: [] for worker_id
-                                 in preds[0].workers.keys()}
-        for pred in preds:
-            for worker in pred.workers.itervalues():
-                worker_answers_by_hit[worker.workerid].append(worker.answer)
-
-        # calculate kappa for each answer list pair
-        worker_answers = worker_answers_by_hit.values()
-        pairs_combinations = itertools.combinations(worker_answers, 2)
-        for l1, l2 in pairs_combinations:
-            kappa_value = skll.kappa(l1, l2)  #, weights='quadratic')
-            kappas.append(kappa_value)
-    avg_kappa = sum(kappas) / (len(kappas) + 0.0)
-    print len(preds_by_hit)
+    matrix = agreement.as_answer_matrix(results)
+    kappas = matrix.cohen_kappas()
+    avg_kappa = kappas.mean()
+    print len(matrix.hit_ids)
     print "The average Cohen's kappa of all HITs is %f." %(avg_kappa)
 
 
-def main(filepath):
-    results = load_result(filepath)
+def ingest_results(stats, filepaths):
+    """
+    Add the answers of result files to agreement stats. Files that were
+    ingested before, by content, are skipped.
+
+    """
+    for filepath in filepaths:
+        digest = agreement.file_digest(filepath)
+        if digest in stats.files:
+            print "Skipping %s, already ingested." %(filepath)
+            continue
+        load_result_columns(filepath, stats)
+        stats.files.add(digest)
+    return stats
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Agreement statistics of PredPatt calibration results.')
+    parser.add_argument('filepaths', nargs='+', help='result csv files.')
+    parser.add_argument('--state', type=str, default=None,
+                        help='keep the statistics in this file and only '
+                             'ingest result files not seen before.')
+    parser.add_argument('--min-reliability', type=float, default=None,
+                        help='leave out workers whose Dawid-Skene '
+                             'reliability is below this.')
+    parser.add_argument('--reliabilities', type=str, default=None,
+                        help='worker reliabilities written by the workers '
+                             'command, estimated from the files otherwise.')
+    args = parser.parse_args(argv)
+    if args.state and args.min_reliability is not None:
+        parser.error('--min-reliability does not work with --state')
+    return args
+
+
+def filter_workers(columns, min_reliability, path=None):
+    """
+    Drop the answers of workers less reliable than min_reliability, with
+    reliabilities read from path or estimated from columns.
+
+    """
+    if path:
+        reliabilities = worker_quality.read_reliabilities(path)
+    else:
+        quality = worker_quality.estimate(columns)
+        reliabilities = dict(zip(quality.worker_ids,
+                                 quality.reliabilities()))
+    dropped = [workerid for workerid in columns.worker_index
+               if reliabilities.get(workerid, 1.0) < min_reliability]
+    print "Dropped %d of %d workers below reliability %g." %(
+        len(dropped), len(columns.worker_index), min_reliability)
+    return columns.without_workers(dropped)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.state:
+        stats = agreement.AgreementStats.load(args.state)
+        ingest_results(stats, args.filepaths)
+        stats.save(args.state)
+        print len(stats.sentids)
+        results = stats
+    else:
+        columns = agreement.AnswerColumns()
+        for filepath in args.filepaths:
+            load_result_columns(filepath, columns)
+        if args.min_reliability is not None:
+            columns = filter_workers(columns, args.min_reliability,
+                                     args.reliabilities)
+        results = agreement.AnswerMatrix.from_columns(columns)
     cal_pairwise_agreement(results)
     cal_fleiss_kappa(results)
     cal_cohen_kappa_by_hit(results)
 
+
+METRICS = ["The fleiss_kappa value of all HITs",
+           "The average pair-wise agreement of all HITs",
+           "The average Cohen's kappa of all HITs"]
+
+
+def bootstrap_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='analyze.py bootstrap',
+        description='Bootstrap confidence intervals of agreement '
+                    'statistics, resampled over items and over HITs.')
+    parser.add_argument('filepaths', nargs='+', help='result csv files.')
+    parser.add_argument('--resamples', type=int, default=1000,
+                        help='number of bootstrap resamples.')
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help='confidence level of the intervals.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed of the resamples.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of worker processes.')
+    args = parser.parse_args(argv)
+
+    columns = agreement.AnswerColumns()
+    for filepath in args.filepaths:
+        load_result_columns(filepath, columns)
+    matrix = agreement.AnswerMatrix.from_columns(columns)
+    for unit in ('item', 'hit'):
+        stats = agreement.unit_statistics(matrix, unit)
+        estimates = agreement.metrics_of_sums(stats.sum(axis=0)[None, :])
+        resamples = agreement.bootstrap(stats, args.resamples, args.seed,
+                                        args.workers)
+        print "Resampled over %d %ss:" %(len(stats), unit)
+        for i, name in enumerate(METRICS):
+            if unit == 'item' and i == 2:
+                # Cohen's kappa is defined over the worker pairs of a HIT
+                continue
+            low, high = agreement.confidence_interval(resamples[:, i],
+                                                      args.confidence)
+            print "%s is %f (%g%% CI %f to %f)." %(
+                name, estimates[i][0], args.confidence * 100, low, high)
+
+
+def rules_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='analyze.py rules',
+        description='Worker correctness by PredPatt rule, rule combination '
+                    'and language, from the pprint of each question.')
+    parser.add_argument('filepaths', nargs='+', help='result csv files.')
+    parser.add_argument('--by', nargs='+', default=['rule', 'combination',
+                                                    'language'],
+                        choices=['rule', 'combination', 'language',
+                                 'language-rule'],
+                        help='groupings to report.')
+    parser.add_argument('--min-items', type=int, default=1,
+                        help='leave out groups with fewer items.')
+    parser.add_argument('--output', type=str, default=None,
+                        help='also write the tables to this csv file.')
+    args = parser.parse_args(argv)
+
+    columns = rules.RuleColumns()
+    for filepath in args.filepaths:
+        load_result_columns(filepath, columns)
+    tables = rules.rule_tables(columns)
+    out = out_file = None
+    if args.output:
+        out_file = open(args.output, 'wb')
+        out = csv.writer(out_file)
+        out.writerow(['by', 'group', 'items', 'judgements', 'correct',
+                      'accuracy', 'precision'])
+    for by in args.by:
+        names, table = tables[by]
+        keep = np.flatnonzero(table['items'] >= args.min_items)
+        keep = keep[np.argsort(-table['judgements'][keep], kind='mergesort')]
+        print
+        print "%-40s %8s %10s %9s %9s" %(by, 'items', 'judgements',
+                                         'accuracy', 'precision')
+        for i in keep:
+            row = table[i]
+            print "%-40s %8d %10d %9.4f %9.4f" %(
+                names[i], row['items'], row['judgements'], row['accuracy'],
+                row['precision'])
+            if out is not None:
+                out.writerow([by, names[i].encode('utf-8'), row['items'],
+                              row['judgements'], row['correct'],
+                              row['accuracy'], row['precision']])
+    if out_file is not None:
+        out_file.close()
+
+
+def workers_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='analyze.py workers',
+        description='Worker confusion matrices, reliabilities and item '
+                    'labels by Dawid-Skene EM.')
+    parser.add_argument('filepaths', nargs='+', help='result csv files.')
+    parser.add_argument('--output', type=str, default=None,
+                        help='write the worker reliabilities and confusion '
+                             'matrices to this csv file.')
+    parser.add_argument('--labels', type=str, default=None,
+                        help='write the posterior item labels to this csv '
+                             'file.')
+    parser.add_argument('--max-iter', type=int, default=100)
+    parser.add_argument('--tol', type=float, default=1e-6,
+                        help='relative log-likelihood gain to stop at.')
+    parser.add_argument('--smoothing', type=float, default=0.1,
+                        help='pseudo-count of every confusion matrix cell.')
+    args = parser.parse_args(argv)
+
+    columns = agreement.AnswerColumns()
+    for filepath in args.filepaths:
+        load_result_columns(filepath, columns)
+    quality = worker_quality.estimate(columns, args.max_iter, args.tol,
+                                      args.smoothing)
+    if args.output:
+        quality.write_workers(args.output)
+    if args.labels:
+        quality.write_labels(args.labels)
+    print "EM stopped after %d iterations, log-likelihood %f." %(
+        quality.iterations, quality.log_likelihood)
+    print "Class priors: %s" %(' '.join('%d: %.4f' %(k, p) for k, p
+                                        in enumerate(quality.priors)))
+    reliabilities = quality.reliabilities()
+    print
+    print "%-40s %10s %11s" %('worker', 'judgements', 'reliability')
+    for w in np.argsort(-reliabilities, kind='mergesort'):
+        print "%-40s %10d %11.4f" %(quality.worker_ids[w],
+                                    quality.judgements[w], reliabilities[w])
+
+
+COMMANDS = {'bootstrap': bootstrap_main, 'rules': rules_main,
+            'workers': workers_main}
+
 if __name__ == '__main__':
-    main(sys.argv[1])
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        main(sys.argv[1:])
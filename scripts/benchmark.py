@@ -0,0 +1,575 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmarks for the calibration pipeline.
+
+    python scripts/benchmark.py load_conllu samples/sample.conllu --scale 100
+    python scripts/benchmark.py load_result data/results/pilot.csv --scale 1000
+    python scripts/benchmark.py escape samples/*.conllu
+    python scripts/benchmark.py parse_store samples/sample.conllu --workers 4
+    python scripts/benchmark.py suite samples/*.conllu data/results/pilot.csv
+
+The escape stage times the old and the fast escaping functions; that
+they give the same output is checked by tests/test_gen_hits.py.
+
+The parse_store stage compares two ways of feeding a process pool:
+pickling every UDParse to the workers and their PredPatt instances back,
+and sending only sentence ranges of a memory-mapped compiled treebank
+and getting cache records back. Both count the bytes pickled between
+the processes.
+
+The suite runs every stage of the pipeline, each in a fresh process, on
+scaled-up copies of the given CoNLL-U files (load_conllu, extract,
+render, write) and result files (load_result, agreement). It reports
+throughput, per-stage time and peak RSS, and compares them with the
+baselines stored by --save-baseline. Regressions beyond --tolerance are
+flagged and make the run exit with status 1.
+
+"""
+
+import os
+import sys
+import csv
+import json
+import codecs
+import shutil
+import timeit
+import argparse
+import resource
+import cPickle as pickle
+import tempfile
+import traceback
+from Queue import Empty
+from multiprocessing import Process, Queue, Pool
+from predpatt.UDParse import DepTriple, UDParse
+import agreement
+from gen_hits import (extract_pp_from_parse, gen_hit_elements, extract_ranges,
+                      open_worker_treebank)
+from cache import load_instances
+from utils import (load_conllu, html_escape_table, HTMLEscaper,
+                   ptb2text, ptb2tokens, gen_chunks)
+from analyze import load_result, load_result_columns
+from treebank import Treebank, compile_treebank
+
+
+def legacy_load_conllu(filename):
+    """The whole-file read+split reader, kept as a reference point."""
+    sent_num = 1
+    with codecs.open(filename, encoding='utf-8') as f:
+        for block in f.read().split('\n\n'):
+            block = block.strip()
+            if not block:
+                continue
+            lines = []
+            sent_id = 'sent_%s' % sent_num
+            has_sent_id = 0
+            for line in block.split('\n'):
+                if line.startswith('#'):
+                    if line.startswith('# sent_id'):
+                        sent_id = line[10:].strip()
+                        has_sent_id = 1
+                    else:
+                        if not has_sent_id:
+                            sent_id = line[1:].strip()
+                    continue
+                line = line.split('\t')
+                if '-' in line[0]:
+                    continue
+                assert len(line) == 10, line
+                lines.append(line)
+            [_, tokens, _, tags, _, _, gov, gov_rel, _, _] = zip(*lines)
+            triples = [DepTriple(rel, int(gov)-1, dep) for dep, (rel, gov)
+                       in enumerate(zip(gov_rel, gov))]
+            parse = UDParse(list(tokens), tags, triples)
+            yield sent_id, parse
+            sent_num += 1
+
+
+def legacy_html_escape(text):
+    """The per-character html_escape, kept as a reference point."""
+    return "".join(html_escape_table.get(c, c) for c in text)
+
+
+class LegacyWorker:
+    """The worker class of the per-row loader."""
+    def __init__(self, workerid, answer):
+        self.workerid = workerid
+        self.answer = int(answer)
+
+
+class LegacyPredicate:
+    """The predicate class of the per-row loader."""
+    def __init__(self, hit_id, pred_id, pred, question, pprint=None):
+        self.hit_id = hit_id
+        self.pred_id = pred_id
+        self.pred_html = pred
+        self.workers = {}
+        self.question = question
+        if pprint:
+            pprint = pprint.replace('\\t', '\t')
+            pprint = pprint.replace('\\n', '\n')
+            self.pprint = pprint
+
+
+class LegacySentence:
+    """The sentence class of the per-row loader."""
+    def __init__(self, q):
+        self.sentid = q['sentenceID']
+        self.sentence_html = q.get('sentence')
+        self.predicates = {}
+
+    def add_worker(self, hit_id, q, row):
+        pred_id = q['pred_id']
+        pred_html = q['predicate']
+        id_ = pred_id + pred_html
+        if id_ not in self.predicates:
+            pred = LegacyPredicate(hit_id, pred_id, pred_html, q,
+                                   q.get('pprint', None))
+            self.predicates[id_] = pred
+        pred = self.predicates[id_]
+        i = q['questionID']
+        workerid = row['WorkerId']
+        answer = row['Answer.correctness_' + i]
+        pred.workers[workerid] = LegacyWorker(workerid, answer)
+
+
+def legacy_load_result(filepath):
+    """
+    The per-row json.loads loader and its classes, as analyze.py had
+    them before the payload tables, kept as a reference point.
+
+    """
+    results = {}
+    with open(filepath) as csv_file:
+        reader = csv.DictReader(csv_file)
+        for i, row in enumerate(reader):
+            json_var = json.loads(row['Input.json_variables'])
+            hit_id = row['Input.json_variables']
+            for q in json_var:
+                if 'normal' not in q['pred_id']:
+                    continue
+                sentid = q['sentenceID']
+                if sentid not in results:
+                    sent = LegacySentence(q)
+                    results[sentid] = sent
+                sent = results[sentid]
+                sent.add_worker(hit_id, q, row)
+    print len(results)
+    return results
+
+
+def scale_up(filepath, scale):
+    """
+    Write *scale* concatenated copies of filepath to a temporary file
+    and return its path.
+
+    """
+    fd, path = tempfile.mkstemp(suffix='_' + os.path.basename(filepath))
+    with os.fdopen(fd, 'wb') as out:
+        for _ in xrange(scale):
+            with open(filepath, 'rb') as f:
+                shutil.copyfileobj(f, out)
+            out.write('\n\n')
+    return path
+
+
+def scale_up_result(filepath, scale):
+    """
+    Write the header of a result file followed by *scale* copies of its
+    rows to a temporary file. Each copy gets its own HIT and sentence
+    IDs, so that copies are distinct HITs answered by the same workers;
+    the HIT ID columns a file lacks are left out. Return the path and
+    the number of rows written.
+
+    """
+    with open(filepath, 'rb') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = list(reader)
+    index = {name: i for i, name in enumerate(header)}
+    if 'Input.json_variables' not in index:
+        raise ValueError('%s has no Input.json_variables column' %(filepath))
+    json_field = index['Input.json_variables']
+    hit_fields = [index[field] for field in ('HITId', 'Input.hit_id')
+                  if field in index]
+    fd, path = tempfile.mkstemp(suffix='_' + os.path.basename(filepath))
+    with os.fdopen(fd, 'wb') as out:
+        writer = csv.writer(out, quoting=csv.QUOTE_ALL)
+        writer.writerow(header)
+        for copy in xrange(scale):
+            for row in rows:
+                row = list(row)
+                for field in hit_fields:
+                    row[field] += '_%d' % copy
+                row[json_field] = row[json_field].replace(
+                    '"sentenceID": "', '"sentenceID": "%d_' % copy)
+                writer.writerow(row)
+    return path, scale * len(rows)
+
+
+def _run(queue, fn, args):
+    # keep the progress prints of the loaders out of the report
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = timeit.default_timer()
+        count = fn(*args)
+        elapsed = timeit.default_timer() - start
+        # stages that need untimed setup time themselves
+        if isinstance(count, tuple):
+            count, elapsed = count
+        # ru_maxrss is reported in kilobytes on Linux.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    except Exception:
+        queue.put((traceback.format_exc(), None))
+    else:
+        queue.put((None, (count, elapsed, peak)))
+
+
+def measure(fn, *args):
+    """
+    Run fn(*args) in a fresh process so that its peak RSS is not
+    polluted by earlier runs. Return (count, seconds, peak RSS in MB).
+    Raise RuntimeError if fn raises or its process dies.
+
+    """
+    queue = Queue()
+    p = Process(target=_run, args=(queue, fn, args))
+    p.start()
+    while True:
+        # a process that died before a get can't put anything after it
+        alive = p.is_alive()
+        try:
+            error, result = queue.get(timeout=1)
+            break
+        except Empty:
+            if not alive:
+                raise RuntimeError('%s exited with code %s' %(fn.__name__,
+                                                              p.exitcode))
+    p.join()
+    if error is not None:
+        raise RuntimeError('%s failed:\n%s' %(fn.__name__, error))
+    return result
+
+
+def report(name, count, elapsed, peak, unit='sents'):
+    print '%-24s %8d %s %8.2fs %10.1f %s/s %8.1f MB' %(
+        name, count, unit, elapsed, count / max(elapsed, 1e-9), unit, peak)
+    sys.stdout.flush()
+
+
+def count_parses(reader, filename):
+    return sum(1 for _ in reader(filename))
+
+
+def count_rows(loader, filepath, n_rows):
+    loader(filepath)
+    return n_rows
+
+
+def bench_load_result(filepath, scale):
+    path, n_rows = scale_up_result(filepath, scale)
+    try:
+        print '%s x%d: %.1f MB' %(filepath, scale,
+                                  os.path.getsize(path) / 1024. / 1024.)
+        for name, loader in (('legacy_load_result', legacy_load_result),
+                             ('load_result', load_result),
+                             ('load_result_columns', load_result_columns)):
+            report(name, *measure(count_rows, loader, path, n_rows),
+                   unit='rows')
+    finally:
+        os.remove(path)
+
+
+def bench_load_conllu(filepath, scale):
+    path = scale_up(filepath, scale)
+    try:
+        print '%s x%d: %.1f MB' %(filepath, scale,
+                                  os.path.getsize(path) / 1024. / 1024.)
+        for name, reader in (('legacy_load_conllu', legacy_load_conllu),
+                             ('load_conllu', load_conllu)):
+            report(name, *measure(count_parses, reader, path))
+        compile_treebank(path, path + '.tb')
+        report('treebank', *measure(count_parses, Treebank, path + '.tb'))
+    finally:
+        os.remove(path)
+        if os.path.isdir(path + '.tb'):
+            shutil.rmtree(path + '.tb')
+
+
+def bench_escape(filepaths, repeat=5):
+    sentences = [list(parse.tokens) for filepath in filepaths
+                 for _, parse in load_conllu(filepath)]
+    n = len(sentences)
+
+    def legacy_ptb():
+        for tokens in sentences:
+            ptb2text(' '.join(tokens)).split(' ')
+
+    def fast_ptb():
+        for tokens in sentences:
+            ptb2tokens(tokens)
+
+    def legacy_escape():
+        # a sentence, its tokens and its phrases, as gen_hits used to
+        for tokens in sentences:
+            legacy_html_escape(' '.join(tokens))
+            for t in tokens:
+                legacy_html_escape(t)
+            legacy_html_escape(' '.join(tokens[:len(tokens) // 2]))
+
+    def fast_escape():
+        for tokens in sentences:
+            escape = HTMLEscaper()
+            escape[' '.join(tokens)]
+            for t in tokens:
+                escape[t]
+            ' '.join(escape[t] for t in tokens[:len(tokens) // 2])
+
+    for name, fn in (('legacy ptb2text', legacy_ptb),
+                     ('ptb2tokens', fast_ptb),
+                     ('legacy html_escape', legacy_escape),
+                     ('html_escape + memo', fast_escape)):
+        elapsed = min(timeit.repeat(fn, number=1, repeat=repeat))
+        report(name, n, elapsed, resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024.)
+
+
+def _extract_parses(chunk):
+    ret = []
+    for slabel, parse in chunk:
+        sent, ppatt = extract_pp_from_parse(parse)
+        ret.append((slabel, sent, ppatt.instances))
+    return ret
+
+
+def ship_parses(filepath, workers, chunk_size):
+    """Pickle parses to the workers and their instances back."""
+    start = timeit.default_timer()
+    tasks = list(gen_chunks(load_conllu(filepath), chunk_size))
+    pool = Pool(workers)
+    results = pool.map(_extract_parses, tasks)
+    pool.close()
+    pool.join()
+    return tasks, results, timeit.default_timer() - start
+
+
+def ship_ranges(path, workers, chunk_size):
+    """Send ranges of a compiled treebank and rebuild the records sent back."""
+    start = timeit.default_timer()
+    n = len(Treebank(path))
+    tasks = [[(i, min(i + chunk_size, n))] for i in xrange(0, n, chunk_size)]
+    pool = Pool(workers, open_worker_treebank, (path,))
+    results = pool.map(extract_ranges, tasks)
+    pool.close()
+    pool.join()
+    for result in results:
+        for record, _, _ in result:
+            if record is not None:
+                load_instances(record)
+    return tasks, results, timeit.default_timer() - start
+
+
+def bench_parse_store(filepath, scale, workers, chunk_size=200):
+    path = scale_up(filepath, scale)
+    try:
+        print '%s x%d: %.1f MB, %d workers' %(
+            filepath, scale, os.path.getsize(path) / 1024. / 1024., workers)
+        compile_treebank(path, path + '.tb')
+        for name, ship, source in (('pickled parses', ship_parses, path),
+                                   ('treebank ranges', ship_ranges,
+                                    path + '.tb')):
+            tasks, results, elapsed = ship(source, workers, chunk_size)
+            n = sum(len(result) for result in results)
+            shipped = sum(len(pickle.dumps(x, pickle.HIGHEST_PROTOCOL))
+                          for x in tasks + results)
+            print '%-24s %8d sents %8.2fs %10.1f sents/s %8.1f KB/100 sents' %(
+                name, n, elapsed, n / max(elapsed, 1e-9),
+                shipped / 1024. * 100 / max(n, 1))
+            sys.stdout.flush()
+    finally:
+        os.remove(path)
+        if os.path.isdir(path + '.tb'):
+            shutil.rmtree(path + '.tb')
+
+
+def stage_load_conllu(filepath):
+    return count_parses(load_conllu, filepath)
+
+
+def extract_all(filepath):
+    ret = []
+    for slabel, parse in load_conllu(filepath):
+        sent, ppatt = extract_pp_from_parse(parse)
+        ret.append((slabel, sent, ppatt.instances))
+    return ret
+
+
+def stage_extract(filepath):
+    start = timeit.default_timer()
+    n = 0
+    for _, parse in load_conllu(filepath):
+        extract_pp_from_parse(parse)
+        n += 1
+    return n, timeit.default_timer() - start
+
+
+def stage_render(filepath):
+    sentences = extract_all(filepath)
+    start = timeit.default_timer()
+    for slabel, sent, instances in sentences:
+        for _ in gen_hit_elements(slabel, sent, instances, "conll"):
+            pass
+    return len(sentences), timeit.default_timer() - start
+
+
+def stage_write(filepath):
+    elements = [e for slabel, sent, instances in extract_all(filepath)
+                for e in gen_hit_elements(slabel, sent, instances, "conll")]
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    start = timeit.default_timer()
+    with os.fdopen(fd, 'wb') as f:
+        writer = csv.writer(f, delimiter=',', quoting=csv.QUOTE_ALL)
+        writer.writerow(['json_variables'])
+        row = []
+        for e in elements:
+            e['questionID'] = 'q_%d' %(len(row) + 1)
+            row.append(e)
+            if len(row) == 5:
+                writer.writerow([json.dumps(row, sort_keys=True)])
+                row = []
+    elapsed = timeit.default_timer() - start
+    os.remove(path)
+    return len(elements), elapsed
+
+
+def stage_load_result(filepath, n_rows):
+    load_result_columns(filepath)
+    return n_rows
+
+
+def stage_agreement(filepath, n_rows):
+    columns = load_result_columns(filepath)
+    start = timeit.default_timer()
+    matrix = agreement.AnswerMatrix.from_columns(columns)
+    counts = matrix.category_counts()
+    agreement.fleiss_kappa(counts)
+    agreement.pairwise_agreement(counts)
+    agreement.cohen_kappa_by_hit(matrix)
+    return n_rows, timeit.default_timer() - start
+
+
+CONLLU_STAGES = [('load_conllu', stage_load_conllu, 'sents'),
+                 ('extract', stage_extract, 'sents'),
+                 ('render', stage_render, 'sents'),
+                 ('write', stage_write, 'elements')]
+RESULT_STAGES = [('load_result', stage_load_result, 'rows'),
+                 ('agreement', stage_agreement, 'rows')]
+
+
+def load_baseline(path):
+    if path and os.path.isfile(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def check_regression(entry, baseline, tolerance):
+    """Describe how entry regressed against its baseline, if it did."""
+    problems = []
+    if baseline is None:
+        return problems
+    if entry['rate'] < baseline['rate'] * (1 - tolerance):
+        problems.append('rate %.1f < %.1f' %(entry['rate'], baseline['rate']))
+    if entry['peak_mb'] > baseline['peak_mb'] * (1 + tolerance):
+        problems.append('peak %.1f MB > %.1f MB' %(entry['peak_mb'],
+                                                   baseline['peak_mb']))
+    return problems
+
+
+def bench_suite(filepaths, scale, result_scale, baseline_path,
+                save_baseline, tolerance):
+    """
+    Run every stage on every input and return the number of
+    regressions against the stored baseline.
+
+    """
+    baseline = load_baseline(baseline_path)
+    entries = {}
+    regressions = 0
+    for filepath in filepaths:
+        if filepath.endswith('.csv'):
+            path, n_rows = scale_up_result(filepath, result_scale)
+            stages = [(name, fn, (path, n_rows), unit)
+                      for name, fn, unit in RESULT_STAGES]
+            factor = result_scale
+        else:
+            path = scale_up(filepath, scale)
+            stages = [(name, fn, (path,), unit)
+                      for name, fn, unit in CONLLU_STAGES]
+            factor = scale
+        print '%s x%d' %(filepath, factor)
+        try:
+            for name, fn, args, unit in stages:
+                count, elapsed, peak = measure(fn, *args)
+                key = '%s x%d:%s' %(os.path.basename(filepath), factor, name)
+                entries[key] = {'count': count, 'seconds': elapsed,
+                                'rate': count / max(elapsed, 1e-9),
+                                'peak_mb': peak, 'unit': unit}
+                report('  ' + name, count, elapsed, peak, unit=unit)
+                problems = check_regression(entries[key], baseline.get(key),
+                                            tolerance)
+                if problems:
+                    regressions += 1
+                    print '  REGRESSION %s: %s' %(key, '; '.join(problems))
+        finally:
+            os.remove(path)
+    if save_baseline:
+        baseline.update(entries)
+        with open(baseline_path, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print 'baseline saved to %s' %(baseline_path)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('stage', choices=['load_conllu', 'load_result',
+                                          'escape', 'parse_store', 'suite'],
+                        help='stage to benchmark.')
+    parser.add_argument('filenames', nargs='+',
+                        help='paths to the input files.')
+    parser.add_argument('--scale', type=int, default=None,
+                        help='number of copies of the input to concatenate '
+                             '(default 10, or 1 for the CoNLL-U files of '
+                             'the suite).')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='number of worker processes of parse_store.')
+    parser.add_argument('--result-scale', type=int, default=100,
+                        help='number of copies of result files in the suite.')
+    parser.add_argument('--baseline', default='benchmark_baseline.json',
+                        help='path to the stored suite baselines.')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results of this run as baselines.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown or memory growth over the '
+                             'baseline that counts as a regression.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.stage == 'load_conllu':
+        for filename in args.filenames:
+            bench_load_conllu(filename, args.scale or 10)
+    elif args.stage == 'load_result':
+        for filename in args.filenames:
+            bench_load_result(filename, args.scale or 10)
+    elif args.stage == 'escape':
+        bench_escape(args.filenames)
+    elif args.stage == 'parse_store':
+        for filename in args.filenames:
+            bench_parse_store(filename, args.scale or 10, args.workers)
+    elif args.stage == 'suite':
+        if bench_suite(args.filenames, args.scale or 1, args.result_scale,
+                       args.baseline, args.save_baseline, args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Byte-offset index of the sentence blocks of a CoNLL-U style file.
+
+Blocks are the pieces of f.read().split('\n\n'). The index is an
+(n_blocks x 2) int64 array of (offset, length) saved beside the data as
+<file>.idx.npy and memory-mapped at query time, so reading k blocks
+costs O(k) seeks instead of reading the whole file.
+
+    python scripts/block_index.py sample_dir/*
+
+builds the indexes ahead of time.
+
+"""
+
+import os
+import sys
+import mmap
+import tempfile
+import numpy as np
+
+SEPARATOR = '\n\n'
+
+
+def index_path(filepath):
+    return filepath + '.idx.npy'
+
+
+def build_block_index(filepath):
+    """
+    Scan filepath once and return the (offset, length) of each block,
+    exactly as str.split(SEPARATOR) would cut it.
+
+    """
+    size = os.path.getsize(filepath)
+    if size == 0:
+        return np.zeros((1, 2), dtype=np.int64)
+    offsets = []
+    with open(filepath, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = 0
+            while True:
+                end = mm.find(SEPARATOR, start)
+                if end == -1:
+                    offsets.append((start, size - start))
+                    break
+                offsets.append((start, end - start))
+                start = end + len(SEPARATOR)
+        finally:
+            mm.close()
+    return np.asarray(offsets, dtype=np.int64)
+
+
+def save_block_index(filepath, index):
+    """Write the index beside filepath, atomically."""
+    path = index_path(filepath)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                               suffix='.npy')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, index)
+    os.rename(tmp, path)
+
+
+def load_block_index(filepath):
+    """
+    Memory-map the index of filepath, building it first if it is missing,
+    older than the data or doesn't end where the data ends.
+
+    """
+    path = index_path(filepath)
+    if (os.path.isfile(path) and
+            os.path.getmtime(path) >= os.path.getmtime(filepath)):
+        index = np.load(path, mmap_mode='r')
+        if index[-1].sum() == os.path.getsize(filepath):
+            return index
+    save_block_index(filepath, build_block_index(filepath))
+    return np.load(path, mmap_mode='r')
+
+
+def read_blocks(filepath, index, ids):
+    """
+    Read the blocks with the given ids. Blocks are read in file order and
+    returned in the order of ids, as byte strings.
+
+    """
+    blocks = {}
+    with open(filepath, 'rb') as f:
+        for i in sorted(set(ids), key=lambda i: index[i, 0]):
+            offset, length = index[i]
+            f.seek(offset)
+            blocks[i] = f.read(length)
+    return [blocks[i] for i in ids]
+
+
+if __name__ == '__main__':
+    for filepath in sys.argv[1:]:
+        if filepath.endswith('.idx.npy'):
+            continue
+        save_block_index(filepath, build_block_index(filepath))
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Content-addressed on-disk cache of PredPatt extractions.
+
+An extraction is stored as a plain record holding what the HIT
+formatting code needs from a sentence: its tokens with their governors,
+and for each predicate the token positions of the predicate and its
+arguments, its type, identifier() and format(track_rule=True) output.
+Records are keyed by a hash of the form, tag, governor and relation of
+the tokens and the PredPattOpts fields, so changing the HTML formatting
+or the comments of a sentence never invalidates them, and a sentence
+hits the same entry whether it is read from CoNLL-U or a compiled
+treebank.
+
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import cPickle as pickle
+
+# Bump when the record layout changes.
+CACHE_VERSION = 1
+
+
+class CachedToken:
+    """
+    Define the token class of a cached extraction.
+
+    """
+    def __init__(self, position, text, gov_rel):
+        self.position = position
+        self.text = text
+        self.gov_rel = gov_rel
+        self.gov = None
+
+
+class CachedArgument:
+    """
+    Define the argument class of a cached extraction.
+
+    """
+    def __init__(self, root, tokens, name=None):
+        self.root = root
+        self.position = root.position
+        self.tokens = tokens
+        self.name = name
+
+
+class CachedPredicate:
+    """
+    Define the predicate class of a cached extraction.
+
+    """
+    def __init__(self, type_, root, tokens, arguments, identifier, pprint):
+        self.type = type_
+        self.root = root
+        self.position = root.position
+        self.tokens = tokens
+        self.arguments = arguments
+        self._identifier = identifier
+        self._pprint = pprint
+
+    def identifier(self):
+        return self._identifier
+
+    def format(self, C=None, track_rule=True):
+        """Return the stored format(track_rule=True) output."""
+        return self._pprint
+
+
+def serialize_instances(tokens, instances):
+    """
+    Turn PredPatt tokens and instances into a picklable record.
+
+    """
+    return {
+        'tokens': [(tk.text, tk.gov.position if tk.gov is not None else -1,
+                    tk.gov_rel) for tk in tokens],
+        'instances': [
+            {'type': pred.type,
+             'root': pred.root.position,
+             'tokens': [tk.position for tk in pred.tokens],
+             'arguments': [(arg.root.position,
+                            [tk.position for tk in arg.tokens],
+                            getattr(arg, 'name', None))
+                           for arg in pred.arguments],
+             'identifier': pred.identifier(),
+             'pprint': pred.format(C=lambda x, _: x, track_rule=True)}
+            for pred in instances]}
+
+
+def load_instances(record):
+    """
+    Rebuild (sent, instances) from a record. Tokens are shared between
+    predicates and arguments the same way they are in PredPatt, so
+    identity checks such as `arg.root.gov in pred.tokens` still hold.
+
+    """
+    tokens = [CachedToken(i, text, gov_rel)
+              for i, (text, _, gov_rel) in enumerate(record['tokens'])]
+    for tk, (_, gov, _) in zip(tokens, record['tokens']):
+        if gov >= 0:
+            tk.gov = tokens[gov]
+    instances = []
+    for p in record['instances']:
+        arguments = [CachedArgument(tokens[root], [tokens[i] for i in tks],
+                                    name)
+                     for root, tks, name in p['arguments']]
+        instances.append(CachedPredicate(p['type'], tokens[p['root']],
+                                         [tokens[i] for i in p['tokens']],
+                                         arguments, p['identifier'],
+                                         p['pprint']))
+    sent = " ".join([tk.text for tk in tokens])
+    return sent, instances
+
+
+def cache_key(lines, opts):
+    """
+    Hash the token lines of a sentence (conllu_block_lines or
+    Treebank.sentence_lines) together with PredPattOpts.
+
+    """
+    h = hashlib.sha1()
+    h.update('%d\0' % CACHE_VERSION)
+    h.update(repr(sorted(vars(opts).items())))
+    h.update('\0')
+    h.update('\n'.join(lines).encode('utf-8'))
+    return h.hexdigest()
+
+
+class ExtractionCache:
+    """
+    Persistent LRU cache of extraction records in a sqlite file.
+
+    Entries are evicted least recently used first once their total
+    pickled size exceeds max_bytes. Writes are committed every
+    commit_every changes or commit_seconds, whichever comes first, so
+    that an interrupted run keeps most of its extractions. The recency
+    of the entries read is kept in memory and written in the same
+    batches.
+
+    """
+    def __init__(self, path, max_bytes=1024 * 2 ** 20, commit_every=1000,
+                 commit_seconds=5.0):
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.commit_seconds = commit_seconds
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS extractions '
+                          '(key TEXT PRIMARY KEY, value BLOB, '
+                          'size INTEGER, atime INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS extractions_atime '
+                          'ON extractions (atime)')
+        size, atime = self.conn.execute(
+            'SELECT SUM(size), MAX(atime) FROM extractions').fetchone()
+        self.size = size or 0
+        self.clock = atime or 0
+        self.changes = 0
+        self.atimes = {}
+        self.committed_at = time.time()
+
+    def _tick(self):
+        self.clock += 1
+        return self.clock
+
+    def get(self, key):
+        row = self.conn.execute('SELECT value FROM extractions WHERE key = ?',
+                                (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.atimes[key] = self._tick()
+        self.changes += 1
+        self.maybe_commit()
+        return pickle.loads(str(row[0]))
+
+    def put(self, key, record):
+        value = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        old = self.conn.execute('SELECT size FROM extractions WHERE key = ?',
+                                (key,)).fetchone()
+        if old is not None:
+            self.size -= old[0]
+        self.conn.execute('INSERT OR REPLACE INTO extractions '
+                          'VALUES (?, ?, ?, ?)',
+                          (key, sqlite3.Binary(value), len(value),
+                           self._tick()))
+        self.atimes.pop(key, None)
+        self.size += len(value)
+        self.changes += 1
+        if self.size > self.max_bytes:
+            self.evict()
+        self.maybe_commit()
+
+    def write_atimes(self):
+        """Write the recency of the entries read since the last call."""
+        self.conn.executemany('UPDATE extractions SET atime = ? WHERE key = ?',
+                              [(atime, key)
+                               for key, atime in self.atimes.iteritems()])
+        self.atimes.clear()
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits."""
+        self.write_atimes()
+        cursor = self.conn.execute('SELECT key, size FROM extractions '
+                                   'ORDER BY atime')
+        victims = []
+        for key, size in cursor:
+            if self.size <= self.max_bytes:
+                break
+            victims.append((key,))
+            self.size -= size
+        self.conn.executemany('DELETE FROM extractions WHERE key = ?',
+                              victims)
+
+    def maybe_commit(self):
+        if (self.changes >= self.commit_every or
+                time.time() - self.committed_at >= self.commit_seconds):
+            self.commit()
+
+    def commit(self):
+        self.write_atimes()
+        self.conn.commit()
+        self.changes = 0
+        self.committed_at = time.time()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+def open_cache(path, max_mb):
+    """Open the cache at path, creating its directory if needed."""
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    return ExtractionCache(path, int(max_mb * 2 ** 20))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Sentence-level deduplication ahead of PredPatt extraction.
+
+Sentences are keyed by a hash of their tokens after ptb2text, so copies
+of a sentence that only differ in PTB escapes (-LRB- and so on) or in
+whitespace share a key. The first sentence with a key is canonical;
+later copies are dropped before PredPatt runs, and each is recorded as a
+JSON line {"slabel": <duplicate>, "canonical": <canonical>} so that
+results on the canonical sentence can be fanned back out.
+
+"""
+
+import json
+import hashlib
+from utils import ptb2tokens
+
+
+def sentence_key(tokens):
+    """Hash the normalized token sequence of a sentence."""
+    text = u' '.join(ptb2tokens(list(tokens)))
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).digest()
+
+
+class Deduplicator:
+    """
+    Define the index of the sentences seen so far.
+
+    """
+    def __init__(self, path=None):
+        self.canonical = {}
+        self.duplicates = 0
+        self.out = open(path, 'w') if path else None
+
+    def is_duplicate(self, slabel, tokens):
+        """Record a sentence, telling whether an earlier one had its tokens."""
+        key = sentence_key(tokens)
+        canonical = self.canonical.get(key)
+        if canonical is None:
+            self.canonical[key] = slabel
+            return False
+        self.duplicates += 1
+        if self.out is not None:
+            self.out.write(json.dumps({'slabel': slabel,
+                                       'canonical': canonical},
+                                      sort_keys=True) + '\n')
+        return True
+
+    def filter(self, iterable, slabel_of, tokens_of):
+        """Yield the items of iterable that are not duplicates."""
+        for item in iterable:
+            if not self.is_duplicate(slabel_of(item), tokens_of(item)):
+                yield item
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
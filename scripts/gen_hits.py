@@ -1,23 +1,61 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-import csv
+import os
+import sys
 import json
+import timeit
 import argparse
+import functools
+import itertools
+import traceback
+import collections
+from multiprocessing import Pool
 from predpatt.patt import PredPatt, Argument, PredPattOpts
 try:
     from predpatt.util.linear import construct_pred_from_flat
 except:
     construct_pred_from_flat = False
-from utils import html_escape, ptb2text, load_conllu
+from utils import (html_escape, HTMLEscaper, ptb2tokens, load_conllu,
+                   skip_first, conllu_block_tokens, conllu_block_lines,
+                   gen_ranges, gen_chunks, gen_conllu_blocks, conllu_sent_id,
+                   parse_conllu_block)
+from cache import (CachedArgument, serialize_instances, load_instances,
+                   cache_key, open_cache)
+from profiling import Profiler, NullProfiler
+from shards import CsvWriter, ShardedCsvWriter
+from dedup import Deduplicator
+from payloads import compact_row
+from treebank import Treebank, is_treebank
 
 
 arg_color_list = ['#fb8072', '#ffffb3', '#8dd3c7',
                   '#80b1d3', '#fdb462', '#b3de69',
                   '#fccde5', '#d9d9d9']
 COLORS = {'pred': '#dab3ff', 'arg': arg_color_list, 'special': '#ffffff'}
-corpula = ('<span id=\\"rcorner\\" style=\\"background-color:%s\\">'
-           'is/are</span>' %(COLORS['special']))
+
+
+def span_open(style):
+    return '<span id=\\"rcorner\\" style=\\"%s\\">' %(style)
+
+
+PRED_STYLE = ('width:100px;height:100px;padding:1px;border:5px solid %s;'
+              %(COLORS['pred']))
+ARG_STYLES = ['background-color:%s' %(color) for color in COLORS['arg']]
+SPECIAL_STYLE = 'background-color:%s' %(COLORS['special'])
+# class names of the styles in --compact payloads
+STYLE_CLASSES = dict([('p', PRED_STYLE), ('s', SPECIAL_STYLE)] +
+                     [('a%d' %(i), style)
+                      for i, style in enumerate(ARG_STYLES)])
+
+# HTML fragments are built once here rather than for every token.
+SPAN_CLOSE = '</span>'
+PRED_OPEN = span_open(PRED_STYLE)
+ARG_OPENS = [span_open(style) for style in ARG_STYLES]
+SPECIAL_OPEN = span_open(SPECIAL_STYLE)
+corpula = SPECIAL_OPEN + 'is/are' + SPAN_CLOSE
+POSS = SPECIAL_OPEN + 'has/have' + SPAN_CLOSE
+SOMETHING = SPECIAL_OPEN + 'SOMETHING' + SPAN_CLOSE
 opts = PredPattOpts(simple=False,
                     cut=False,
                     resolve_relcl=True,
@@ -25,17 +63,56 @@ opts = PredPattOpts(simple=False,
                     resolve_poss=True,
                     resolve_appos=True,
                     resolve_conj=True)
+# Set by extract for every run: a Profiler when --profile is given.
+profiler = NullProfiler()
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('filename',
-                        help='path to the input file. Accepts Concrete communications and CoNLLU formats.')
+                        help='path to the input file. Accepts Concrete communications, CoNLLU and compiled treebank (see treebank.py) formats.')
     parser.add_argument('output',
                         help='output')
     parser.add_argument('--reference', nargs='?', const="", type=str,
                         help='path to the reference file, when the input file is in the linear format.')
-    args = parser.parse_args()
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of worker processes for PredPatt extraction. '
+                             'Runs serially by default.')
+    parser.add_argument('--chunk-size', type=int, default=200,
+                        help='number of sentences sent to a worker at a time.')
+    parser.add_argument('--rejects', type=str, default=None,
+                        help='write the lines of a linear-format input that '
+                             'fail to parse to this file, as JSON lines.')
+    parser.add_argument('--dedup', type=str, default=None,
+                        help='skip sentences whose tokens repeat an earlier '
+                             'sentence, writing the duplicate to canonical '
+                             'slabel mapping to this file.')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='path to an on-disk cache of PredPatt extractions '
+                             '(CoNLL-U and compiled treebank input only).')
+    parser.add_argument('--cache-size', type=float, default=1024,
+                        help='size cap of the extraction cache in MB.')
+    parser.add_argument('--compact', action='store_true',
+                        help='write compact payloads: the sentences of a row '
+                             'once, style classes and short keys (see '
+                             'payloads.py).')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='write a JSON report of per-stage timings, '
+                             'counters and sentence latencies to this path.')
+    parser.add_argument('--profile-top', type=int, default=20,
+                        help='number of slowest sentences in the profile.')
+    parser.add_argument('--shard-rows', type=int, default=0,
+                        help='split the output into files of this many rows, '
+                             'e.g. hits.00000.csv, hits.00001.csv, ...')
+    parser.add_argument('--gzip', action='store_true',
+                        help='gzip-compress the output shards.')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume an interrupted sharded run from its '
+                             'checkpoint.')
+    parser.add_argument('--checkpoint-every', type=int, default=1000,
+                        help='number of sentences between checkpoints of a '
+                             'sharded run.')
+    args = parser.parse_args(argv)
     return args
 
 
@@ -48,83 +125,425 @@ def extract_predpattern(sys_args, ft="conll"):
             for y in extract_pp_from_linear(sys_args):
                 yield y
 
+def extract_pp_from_parse(parse):
+    parse.tokens = ptb2tokens(parse.tokens)
+    ppatt = PredPatt(parse, opts=opts)
+    sent = " ".join([t.text for t in ppatt.token])
+    return sent, ppatt
+
+
+def skip_done(sys_args, iterable, key):
+    """
+    Skip the sentences a resumed run has already written, by their
+    number, since slabels may repeat; the slabel of the last one is
+    checked.
+
+    """
+    resume_at = getattr(sys_args, 'resume_at', None)
+    if resume_at is None:
+        return iterable
+    sentences, slabel = resume_at
+    return skip_first(iterable, sentences, slabel, key)
+
+
+def drop_duplicates(sys_args, iterable, slabel_of, tokens_of):
+    """Drop repeated sentences when --dedup is given."""
+    deduplicator = getattr(sys_args, 'deduplicator', None)
+    if deduplicator is None:
+        return iterable
+    return deduplicator.filter(iterable, slabel_of, tokens_of)
+
+
+def gen_parses(sys_args):
+    """
+    Yield the (slabel, parse) pairs of the CoNLL-U or compiled treebank
+    input, leaving out duplicates and the sentences already written. The
+    parses of a compiled treebank are only built for the sentences left.
+
+    """
+    if is_treebank(sys_args.filename):
+        treebank = Treebank(sys_args.filename)
+        items = treebank.gen_sentences()
+        tokens_of = lambda (_, sent): treebank.tokens(sent)
+        build = treebank.parse
+    else:
+        items = load_conllu(sys_args.filename)
+        tokens_of = lambda (_, parse): parse.tokens
+        build = lambda parse: parse
+    items = drop_duplicates(sys_args, items, lambda (slabel, _): slabel,
+                            tokens_of)
+    items = skip_done(sys_args, items, lambda (slabel, _): slabel)
+    for slabel, item in items:
+        yield slabel, build(item)
+
+
 def extract_pp_from_conll(sys_args):
-    for slabel, parse in load_conllu(sys_args.filename):
-        parse.tokens = ptb2text(' '.join(parse.tokens)).split(' ')
-        ppatt = PredPatt(parse, opts=opts)
-        sent = " ".join([t.text for t in ppatt.token])
+    if sys_args.workers > 0 or sys_args.cache:
+        for y in extract_pp_from_records(sys_args):
+            yield y
+        return
+    for slabel, parse in profiler.timed('parse', gen_parses(sys_args)):
+        with profiler.timer('predpatt'):
+            sent, ppatt = extract_pp_from_parse(parse)
+        yield slabel, sent, ppatt.instances if ppatt else []
+
+
+EXTRACT_STAGES = ('parse', 'predpatt', 'serialize')
+
+
+def extract_record(make_parse):
+    """
+    Run PredPatt over the parse returned by make_parse(). Return a
+    (record, error, times) triple so that a failing sentence doesn't take
+    the whole chunk down; times holds the seconds spent in each
+    EXTRACT_STAGES.
+
+    """
+    times = []
+    try:
+        start = timeit.default_timer()
+        parse = make_parse()
+        times.append(timeit.default_timer() - start)
+        start = timeit.default_timer()
+        _, ppatt = extract_pp_from_parse(parse)
+        times.append(timeit.default_timer() - start)
+        start = timeit.default_timer()
+        record = None
         if ppatt:
-            yield slabel, sent, ppatt.instances
+            record = serialize_instances(ppatt.token, ppatt.instances)
+        times.append(timeit.default_timer() - start)
+        return record, None, times
+    except Exception:
+        return None, traceback.format_exc().strip(), times
+
+
+def extract_chunk(chunk):
+    """
+    Run PredPatt over a chunk of (sent_num, block) pairs, usually in a
+    worker process. Return an extract_record() triple per sentence.
+
+    """
+    return [extract_record(lambda: parse_conllu_block(block, sent_num)[1])
+            for sent_num, block in chunk]
+
+
+# The compiled treebank of a worker process. It is opened once by the
+# pool initializer, so tasks only carry sentence ranges.
+worker_treebank = None
+
+
+def open_worker_treebank(path):
+    global worker_treebank
+    worker_treebank = Treebank(path)
+
+
+def extract_ranges(ranges, treebank=None):
+    """
+    Run PredPatt over the sentences of (start, stop) ranges of a compiled
+    treebank, the one of the worker process by default. Return an
+    extract_record() triple per sentence.
+
+    """
+    if treebank is None:
+        treebank = worker_treebank
+    return [extract_record(lambda: treebank.parse(sent))
+            for start, stop in ranges for sent in xrange(start, stop)]
+
+
+def extract_pp_from_records(sys_args):
+    """
+    Extract sentences through serialized records. Each sentence is looked
+    up in the extraction cache first (--cache) and the misses are run
+    through PredPatt, spread over a process pool when --workers is given.
+    Workers get CoNLL-U blocks, or only sentence ranges of a compiled
+    treebank, which every worker maps once. Chunks are collected in input
+    order, so the output is the same as the serial run. At most two
+    chunks per worker are in flight to bound memory.
+
+    """
+    if is_treebank(sys_args.filename):
+        treebank = Treebank(sys_args.filename)
+        sentences = treebank.gen_sentences()
+        tokens_of, lines_of = treebank.tokens, treebank.sentence_lines
+        task_of = lambda misses: list(gen_ranges(misses))
+        extract, extract_here = extract_ranges, functools.partial(
+            extract_ranges, treebank=treebank)
+        initializer, initargs = open_worker_treebank, (sys_args.filename,)
+    else:
+        blocks = profiler.timed('read',
+                                gen_conllu_blocks(sys_args.filename),
+                                sentence=False)
+        sentences = ((conllu_sent_id(block, sent_num), (sent_num, block))
+                     for sent_num, block in enumerate(blocks, 1))
+        tokens_of = lambda (_, block): conllu_block_tokens(block)
+        lines_of = lambda (_, block): conllu_block_lines(block)
+        task_of = lambda misses: misses
+        extract = extract_here = extract_chunk
+        initializer, initargs = None, ()
+    cache = None
+    if sys_args.cache:
+        cache = open_cache(sys_args.cache, sys_args.cache_size)
+    pool = None
+    if sys_args.workers > 0:
+        pool = Pool(sys_args.workers, initializer, initargs)
+    pending = collections.deque()
+
+    def collect(entries, result):
+        if not isinstance(result, list):
+            result = result.get()
+        extracted = iter(result)
+        for slabel, key, record, lookup_time in entries:
+            profiler.add('cache', lookup_time)
+            if record is None:
+                record, error, times = next(extracted)
+                for stage, seconds in zip(EXTRACT_STAGES, times):
+                    profiler.add(stage, seconds)
+                if error is not None:
+                    print >> sys.stderr, 'failed: %s\n%s' %(slabel, error)
+                    profiler.count('failed')
+                if record is None:
+                    yield slabel, None, []
+                    continue
+                if cache is not None:
+                    with profiler.timer('cache'):
+                        cache.put(key, record)
+            with profiler.timer('load'):
+                sent, instances = load_instances(record)
+            yield slabel, sent, instances
+
+    try:
+        slabel_of = lambda (slabel, _): slabel
+        sentences = drop_duplicates(sys_args, sentences, slabel_of,
+                                    lambda (_, item): tokens_of(item))
+        sentences = skip_done(sys_args, sentences, slabel_of)
+        for chunk in gen_chunks(sentences, sys_args.chunk_size):
+            entries, misses = [], []
+            for slabel, item in chunk:
+                key, record = None, None
+                start = timeit.default_timer()
+                if cache is not None:
+                    key = cache_key(lines_of(item), opts)
+                    record = cache.get(key)
+                entries.append((slabel, key, record,
+                                timeit.default_timer() - start))
+                if record is None:
+                    misses.append(item)
+            if pool is None or not misses:
+                result = extract_here(task_of(misses))
+            else:
+                result = pool.apply_async(extract, (task_of(misses),))
+            pending.append((entries, result))
+            if len(pending) >= 2 * max(sys_args.workers, 1):
+                for y in collect(*pending.popleft()):
+                    yield y
+        while pending:
+            for y in collect(*pending.popleft()):
+                yield y
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if cache is not None:
+            print >> sys.stderr, 'cache: %d hits, %d misses' %(cache.hits,
+                                                               cache.misses)
+            cache.close()
+
+
+def gen_lines(filename):
+    """
+    Stream the lines of a file without their newlines, the lines
+    open(filename).read().strip().split("\n") gives: blank lines at
+    either end are left out, and so is the whitespace before the first
+    line and after the last one, so line numbers match the slabels of
+    earlier runs.
+
+    """
+    last, blank = None, []
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip():
+                if last is not None:
+                    blank.append(line)
+                continue
+            if last is None:
+                line = line.lstrip()
+            else:
+                yield last
+                for b in blank:
+                    yield b
+                blank = []
+            last = line
+    yield last.rstrip() if last is not None else ''
+
+
+def gen_linear_pairs(reference, filename):
+    """
+    Zip the reference sentences with the linearized predicates line by
+    line, yielding (line_num, sent, linear). Raise ValueError when one
+    file runs out before the other.
+
+    """
+    end = object()
+    pairs = itertools.izip_longest(gen_lines(reference), gen_lines(filename),
+                                   fillvalue=end)
+    for line_num, (sent, linear) in enumerate(pairs, 1):
+        if sent is end or linear is end:
+            raise ValueError('%s has %d lines but %s has more.' %(
+                reference if sent is end else filename, line_num - 1,
+                filename if sent is end else reference))
+        yield line_num, sent, linear
+
+
+def linear_slabel(line_num):
+    return "mt/ie-%d" % line_num
+
+
+def construct_chunk(chunk):
+    """
+    Run construct_pred_from_flat over a chunk of (line_num, sent, linear)
+    triples, usually in a worker process. Return a (line_num, sent,
+    predicates, error, seconds) tuple per line.
+
+    """
+    ret = []
+    for line_num, sent, linear in chunk:
+        start = timeit.default_timer()
+        try:
+            predicates = construct_pred_from_flat(linear.split())
+            error = None
+        except Exception as e:
+            predicates, error = None, '%s: %s' %(type(e).__name__, e)
+        ret.append((line_num, sent, predicates, error,
+                    timeit.default_timer() - start))
+    return ret
 
 
 def extract_pp_from_linear(sys_args):
-    sent_list = open(sys_args.reference).read().strip().split("\n")
-    linear_list = open(sys_args.filename).read().strip().split("\n")
-    assert len(sent_list) == len(linear_list)
-    count = 0
-    for i in xrange(len(sent_list)):
-        sent = sent_list[i]
-        linear = linear_list[i]
-        try:
-            predicates = construct_pred_from_flat(linear.split())
-        except:
-            continue
-        count += 1
-        yield "mt/ie-%d" % (i+1), sent, predicates
-    print "processed: %d / %d" %(count, len(sent_list))
+    """
+    Stream the reference and linearized files together and build the
+    predicates of each line, spread over a process pool when --workers is
+    given. Lines come out in input order with at most two chunks per
+    worker in flight, so memory doesn't grow with the input. Lines that
+    can't be parsed are written to --rejects as JSON lines.
+
+    """
+    slabel_of = lambda (line_num, _, __): linear_slabel(line_num)
+    pairs = drop_duplicates(sys_args,
+                            gen_linear_pairs(sys_args.reference,
+                                             sys_args.filename),
+                            slabel_of, lambda (_, sent, __): sent.split())
+    pairs = skip_done(sys_args, pairs, slabel_of)
+    pool = None
+    if sys_args.workers > 0:
+        pool = Pool(sys_args.workers)
+    rejects = None
+    if getattr(sys_args, 'rejects', None):
+        rejects = open(sys_args.rejects, 'w')
+    pending = collections.deque()
+    counts = {'lines': 0, 'processed': 0}
+
+    def collect(chunk, result):
+        if not isinstance(result, list):
+            result = result.get()
+        for (_, _, linear), (line_num, sent, predicates, error, seconds) \
+                in zip(chunk, result):
+            counts['lines'] += 1
+            slabel = linear_slabel(line_num)
+            profiler.add('construct', seconds)
+            if error is not None:
+                profiler.count('failed')
+                if rejects is not None:
+                    rejects.write(json.dumps({'line': line_num,
+                                              'slabel': slabel,
+                                              'error': error,
+                                              'linear': linear},
+                                             sort_keys=True) + '\n')
+                yield slabel, sent, []
+                continue
+            counts['processed'] += 1
+            yield slabel, sent, predicates
+
+    try:
+        for chunk in gen_chunks(pairs, sys_args.chunk_size):
+            if pool is None:
+                result = construct_chunk(chunk)
+            else:
+                result = pool.apply_async(construct_chunk, (chunk,))
+            pending.append((chunk, result))
+            if len(pending) >= 2 * max(sys_args.workers, 1):
+                for y in collect(*pending.popleft()):
+                    yield y
+        while pending:
+            for y in collect(*pending.popleft()):
+                yield y
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if rejects is not None:
+            rejects.close()
+    print "processed: %d / %d" %(counts['processed'], counts['lines'])
 
 
 def highlight_sentence(sent_tokens, pred):
-    def highlight(tokens, style):
+    """
+    Highlight the predicate and argument tokens of pred in the escaped
+    sent_tokens and return the whole sentence. sent_tokens is shared
+    between the predicates of a sentence and is not modified: span tags
+    are collected per token position in one pass over each predicate
+    and argument, and only the tagged positions are rebuilt.
+
+    """
+    opens, closes = {}, {}
+
+    def highlight(tokens, open_tag):
         """
-        Add html code to highlight specific *tokens* with specific
-        *color* in sent_tokens.
+        Open a span before each run of consecutive *tokens* and close it
+        after the run.
         """
         if len(tokens) == 0:
             return None
         last_index = -1
         for tk in tokens:
             index = tk.position
-            text = sent_tokens[index]
             if last_index == -1:
-                sent_tokens[index] = ('<span id=\\"rcorner\\" style=\\"'
-                                      '%s\\">%s'
-                                      %(style, text))
-            else:
-                span = index - last_index
-                if span != 1:
-                    sent_tokens[last_index] += '</span>'
-                    sent_tokens[index] = ('<span id=\\"rcorner\\" style=\\"'
-                                          '%s\\">%s'
-                                          %(style, text))
+                opens.setdefault(index, []).append(open_tag)
+            elif index - last_index != 1:
+                # a repeated position reopens the span without closing it
+                if index != last_index:
+                    closes.setdefault(last_index, []).append(SPAN_CLOSE)
+                opens.setdefault(index, []).append(open_tag)
             last_index = index
-        sent_tokens[last_index] += '</span>'
+        closes.setdefault(last_index, []).append(SPAN_CLOSE)
 
     if pred.type != 'poss':
-        style = "width:100px;height:100px;padding:1px;border:5px solid %s;" %COLORS['pred']
-        highlight(pred.tokens, style)
+        highlight(pred.tokens, PRED_OPEN)
     for arg_i, arg in enumerate(sort_by_position(pred.arguments)):
         arg_i = arg_i % len(COLORS['arg'])
-        style = "background-color:%s" %COLORS['arg'][arg_i]
-        highlight(arg.tokens, style)
-
-    return ' '.join(sent_tokens)
+        highlight(arg.tokens, ARG_OPENS[arg_i])
+
+    ret = list(sent_tokens)
+    for index, tags in opens.iteritems():
+        # later spans are opened outside earlier ones
+        ret[index] = ''.join(reversed(tags)) + ret[index]
+    for index, tags in closes.iteritems():
+        ret[index] += ''.join(tags)
+    return ' '.join(ret)
 
 
-def format_poss(pred, placeholder):
-    poss = ('<span id=\\"rcorner\\" style=\\"background-color:%s\\">'
-            'has/have</span>' %(COLORS['special']))
+def format_poss(pred, placeholder, escape=None):
     if placeholder:
-        ret = ' '.join([pred.arguments[0].name, poss,
+        ret = ' '.join([pred.arguments[0].name, POSS,
                         pred.arguments[1].name])
     else:
-        arg_0 = format_arg(pred, pred.arguments[0], 0)
-        arg_1 = format_arg(pred, pred.arguments[1], 1)
-        ret = ' '.join([arg_0, poss, arg_1])
+        arg_0 = format_arg(pred, pred.arguments[0], 0, escape)
+        arg_1 = format_arg(pred, pred.arguments[1], 1, escape)
+        ret = ' '.join([arg_0, POSS, arg_1])
     return ret
 
 
-def preprocess_modpred(pred, placeholder):
+def preprocess_modpred(pred, placeholder, escape=None):
     # Special handling for `amod` and `appos` because the target
     # relation `is/are` deviates from the original word order.
     arg0 = None
@@ -136,12 +555,12 @@ def preprocess_modpred(pred, placeholder):
             other_args.append(arg)
     if arg0 is not None:
         arg_0 = (arg0.name if placeholder
-                 else format_arg(pred, arg0, 0))
+                 else format_arg(pred, arg0, 0, escape))
         ret = [arg_0, corpula]
         args = other_args
     else:
         arg_0 = (args[0].name if placeholder
-                 else format_arg(pred, args[0], 0))
+                 else format_arg(pred, args[0], 0, escape))
         ret = [arg_0, corpula]
         args = args[1:]
     return ret
@@ -151,29 +570,32 @@ def sort_by_position(x):
     return list(sorted(x, key=lambda y: y.position))
 
 
-def format_pred(pred, placeholder):
+def format_pred(pred, placeholder, escape=None):
     ret = []
     args = pred.arguments
+    if escape is None:
+        escape = HTMLEscaper()
 
     if pred.type in {'poss'}:
-        return format_poss(pred, placeholder)
+        return format_poss(pred, placeholder, escape)
 
     arg_i = 0  # Count for current argument.
 
     if pred.type in {'amod', 'appos'}:
-        ret += preprocess_modpred(pred, placeholder)
+        ret += preprocess_modpred(pred, placeholder, escape)
         arg_i = 1
 
     # Mix arguments with predicate tokens. Use word order to derive a
     # nice-looking name.
     last_pred_token_pos, last_pred_token_index = -1, -1
     last_token_type = None
+    closed = set()  # indices in ret that end a predicate span
     for idx, y in enumerate(sort_by_position(pred.tokens + args)):
-        if isinstance(y, Argument):
+        if isinstance(y, (Argument, CachedArgument)):
             if placeholder:
                 arg = y.name
             else:
-                arg = format_arg(pred, y, arg_i)
+                arg = format_arg(pred, y, arg_i, escape)
                 arg_i += 1
             ret.append(arg)
             last_token_type = "Argument"
@@ -183,90 +605,186 @@ def format_pred(pred, placeholder):
             #     idx == 0):
             #     ret.append(corpula)
         else:
-            text = html_escape(y.text)
+            text = escape[y.text]
             if last_pred_token_pos == -1:
                 # add html code to the first token of the predicate
-                text = ('<span id=\\"rcorner\\" style=\\"'
-                        'width:100px;height:100px;padding:1px;border:5px'
-                        ' solid %s;\\">%s' %(COLORS['pred'], text))
-                ret.append(text)
+                ret.append(PRED_OPEN + text)
             else:
                 if last_token_type == "Argument":
                     # if there's argument in between
-                    # add html code to end the span
-                    ret[last_pred_token_index] += '</span>'
-                    # add html code to start a new span
-                    text = ('<span id=\\"rcorner\\" style=\\"'
-                            'width:100px;height:100px;padding:1px;border:5px'
-                            ' solid %s;\\">%s' %(COLORS['pred'], text))
-                    ret.append(text)
+                    # end the span and start a new one
+                    closed.add(last_pred_token_index)
+                    ret.append(PRED_OPEN + text)
                 else:
                     ret.append(text)
             last_token_type = "Predicate"
             last_pred_token_pos = y.position
             last_pred_token_index = len(ret) - 1
-    ret[last_pred_token_index] += '</span>'
-    return ' '.join(ret)
-
-
-def format_arg(pred, arg, arg_i):
-    something = ('<span id=\\"rcorner\\" style=\\"background-color:%s\\">'
-                 'SOMETHING</span>' %(COLORS['special']))
-    arg_phrase = html_escape(' '.join(tk.text for tk in arg.tokens))
-    arg_phrase = ('<span id=\\"rcorner\\" style=\\"background-color:%s\\">'
-                  '%s</span>' %(COLORS['arg'][arg_i], arg_phrase))
+    closed.add(last_pred_token_index % len(ret))
+    return ' '.join([piece + SPAN_CLOSE if i in closed else piece
+                     for i, piece in enumerate(ret)])
+
+
+def format_arg(pred, arg, arg_i, escape=None):
+    if escape is None:
+        escape = HTMLEscaper()
+    # escaping is per character, so the phrase is the escaped tokens
+    arg_phrase = (ARG_OPENS[arg_i] +
+                  ' '.join([escape[tk.text] for tk in arg.tokens]) +
+                  SPAN_CLOSE)
     if ((arg.root.gov_rel in {'ccomp', 'csubj', 'xcomp'}) and
             arg.root.gov in pred.tokens and pred.type == 'normal'):
-        s = something + ' := ' + arg_phrase
+        s = SOMETHING + ' := ' + arg_phrase
     else:
         s = arg_phrase
     return s
 
 
-def create_a_hit_element(qid, slabel, sent, html_sent, pred):
-    pprint = pred.format(C=lambda x, _: x, track_rule=True)
+def create_a_hit_element(slabel, sent, html_sent, pred, escape=None):
+    with profiler.timer('pprint'):
+        pprint = pred.format(C=lambda x, _: x, track_rule=True)
     for a, b in (('\t', '\\t'), ('\n', '\\n')):
         pprint = pprint.replace(a, b)
+    if escape is None:
+        escape = HTMLEscaper()
     e = {}
-    e['questionID'] = 'q_%d' %qid
     e['sentenceID'] = slabel
-    e['sentence'] = html_escape(sent)
+    e['sentence'] = escape[sent]
     e['html_sentence'] = html_sent
     e['pred_id'] = pred.identifier()
     e['pprint'] = html_escape(pprint)
-    e['predicate'] = '<div class=\\"statement_for_predicate\\">'
-    e['predicate'] += format_pred(pred, False) + '</div>'
+    with profiler.timer('html'):
+        e['predicate'] = '<div class=\\"statement_for_predicate\\">'
+        e['predicate'] += format_pred(pred, False, escape) + '</div>'
     return e
 
 
-def extract():
-    sys_args = parse_args()
-    ft = "conll" if sys_args.reference is None else "linear"
-    f = open(sys_args.output, 'wb')
-    writer = csv.writer(f, delimiter=',', quoting=csv.QUOTE_ALL)
-    writer.writerow(['json_variables'])
-    row= []
-    for slabel, sent, instances in extract_predpattern(sys_args, ft):
-        tokens = [html_escape(text) for text in sent.split()]
-        for pred in instances:
-            # only output normal output for now
-            if pred.type != 'normal':
-                continue
-            # highlight argument phrases and return the whole sentence str
+def gen_hit_elements(slabel, sent, instances, ft):
+    """
+    Yield a HIT question element for each normal predicate of a sentence.
+    Question IDs are assigned when the elements are grouped into rows.
+
+    """
+    escape = HTMLEscaper()
+    tokens = [escape[text] for text in sent.split()]
+    for pred in instances:
+        # only output normal output for now
+        if pred.type != 'normal':
+            continue
+        # highlight argument phrases and return the whole sentence str
+        with profiler.timer('html'):
             if ft == "conll":
-                html_sent = highlight_sentence(tokens[:], pred)
+                html_sent = highlight_sentence(tokens, pred)
             else:
                 html_sent = " ".join(tokens)
-            if html_sent is None:
-                continue
-            # create an element for a hit quesiton
-            e = create_a_hit_element(len(row) + 1, slabel, sent, html_sent,
-                                     pred)
-            row.append(e)
-            if len(row) == 5:
-                writer.writerow([json.dumps(row, sort_keys=True)])
-                row = []
-    f.close()
+        if html_sent is None:
+            continue
+        # create an element for a hit quesiton
+        yield create_a_hit_element(slabel, sent, html_sent, pred, escape)
+
+
+def gen_elements(sys_args, ft, end_sentence=None):
+    """
+    Generate the HIT elements of every sentence, calling end_sentence
+    with the slabel once all elements of a sentence have been consumed.
+    Sentences without predicates, or that failed, have no elements but
+    are ended all the same, so their time isn't counted towards the next
+    sentence.
+
+    """
+    for slabel, sent, instances in extract_predpattern(sys_args, ft):
+        if instances:
+            for e in gen_hit_elements(slabel, sent, instances, ft):
+                profiler.count('elements')
+                yield e
+        if end_sentence is not None:
+            end_sentence(slabel)
+        profiler.count('sentences')
+        profiler.count('predicates', len(instances))
+        profiler.end_sentence(slabel, len(sent.split()) if sent else 0)
+
+
+def output_settings(sys_args):
+    """
+    Return the options that change the rows written, which a resumed run
+    must share with the run it continues.
+
+    """
+    return {'filename': os.path.abspath(sys_args.filename),
+            'reference': sys_args.reference,
+            'compact': sys_args.compact,
+            'dedup': sys_args.dedup and os.path.abspath(sys_args.dedup),
+            'opts': dict(vars(opts))}
+
+
+def extract(sys_args=None):
+    """
+    Write the HITs of sys_args (parse_args() of the command line by
+    default) and return the numbers of sentences, questions and rows
+    written.
+
+    """
+    global profiler
+    if sys_args is None:
+        sys_args = parse_args()
+    # pool processes of multi_lang.py run extract once per language
+    profiler = Profiler(sys_args.profile_top) if sys_args.profile \
+        else NullProfiler()
+    ft = "conll" if sys_args.reference is None else "linear"
+    if sys_args.shard_rows or sys_args.gzip or sys_args.resume:
+        settings = output_settings(sys_args)
+        writer = ShardedCsvWriter.open(sys_args.output, sys_args.shard_rows,
+                                       sys_args.gzip,
+                                       sys_args.checkpoint_every, settings,
+                                       resume=sys_args.resume)
+        if writer.done:
+            print >> sys.stderr, '%s is already complete.' %(sys_args.output)
+            return {'sentences': 0, 'questions': 0, 'rows': 0}
+    else:
+        writer = CsvWriter(sys_args.output)
+    sys_args.resume_at = None
+    if writer.sentences:
+        sys_args.resume_at = (writer.sentences, writer.slabel)
+    # duplicates of skipped sentences are still dropped on resume, since
+    # deduplication runs before the skip
+    sys_args.deduplicator = Deduplicator(sys_args.dedup) if sys_args.dedup \
+        else None
+    if sys_args.resume_at is not None:
+        print >> sys.stderr, 'resuming after %s (%d sentences)' %(
+            writer.slabel, writer.sentences)
+    counts = {'sentences': 0, 'questions': 0, 'rows': 0}
+
+    def end_sentence(slabel):
+        counts['sentences'] += 1
+        writer.end_sentence(slabel)
+
+    # the partial row is part of the checkpoint, so it is kept by the writer
+    row = writer.pending
+    for e in gen_elements(sys_args, ft, end_sentence):
+        counts['questions'] += 1
+        e['questionID'] = 'q_%d' %(len(row) + 1)
+        row.append(e)
+        if len(row) == 5:
+            with profiler.timer('json', sentence=False):
+                if sys_args.compact:
+                    line = json.dumps(compact_row(row, STYLE_CLASSES),
+                                      sort_keys=True)
+                else:
+                    line = json.dumps(row, sort_keys=True)
+            with profiler.timer('write', sentence=False):
+                writer.writerow(line)
+            profiler.count('rows')
+            counts['rows'] += 1
+            del row[:]
+    writer.close()
+    if sys_args.deduplicator is not None:
+        sys_args.deduplicator.close()
+        print >> sys.stderr, 'dropped %d duplicate sentences' %(
+            sys_args.deduplicator.duplicates)
+        profiler.count('duplicates', sys_args.deduplicator.duplicates)
+    if profiler.enabled:
+        profiler.dump(sys_args.profile)
+    return counts
 
 
 if __name__ == "__main__":
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+A local stand-in for the MTurk requester API, to try mturk.py against.
+
+    python scripts/mock_mturk.py --port 8000 --fault-rate 0.1
+
+It keeps HITs in memory and serves CreateHIT and ListAssignmentsForHIT
+over keep-alive HTTP. Every HIT is answered right away by MaxAssignments
+simulated workers; each worker is right with a fixed probability about
+a hidden true answer of each question. A --fault-rate share of the
+requests fail with a server fault or throttling error. Like the real
+service, a CreateHIT whose UniqueRequestToken was used in the last 24
+hours fails with an error naming the HIT created for it.
+
+"""
+
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+from xml.sax.saxutils import escape
+from payloads import load_questions
+
+TARGET_PREFIX = 'MTurkRequesterServiceV20170117.'
+ANSWERS_XML = ('<?xml version="1.0" encoding="UTF-8"?><QuestionFormAnswers '
+               'xmlns="http://mechanicalturk.amazonaws.com/'
+               'AWSMechanicalTurkDataSchemas/2005-10-01/'
+               'QuestionFormAnswers.xsd">%s</QuestionFormAnswers>')
+ANSWER_XML = ('<Answer><QuestionIdentifier>%s</QuestionIdentifier>'
+              '<FreeText>%s</FreeText></Answer>')
+TOKEN_SECONDS = 24 * 3600
+
+
+class ServiceError(Exception):
+    """An error response, with its HTTP status and body."""
+    def __init__(self, status, error_type, message, code=None):
+        Exception.__init__(self, message)
+        self.status = status
+        self.body = {'__type': error_type, 'Message': message}
+        if code is not None:
+            self.body['TurkErrorCode'] = code
+
+
+class MockService:
+    """
+    Define the in-memory state of the mock service.
+
+    """
+    def __init__(self, n_workers=20, fault_rate=0.0, seed=0):
+        self.rng = random.Random(seed)
+        self.workers = [('MOCKWORKER%04d' %(i), self.rng.uniform(0.55, 0.95))
+                        for i in xrange(n_workers)]
+        self.fault_rate = fault_rate
+        self.hits = {}
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def truth(self, q):
+        """The hidden true answer of a question, the same on every run."""
+        key = (q['sentenceID'] + q['pred_id']).encode('utf-8')
+        return ord(hashlib.md5(key).digest()[0]) % 2
+
+    def create_hit(self, params):
+        token = params.get('UniqueRequestToken')
+        if token in self.tokens:
+            hit_id, created = self.tokens[token]
+            if time.time() - created < TOKEN_SECONDS:
+                raise ServiceError(
+                    400, 'RequestError',
+                    'The HIT with ID "%s" already exists for this '
+                    'UniqueRequestToken.' %(hit_id),
+                    'AWS.MechanicalTurk.HitAlreadyExists')
+        json_variables = [p['Value'] for p in params['HITLayoutParameters']
+                          if p['Name'] == 'json_variables'][0]
+        questions = load_questions(json_variables)
+        hit_id = 'MOCKHIT%06d' %(len(self.hits))
+        assignments = []
+        workers = self.rng.sample(self.workers, min(params['MaxAssignments'],
+                                                    len(self.workers)))
+        for i, (workerid, accuracy) in enumerate(workers):
+            answers = []
+            for q in questions:
+                answer = self.truth(q)
+                if self.rng.random() > accuracy:
+                    answer = 1 - answer
+                answers.append(ANSWER_XML %(
+                    escape('correctness_' + q['questionID']), answer))
+            assignments.append({'AssignmentId': '%sA%02d' %(hit_id, i),
+                                'WorkerId': workerid, 'HITId': hit_id,
+                                'AssignmentStatus': 'Submitted',
+                                'Answer': ANSWERS_XML %(''.join(answers))})
+        self.hits[hit_id] = {'HIT': {'HITId': hit_id,
+                                     'HITTypeId': 'MOCKTYPE',
+                                     'MaxAssignments':
+                                     params['MaxAssignments']},
+                             'assignments': assignments}
+        if token:
+            self.tokens[token] = (hit_id, time.time())
+        return {'HIT': self.hits[hit_id]['HIT']}
+
+    def list_assignments(self, params):
+        hit = self.hits.get(params['HITId'])
+        if hit is None:
+            raise KeyError(params['HITId'])
+        start = int(params.get('NextToken') or 0)
+        end = start + params.get('MaxResults', 10)
+        ret = {'Assignments': hit['assignments'][start:end],
+               'NumResults': len(hit['assignments'][start:end])}
+        if end < len(hit['assignments']):
+            ret['NextToken'] = str(end)
+        return ret
+
+    def handle(self, operation, params):
+        """Return the HTTP status and response body of a request."""
+        with self.lock:
+            if self.rng.random() < self.fault_rate:
+                if self.rng.random() < 0.5:
+                    return 503, {'__type': 'ServiceFault',
+                                 'Message': 'mock fault'}
+                return 400, {'__type': 'ThrottlingException',
+                             'Message': 'Rate exceeded'}
+            try:
+                if operation == 'CreateHIT':
+                    return 200, self.create_hit(params)
+                if operation == 'ListAssignmentsForHIT':
+                    return 200, self.list_assignments(params)
+            except ServiceError as e:
+                return e.status, e.body
+            except KeyError as e:
+                return 400, {'__type': 'RequestError',
+                             'Message': 'no such HIT or field %s' %(e)}
+            return 400, {'__type': 'RequestError',
+                         'Message': 'unsupported operation %s' %(operation)}
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length',
+                                                          0)))
+        operation = self.headers.getheader('x-amz-target', '')
+        status, response = self.server.service.handle(
+            operation[len(TARGET_PREFIX):], json.loads(body or '{}'))
+        data = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-amz-json-1.1')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.service = service
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Serve a mock MTurk requester API.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=20,
+                        help='number of simulated workers.')
+    parser.add_argument('--fault-rate', type=float, default=0.0,
+                        help='share of requests that fail.')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = MockServer(('localhost', args.port),
+                        MockService(args.workers, args.fault_rate, args.seed))
+    print 'serving on http://localhost:%d' %(args.port)
+    server.serve_forever()
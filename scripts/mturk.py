@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Publish HIT rows to MTurk and collect their assignments.
+
+    python scripts/mturk.py publish hits.csv published.csv --layout-id <id> \
+        --reward 0.10 --assignments 5 --title "..." --sandbox
+    python scripts/mturk.py collect published.csv results.csv --sandbox
+
+publish creates one HIT per row of a gen_hits.py csv (or of its shards),
+passing the row as the json_variables layout parameter, and writes the
+HIT IDs with their rows to published.csv. collect lists the submitted
+and approved assignments of those HITs and writes them in the column
+layout of MTurk result files (HITId, WorkerId, Input.json_variables,
+Answer.correctness_q_N, ...). The rows are streamed into the
+analyze.py loader as they arrive, and the agreement statistics are
+printed at the end.
+
+Requests run concurrently on a thread pool over a pool of keep-alive
+connections, at most --rate requests per second. Throttled requests,
+server faults and connection errors are retried with exponential
+backoff. CreateHIT carries a UniqueRequestToken derived from the row;
+the service refuses a token it has seen in the last 24 hours with an
+error naming the existing HIT, which is taken as the HIT of the row. So
+retrying it, or publishing the same file again within a day, doesn't
+create a second HIT. Requests are signed with AWS Signature Version 4 when
+AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY are set. mock_mturk.py
+serves the same API locally,
+
+    python scripts/mock_mturk.py --port 8000 &
+    python scripts/mturk.py publish hits.csv published.csv \
+        --endpoint http://localhost:8000 --layout-id mock
+
+"""
+
+import os
+import re
+import csv
+import gzip
+import sys
+import json
+import time
+import hmac
+import socket
+import random
+import urlparse
+import hashlib
+import httplib
+import argparse
+import datetime
+import threading
+import Queue
+import collections
+from multiprocessing.pool import ThreadPool
+from xml.etree import cElementTree as ElementTree
+import agreement
+import analyze
+
+ENDPOINTS = {
+    'production': 'https://mturk-requester.us-east-1.amazonaws.com',
+    'sandbox': 'https://mturk-requester-sandbox.us-east-1.amazonaws.com'}
+TARGET_PREFIX = 'MTurkRequesterServiceV20170117.'
+SERVICE = 'mturk-requester'
+# error types worth retrying, besides HTTP 5xx and 429
+RETRY_ERRORS = ('ServiceFault', 'ThrottlingException',
+                'ServiceUnavailableException')
+QUESTIONS_PER_ROW = 5
+# the TurkErrorCode of a CreateHIT whose UniqueRequestToken was already
+# used, and the HITId in its message, "The HIT with ID ... already exists"
+DUPLICATE_CODE = 'AWS.MechanicalTurk.HitAlreadyExists'
+HIT_ID_RE = re.compile(r'\bHIT with ID "?([0-9A-Z]+)')
+
+
+class RequestError(Exception):
+    """
+    An API error that retrying won't fix, or the last error of a request
+    that ran out of retries. error_type is the __type of the error
+    response, fault its Message and code its TurkErrorCode.
+
+    """
+    def __init__(self, message, error_type='', fault='', code=''):
+        Exception.__init__(self, message)
+        self.error_type = error_type
+        self.fault = fault
+        self.code = code
+
+
+def sign_v4(method, host, path, headers, body, access_key, secret_key,
+            region, service, now=None):
+    """
+    Return headers with the X-Amz-Date and Authorization headers of AWS
+    Signature Version 4 added, for a request without a query string.
+
+    """
+    now = now or datetime.datetime.utcnow()
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date = amz_date[:8]
+    headers = dict(headers)
+    headers['Host'] = host
+    headers['X-Amz-Date'] = amz_date
+    canonical = sorted((name.lower(), ' '.join(str(value).split()))
+                       for name, value in headers.iteritems())
+    signed_headers = ';'.join(name for name, _ in canonical)
+    request = '\n'.join([method, path, '',
+                         ''.join('%s:%s\n' %(name, value)
+                                 for name, value in canonical),
+                         signed_headers, hashlib.sha256(body).hexdigest()])
+    scope = '%s/%s/%s/aws4_request' %(date, region, service)
+    string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                hashlib.sha256(request).hexdigest()])
+    key = 'AWS4' + secret_key
+    for part in (date, region, service, 'aws4_request'):
+        key = hmac.new(key, part, hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign, hashlib.sha256).hexdigest()
+    headers['Authorization'] = (
+        'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s'
+        %(access_key, scope, signed_headers, signature))
+    return headers
+
+
+class ConnectionPool:
+    """
+    Define the pool of keep-alive connections to one host.
+
+    A connection is taken for each request and put back once its
+    response has been read; one that fails is closed and dropped.
+
+    """
+    def __init__(self, endpoint, timeout=30):
+        url = urlparse.urlparse(endpoint)
+        self.secure = url.scheme == 'https'
+        self.host = url.hostname
+        self.port = url.port
+        self.netloc = url.netloc
+        self.timeout = timeout
+        self.idle = Queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        cls = httplib.HTTPSConnection if self.secure else httplib.HTTPConnection
+        with self.lock:
+            self.opened += 1
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body, headers):
+        """Send a request and return its status and body."""
+        try:
+            conn = self.idle.get_nowait()
+        except Queue.Empty:
+            conn = self._connect()
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        if response.getheader('connection', '').lower() == 'close':
+            conn.close()
+        else:
+            self.idle.put(conn)
+        return response.status, data
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+
+class RateLimiter:
+    """
+    Define the token bucket limiting requests to rate per second, with
+    bursts of up to burst requests. A rate of 0 doesn't limit.
+
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # a negative balance reserves the next free slots
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class Client:
+    """
+    Define the client of the MTurk requester API.
+
+    """
+    def __init__(self, endpoint, access_key=None, secret_key=None,
+                 region='us-east-1', workers=8, rate=5.0, retries=5,
+                 backoff=0.5, timeout=30):
+        self.pool = ConnectionPool(endpoint, timeout)
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.workers = workers
+        self.limiter = RateLimiter(rate, burst=workers)
+        self.retries = retries
+        self.backoff = backoff
+        # counted across the threads of _map
+        self.calls = 0
+        self.retried = 0
+        self.lock = threading.Lock()
+
+    def call(self, operation, params):
+        """Call an API operation and return its decoded response."""
+        body = json.dumps(params, sort_keys=True)
+        for attempt in xrange(self.retries + 1):
+            self.limiter.wait()
+            headers = {'Content-Type': 'application/x-amz-json-1.1',
+                       'X-Amz-Target': TARGET_PREFIX + operation}
+            if self.access_key:
+                headers = sign_v4('POST', self.pool.netloc, '/', headers,
+                                  body, self.access_key, self.secret_key,
+                                  self.region, SERVICE)
+            with self.lock:
+                self.calls += 1
+            try:
+                status, data = self.pool.request('POST', '/', body, headers)
+            except (socket.error, httplib.HTTPException) as e:
+                error = '%s: %s' %(type(e).__name__, e)
+                error_type, fault = type(e).__name__, {'Message': str(e)}
+            else:
+                if status == 200:
+                    return json.loads(data)
+                try:
+                    fault = json.loads(data)
+                except ValueError:
+                    fault = {}
+                error_type = fault.get('__type', '').split('#')[-1]
+                error = '%s %d %s: %s' %(operation, status, error_type,
+                                         fault.get('Message', data[:200]))
+                if (status < 500 and status != 429 and
+                        error_type not in RETRY_ERRORS):
+                    raise RequestError(error, error_type,
+                                       fault.get('Message', ''),
+                                       fault.get('TurkErrorCode', ''))
+            if attempt == self.retries:
+                break
+            with self.lock:
+                self.retried += 1
+            # full jitter keeps retrying threads from moving in lockstep
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+        raise RequestError('%s failed after %d attempts: %s' %(
+            operation, self.retries + 1, error), error_type,
+            fault.get('Message', ''), fault.get('TurkErrorCode', ''))
+
+    def create_hit(self, json_variables, hit_params):
+        """
+        Create the HIT of a row and return its HITId, or the HITId of the
+        HIT created for the same row and settings in the last 24 hours.
+
+        """
+        params = dict(hit_params)
+        params['HITLayoutParameters'] = [{'Name': 'json_variables',
+                                          'Value': json_variables}]
+        # the same row and settings always make the same token
+        params['UniqueRequestToken'] = hashlib.sha1(json.dumps(
+            params, sort_keys=True)).hexdigest()
+        try:
+            return self.call('CreateHIT', params)['HIT']['HITId']
+        except RequestError as e:
+            if e.code.lower() != DUPLICATE_CODE.lower():
+                raise
+            m = HIT_ID_RE.search(e.fault)
+            if m is None:
+                raise
+            return m.group(1)
+
+    def list_assignments(self, hit_id):
+        """Return the submitted and approved assignments of a HIT."""
+        ret = []
+        params = {'HITId': hit_id, 'MaxResults': 100,
+                  'AssignmentStatuses': ['Submitted', 'Approved']}
+        while True:
+            response = self.call('ListAssignmentsForHIT', params)
+            ret.extend(response.get('Assignments', []))
+            if not response.get('NextToken') or \
+                    not response.get('Assignments'):
+                return ret
+            params['NextToken'] = response['NextToken']
+
+    def _map(self, fn, iterable):
+        """
+        Yield fn of each item in order, running workers at a time. At
+        most two items per worker are in flight, so iterable is read as
+        results are consumed.
+
+        """
+        pool = ThreadPool(self.workers)
+        pending = collections.deque()
+        try:
+            for item in iterable:
+                pending.append(pool.apply_async(fn, (item,)))
+                if len(pending) >= 2 * self.workers:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def publish(self, rows, hit_params):
+        """Create a HIT per row, yielding (HITId, row) in row order."""
+        return self._map(lambda row: (self.create_hit(row, hit_params), row),
+                         rows)
+
+    def collect(self, hits, n_questions=QUESTIONS_PER_ROW):
+        """
+        Yield the assignments of (HITId, json_variables) pairs as result
+        rows, after a header row.
+
+        """
+        answer_fields = ['correctness_q_%d' %(i + 1)
+                         for i in xrange(n_questions)]
+        yield (['HITId', 'AssignmentId', 'WorkerId', 'AssignmentStatus',
+                'Input.json_variables'] +
+               ['Answer.' + field for field in answer_fields])
+
+        def fetch((hit_id, json_variables)):
+            return hit_id, json_variables, self.list_assignments(hit_id)
+
+        for hit_id, json_variables, assignments in self._map(fetch, hits):
+            for assignment in assignments:
+                answers = parse_answers(assignment['Answer'])
+                yield [utf8(value) for value in
+                       [hit_id, assignment['AssignmentId'],
+                        assignment['WorkerId'],
+                        assignment['AssignmentStatus'], json_variables] +
+                       [answers.get(field, '') for field in answer_fields]]
+
+    def close(self):
+        self.pool.close()
+
+
+def utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def parse_answers(xml):
+    """Map the question identifiers of QuestionFormAnswers XML to answers."""
+    ret = {}
+    for element in ElementTree.fromstring(utf8(xml)).iter():
+        if element.tag.rsplit('}', 1)[-1] != 'Answer':
+            continue
+        fields = {child.tag.rsplit('}', 1)[-1]: child.text or ''
+                  for child in element}
+        ret[fields.get('QuestionIdentifier')] = fields.get('FreeText', '')
+    return ret
+
+
+def read_hit_rows(filepaths):
+    """
+    Yield the json_variables of every row of gen_hits.py csv files, or of
+    their shards, gzipped or not.
+
+    """
+    for filepath in filepaths:
+        opener = gzip.open if filepath.endswith('.gz') else open
+        with opener(filepath, 'rb') as f:
+            reader = csv.reader(f)
+            field = next(reader).index('json_variables')
+            for row in reader:
+                yield row[field]
+
+
+def read_published(filepath):
+    with open(filepath, 'rb') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield row['HITId'], row['json_variables']
+
+
+def make_client(args):
+    endpoint = args.endpoint or ENDPOINTS['sandbox' if args.sandbox
+                                          else 'production']
+    return Client(endpoint, os.environ.get('AWS_ACCESS_KEY_ID'),
+                  os.environ.get('AWS_SECRET_ACCESS_KEY'), args.region,
+                  args.workers, args.rate, args.retries, args.backoff)
+
+
+def publish_main(args):
+    hit_params = {'HITLayoutId': args.layout_id,
+                  'MaxAssignments': args.assignments,
+                  'Reward': args.reward,
+                  'LifetimeInSeconds': args.lifetime,
+                  'AssignmentDurationInSeconds': args.duration,
+                  'AutoApprovalDelayInSeconds': args.auto_approval,
+                  'Title': args.title,
+                  'Description': args.description,
+                  'Keywords': args.keywords}
+    client = make_client(args)
+    n = 0
+    try:
+        with open(args.output, 'wb') as f:
+            writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+            writer.writerow(['HITId', 'json_variables'])
+            for hit_id, row in client.publish(read_hit_rows(args.filepaths),
+                                              hit_params):
+                writer.writerow([utf8(hit_id), row])
+                n += 1
+    finally:
+        client.close()
+    print >> sys.stderr, 'published %d HITs in %d requests (%d retried), ' \
+        '%d connections' %(n, client.calls, client.retried,
+                           client.pool.opened)
+
+
+def collect_main(args):
+    client = make_client(args)
+    try:
+        with open(args.output, 'wb') as f:
+            writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+
+            def gen_rows():
+                for row in client.collect(read_published(args.published),
+                                          args.questions):
+                    writer.writerow(row)
+                    yield row
+
+            columns = analyze.load_result_rows(gen_rows())
+    finally:
+        client.close()
+    print >> sys.stderr, 'collected %d judgements in %d requests ' \
+        '(%d retried), %d connections' %(len(columns), client.calls,
+                                         client.retried, client.pool.opened)
+    if len(columns):
+        results = agreement.AnswerMatrix.from_columns(columns)
+        analyze.cal_pairwise_agreement(results)
+        analyze.cal_fleiss_kappa(results)
+        analyze.cal_cohen_kappa_by_hit(results)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Publish HITs to MTurk and collect their results.')
+    parser.add_argument('--endpoint', type=str, default=None,
+                        help='API endpoint, e.g. of mock_mturk.py.')
+    parser.add_argument('--sandbox', action='store_true',
+                        help='use the requester sandbox.')
+    parser.add_argument('--region', type=str, default='us-east-1')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of concurrent requests.')
+    parser.add_argument('--rate', type=float, default=5.0,
+                        help='requests per second, 0 for no limit.')
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--backoff', type=float, default=0.5,
+                        help='base delay of the retries in seconds.')
+    commands = parser.add_subparsers(dest='command')
+
+    publish = commands.add_parser('publish', help='create a HIT per row.')
+    publish.add_argument('filepaths', nargs='+',
+                         help='gen_hits.py csv files or shards.')
+    publish.add_argument('output', help='csv of the published HITs.')
+    publish.add_argument('--layout-id', required=True,
+                         help='HIT layout with a json_variables parameter.')
+    publish.add_argument('--reward', type=str, default='0.10')
+    publish.add_argument('--assignments', type=int, default=5)
+    publish.add_argument('--lifetime', type=int, default=7 * 24 * 3600)
+    publish.add_argument('--duration', type=int, default=3600)
+    publish.add_argument('--auto-approval', type=int, default=3 * 24 * 3600)
+    publish.add_argument('--title', type=str,
+                         default='Is this statement true of the sentence?')
+    publish.add_argument('--description', type=str,
+                         default='Judge statements extracted from sentences.')
+    publish.add_argument('--keywords', type=str, default='text, language')
+
+    collect = commands.add_parser('collect',
+                                  help='collect assignments of published HITs.')
+    collect.add_argument('published', help='csv written by publish.')
+    collect.add_argument('output', help='result csv.')
+    collect.add_argument('--questions', type=int, default=QUESTIONS_PER_ROW,
+                         help='number of questions per HIT.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.command == 'publish':
+        publish_main(args)
+    else:
+        collect_main(args)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Sample treebanks and generate their HITs, one language per process.
+
+The manifest is a JSON list of treebanks,
+
+    [{"language": "de", "path": "ud/de-ud-train.conllu", "n": 100,
+      "seed": 1},
+     {"language": "en", "path": "ud/en-ud-train.conllu",
+      "args": ["--cache", "cache/en.db"]}]
+
+where n and seed default to the command line values and args are extra
+gen_hits.py options, except --workers: languages already run in
+daemonic worker processes, which can't start a pool of their own. For
+each language, the sample is written to
+<output_dir>/<language>_sample.conllu and the HITs to
+<output_dir>/<language>.csv. Counts and timings of every language go to
+<output_dir>/summary.json.
+
+    python scripts/multi_lang.py manifest.json data/multi_lang_hits --workers 7
+
+"""
+
+import os
+import sys
+import json
+import codecs
+import timeit
+import argparse
+import traceback
+from multiprocessing import Pool
+import gen_hits
+from sample_multi_lang import sample_blocks
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Sample treebanks and generate their HITs concurrently.')
+    parser.add_argument('manifest', help='JSON list of treebanks.')
+    parser.add_argument('output_dir', help='directory of the outputs.')
+    parser.add_argument('--n', type=int, default=100,
+                        help='number of sentences sampled per treebank.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed of treebanks without one.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of languages processed at a time.')
+    return parser.parse_args()
+
+
+def run_language(task):
+    """
+    Sample one treebank and generate its HITs. Return the summary entry
+    of the language; a failure is recorded in it rather than raised.
+
+    """
+    entry, output_dir = task
+    language = entry['language']
+    sample_path = os.path.join(output_dir, '%s_sample.conllu' %(language))
+    output = os.path.join(output_dir, '%s.csv' %(language))
+    ret = {'language': language, 'path': entry['path'], 'n': entry['n'],
+           'seed': entry['seed'], 'sample': sample_path, 'output': output}
+    try:
+        start = timeit.default_timer()
+        blocks, ret['blocks'] = sample_blocks(entry['path'], entry['n'],
+                                              entry['seed'])
+        with codecs.open(sample_path, 'w', 'utf-8') as f:
+            f.write(u'\n\n'.join(blocks) + u'\n')
+        ret['sampled'] = len(blocks)
+        ret['sample_seconds'] = timeit.default_timer() - start
+
+        start = timeit.default_timer()
+        sys_args = gen_hits.parse_args([sample_path, output] +
+                                       entry.get('args', []))
+        ret.update(gen_hits.extract(sys_args))
+        ret['hits_seconds'] = timeit.default_timer() - start
+    except Exception:
+        ret['error'] = traceback.format_exc().strip()
+    return ret
+
+
+def main():
+    args = parse_args()
+    with open(args.manifest) as f:
+        entries = json.load(f)
+    for entry in entries:
+        entry.setdefault('n', args.n)
+        entry.setdefault('seed', args.seed)
+        if gen_hits.parse_args(['-', '-'] + entry.get('args', [])).workers:
+            sys.exit('%s: --workers is not allowed in the args of a manifest '
+                     'entry' %(entry['language']))
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    start = timeit.default_timer()
+    tasks = [(entry, args.output_dir) for entry in entries]
+    pool = Pool(max(1, min(args.workers, len(tasks))))
+    try:
+        summary = []
+        for ret in pool.imap_unordered(run_language, tasks):
+            if 'error' in ret:
+                print >> sys.stderr, 'failed: %s\n%s' %(ret['language'],
+                                                       ret['error'])
+            else:
+                print '%-4s %7d blocks %5d sampled %5d sentences %6d questions' \
+                      ' %6.1fs' %(ret['language'], ret['blocks'],
+                                  ret['sampled'], ret['sentences'],
+                                  ret['questions'],
+                                  ret['sample_seconds'] + ret['hits_seconds'])
+            summary.append(ret)
+    finally:
+        pool.close()
+        pool.join()
+    summary.sort(key=lambda ret: ret['language'])
+    with open(os.path.join(args.output_dir, 'summary.json'), 'w') as f:
+        json.dump({'languages': summary,
+                   'seconds': timeit.default_timer() - start},
+                  f, indent=2, sort_keys=True)
+    if any('error' in ret for ret in summary):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
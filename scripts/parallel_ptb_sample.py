@@ -3,6 +3,8 @@
 
 import sys
 import os
+import argparse
+from multiprocessing import Pool
 from concrete.util.file_io import CommunicationReader
 from concrete_util.io import gen_sent_from_comm
 from concrete_util.export import export_ptb
@@ -26,44 +28,55 @@ def get_entries(filepath):
     return entries
 
 
+def get_ptb(sent):
+    """Export the Stanford CoreNLP constituency parse of a sentence."""
+    for ptb_parse in sent.tokenization.parseList:
+        if ptb_parse.metadata.tool == 'Stanford CoreNLP':
+            return export_ptb(ptb_parse.constituentList)
+    return None
+
+
 def get_ptb_samples(gzfilepath, entries):
     """
     Get ptb samples from gzfile given their entries.
 
+    The needed sentences are indexed by communication id, and the archive
+    is streamed once, stopping as soon as every needed communication has
+    been seen. Samples are returned in the order of entries, and entries
+    that couldn't be found are reported one by one.
+
     """
-    ret = []
-    entry_length = len(entries)
-    _, comm_id, sent_i = entries.pop(0)
-    last_date = None
-    sent_i = int(sent_i)
-    print 'looking for %s at %d' %(comm_id, sent_i)
+    needed = {}
+    for _, comm_id, sent_i in entries:
+        needed.setdefault(comm_id, set()).add(int(sent_i))
+    found = {}
     for comm, filename in CommunicationReader(gzfilepath):
-        current_date = comm.id.rsplit('.')[0]
-        if current_date != last_date:
-            last_date = current_date
-            print current_date
-            sys.stdout.flush()
-        if comm.id != comm_id:
+        sent_ids = needed.pop(comm.id, None)
+        if sent_ids is None:
             continue
         for sent_j, sent in enumerate(gen_sent_from_comm(comm), 1):
-            if sent_i == sent_j:
-                print '+',
-                sys.stdout.flush()
-                for ptb_parse in sent.tokenization.parseList:
-                    if ptb_parse.metadata.tool == 'Stanford CoreNLP':
-                        ptb = export_ptb(ptb_parse.constituentList)
-                        break
-                ret.append((comm_id, sent_i, ptb.encode('utf-8')))
-                if len(entries) == 0:
-                    return ret
-                _, comm_id, sent_i = entries.pop(0)
-                sent_i = int(sent_i)
-                print 'looking for %s at %d' %(comm_id, sent_i)
-                if comm.id != comm_id:
-                    break
-    print >> sys.stderr, 'Missed ptb samples %d-%d: %s' %(entry_length,
-                                                          len(ret),
-                                                          gzfilepath)
+            if sent_j in sent_ids:
+                ptb = get_ptb(sent)
+                if ptb is not None:
+                    found[comm.id, sent_j] = ptb.encode('utf-8')
+        if not needed:
+            break
+
+    ret, missed = [], []
+    for _, comm_id, sent_i in entries:
+        key = (comm_id, int(sent_i))
+        if key in found:
+            ret.append((comm_id, int(sent_i), found[key]))
+        else:
+            missed.append(key)
+    print 'found %d of %d ptb samples in %s' %(len(ret), len(entries),
+                                              gzfilepath)
+    if missed:
+        print >> sys.stderr, 'Missed %d ptb samples in %s:' %(len(missed),
+                                                             gzfilepath)
+        for comm_id, sent_i in missed:
+            print >> sys.stderr, '\t%s__%d' %(comm_id, sent_i)
+    sys.stdout.flush()
     return ret
 
 
@@ -111,13 +124,13 @@ def get_entries_from_hits_file(hits_filepath):
 
     """
     import csv
-    import json
+    from payloads import load_questions
     entries = {}
     sent_id_set = set()
     with open(hits_filepath) as csv_file:
         reader = csv.DictReader(csv_file)
         for row in reader:
-            questions = json.loads(row['Input.json_variables'])
+            questions = load_questions(row['Input.json_variables'])
             for q in questions:
                 sent_id = q['sentenceID']
                 if sent_id in sent_id_set:
@@ -148,26 +161,58 @@ def load_entries(lines):
     return dict(split_line(line) for line in lines)
 
 
-def main(entries_filepath, gz_dirpath, output_filepath, batch_i):
-    # load_entries for batch_i
-    batch_i = int(batch_i)
-    lines = open(entries_filepath).read().split('\n')
-    batch_size = len(lines) / 9
-    lines = lines[(batch_i - 1) * batch_size: batch_i * batch_size]
+def search_file_entry(task):
+    """Search the ptb parses of one file entry in a worker process."""
+    file_entry, gzfilepath, entries = task
+    print "searching %d sentences in %s" %(len(entries), file_entry)
+    sys.stdout.flush()
+    return get_ptb_samples(gzfilepath, entries)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Search the ptb parses of grouped entries in parallel.')
+    parser.add_argument('entries_filepath',
+                        help='entries grouped by get_entries_from_hits_file.')
+    parser.add_argument('gz_dirpath', help='directory of the .tar.gz files.')
+    parser.add_argument('output_filepath', help='output ptb samples.')
+    # the batch number the script used to take, one of 9 runs
+    parser.add_argument('batch_i', nargs='?', help=argparse.SUPPRESS)
+    parser.add_argument('--workers', type=int, default=9,
+                        help='number of archives searched at a time.')
+    args = parser.parse_args(argv)
+    if args.batch_i is not None:
+        parser.error('batch_i is no longer taken: every entry is searched '
+                     'in one run, use --workers to set the number of '
+                     'processes')
+    return args
+
+
+def main(entries_filepath, gz_dirpath, output_filepath, workers=9):
+    # load entries of all file entries
+    lines = [line for line in open(entries_filepath).read().split('\n')
+             if line]
     entries = load_entries(lines)
     print "%d entries loading from %d lines complete." %(len(entries), len(lines))
 
-    # search parses
+    # search parses, one archive per task
+    tasks = [(file_entry, os.path.join(gz_dirpath, file_entry + '.tar.gz'),
+              entries[file_entry]) for file_entry in sorted(entries)]
     ptb_parses = []
-    for file_entry in entries:
-        print "searching %d sentences in %s" %(len(entries[file_entry]), file_entry)
-        gzfilepath = os.path.join(gz_dirpath, file_entry + '.tar.gz')
-        ptb_parses += get_ptb_samples(gzfilepath, entries[file_entry])
-        print
+    pool = Pool(workers)
+    try:
+        for ret in pool.imap(search_file_entry, tasks):
+            ptb_parses += ret
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
     output_ptb_samples(ptb_parses, output_filepath)
 
 
 if __name__ == '__main__':
     # generate_parallel_ptb(*sys.argv[1:])
-    main(*sys.argv[1:])
+    args = parse_args()
+    main(args.entries_filepath, args.gz_dirpath, args.output_filepath,
+         args.workers)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Compact HIT payloads.
+
+A row of HIT questions is normally written as the JSON list of its
+question objects. The compact payload of the same row is
+
+    {"v": 1,
+     "c": {"a0": "background-color:#fb8072", "p": "width:100px;..."},
+     "s": [["<sentenceID>", "<sentence>"], ...],
+     "q": [{"q": "q_1", "s": 0, "i": "<pred_id>", "h": "<html_sentence>",
+            "d": "<predicate>", "r": "<pprint>"}, ...]}
+
+where the sentences of the row are written once in "s" and referenced
+by their index, the keys are shortened, and the highlighting spans carry
+a class, <span class=\"a0\">, whose style is in "c", instead of an
+inline style. expand_row gives back exactly the original questions, and
+load_questions reads both formats.
+
+"""
+
+import re
+import json
+
+VERSION = 1
+# question keys and their compact names
+KEYS = {'questionID': 'q', 'pred_id': 'i', 'html_sentence': 'h',
+        'predicate': 'd', 'pprint': 'r'}
+LONG_KEYS = {short: key for key, short in KEYS.iteritems()}
+HTML_KEYS = ('html_sentence', 'predicate')
+STYLE_SPAN = '<span id=\\"rcorner\\" style=\\"%s\\">'
+CLASS_SPAN = '<span class=\\"%s\\">'
+STYLE_SPAN_RE = re.compile(r'<span id=\\"rcorner\\" style=\\"([^"\\]*)\\">')
+CLASS_SPAN_RE = re.compile(r'<span class=\\"([A-Za-z0-9_-]+)\\">')
+
+
+def compact_row(questions, style_classes):
+    """
+    Return the compact payload of a row of question objects.
+    style_classes maps class names to the inline styles they replace;
+    spans of other styles are left as they are.
+
+    """
+    classes = {style: name for name, style in style_classes.iteritems()}
+    used = {}
+    sentences, sentence_index = [], {}
+
+    def to_class(m):
+        name = classes.get(m.group(1))
+        if name is None:
+            return m.group()
+        used[name] = m.group(1)
+        return CLASS_SPAN %(name)
+
+    ret = []
+    for q in questions:
+        # payloads of older rows may have no sentence
+        sentence = (q['sentenceID'],) + ((q['sentence'],) if 'sentence' in q
+                                         else ())
+        s = sentence_index.get(sentence)
+        if s is None:
+            s = sentence_index[sentence] = len(sentences)
+            sentences.append(list(sentence))
+        c = {'s': s}
+        for key, value in q.iteritems():
+            if key in ('sentenceID', 'sentence'):
+                continue
+            if key in HTML_KEYS:
+                value = STYLE_SPAN_RE.sub(to_class, value)
+            c[KEYS.get(key, key)] = value
+        ret.append(c)
+    return {'v': VERSION, 'c': used, 's': sentences, 'q': ret}
+
+
+def expand_row(row):
+    """Return the question objects of a compact payload."""
+    if row.get('v') != VERSION:
+        raise ValueError('unknown payload version %r' %(row.get('v')))
+    styles = row['c']
+
+    def to_style(m):
+        style = styles.get(m.group(1))
+        if style is None:
+            return m.group()
+        return STYLE_SPAN %(style)
+
+    ret = []
+    for c in row['q']:
+        q = {}
+        for key, value in c.iteritems():
+            if key == 's':
+                q.update(zip(('sentenceID', 'sentence'), row['s'][value]))
+                continue
+            key = LONG_KEYS.get(key, key)
+            if key in HTML_KEYS:
+                value = CLASS_SPAN_RE.sub(to_style, value)
+            q[key] = value
+        ret.append(q)
+    return ret
+
+
+def load_questions(payload):
+    """Decode the questions of a json_variables payload of either format."""
+    questions = json.loads(payload)
+    if isinstance(questions, dict):
+        return expand_row(questions)
+    return questions
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Opt-in per-stage profiling for HIT generation.
+
+A Profiler accumulates time per stage, counters, and the latency of
+every sentence, i.e. the time of all stages spent on it. The report
+includes a latency histogram and the slowest sentences, so that
+pathological parses can be found. NullProfiler has the same interface
+and does nothing, which keeps unprofiled runs fast.
+
+"""
+
+import json
+import heapq
+import timeit
+from array import array
+from contextlib import contextmanager
+
+
+class NullProfiler:
+    """
+    Define the profiler used when profiling is off.
+
+    """
+    enabled = False
+
+    @contextmanager
+    def timer(self, stage, sentence=True):
+        yield
+
+    def add(self, stage, seconds, sentence=True):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def timed(self, stage, iterable, sentence=True):
+        return iterable
+
+    def end_sentence(self, slabel, n_tokens):
+        pass
+
+
+class Profiler:
+    """
+    Define the profiler of a HIT generation run.
+
+    Stage time also counts towards the latency of the current sentence,
+    unless the stage is not tied to one sentence (sentence=False), e.g.
+    serializing a row of five questions. end_sentence closes the current
+    sentence.
+
+    """
+    enabled = True
+
+    def __init__(self, top=20):
+        self.top = top
+        self.stages = {}
+        self.counters = {}
+        self.latencies = array('d')
+        self.slowest = []
+        self.pending = 0.0
+
+    @contextmanager
+    def timer(self, stage, sentence=True):
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.add(stage, timeit.default_timer() - start, sentence)
+
+    def add(self, stage, seconds, sentence=True):
+        seconds_, calls = self.stages.get(stage, (0.0, 0))
+        self.stages[stage] = (seconds_ + seconds, calls + 1)
+        if sentence:
+            self.pending += seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed(self, stage, iterable, sentence=True):
+        """Time every step of iterable as stage."""
+        it = iter(iterable)
+        while True:
+            with self.timer(stage, sentence):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def end_sentence(self, slabel, n_tokens):
+        latency, self.pending = self.pending, 0.0
+        self.latencies.append(latency)
+        entry = (latency, slabel, n_tokens)
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def histogram(self):
+        """Count sentence latencies in power-of-two millisecond buckets."""
+        buckets = {}
+        for latency in self.latencies:
+            bound = 0.125
+            while latency * 1000 > bound:
+                bound *= 2
+            buckets[bound] = buckets.get(bound, 0) + 1
+        return [{'le_ms': bound, 'count': buckets[bound]}
+                for bound in sorted(buckets)]
+
+    def report(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(q):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1,
+                                 int(q * len(latencies)))] * 1000
+
+        total = sum(seconds for seconds, _ in self.stages.itervalues())
+        return {
+            'stages': {stage: {'seconds': seconds, 'calls': calls,
+                               'share': seconds / total if total else 0.0}
+                       for stage, (seconds, calls)
+                       in self.stages.iteritems()},
+            'counters': self.counters,
+            'sentences': {
+                'count': len(latencies),
+                'mean_ms': (sum(latencies) / len(latencies) * 1000
+                            if latencies else 0.0),
+                'p50_ms': percentile(.5),
+                'p90_ms': percentile(.9),
+                'p99_ms': percentile(.99),
+                'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+                'histogram': self.histogram()},
+            'slowest': [{'slabel': slabel, 'tokens': n_tokens,
+                         'ms': latency * 1000}
+                        for latency, slabel, n_tokens
+                        in sorted(self.slowest, reverse=True)]}
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Worker correctness by PredPatt rule, rule combination and language.
+
+The pprint of a question, pred.format(track_rule=True), ends each line
+with the rules that built the predicate or argument, e.g.
+
+    \t?a should give ?b\t[give-root,c,n1,n2,u]
+    \t\t?a: You\t[You-nsubj,g1(nsubj)]
+
+Rule fields are separated by top-level commas; a rule may carry
+arguments in parentheses, borrow-subj(wish/10,owner/4,conj), which are
+not rules. The rule names (c, n1, n2, u, g1) of each item are interned to ints and
+kept as a CSR array next to the answer columns, so that counts per rule
+are bincounts over the judgements instead of loops over objects.
+
+"""
+
+import re
+from array import array
+import numpy as np
+import agreement
+
+RULE_FIELD_RE = re.compile(r'\t\[([^\t]*)\]$')
+# the leading token-rel field; tokens may contain '-' or ','
+ROOT_FIELD_RE = re.compile(r'^.*?-[a-z]+(?::[a-z]+)?(?=,|$)')
+RULE_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z_0-9-]*$')
+# en-ud-train.conllu_12, es-train-018-s482, a_tree-hi-s4-root
+LANGUAGE_RE = re.compile(r'(?:^|-)([a-z]{2,3})-')
+NO_RULES = '-'
+# Gigaword and NYT IDs (APW_ENG_20090111.0038.com) carry no language
+DEFAULT_LANGUAGE = 'en'
+
+
+def split_fields(text):
+    """Split text at the commas that are not inside parentheses."""
+    fields, depth, start = [], 0, 0
+    for i, char in enumerate(text):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth = max(depth - 1, 0)
+        elif char == ',' and not depth:
+            fields.append(text[start:i])
+            start = i + 1
+    fields.append(text[start:])
+    return fields
+
+
+def parse_rules(pprint):
+    r"""
+    Return the sorted distinct rule names in a pprint.
+
+    >>> parse_rules('\t?a wish in ?b\t[wish-conj,f,n2,n6]\n'
+    ...             '\t\t?a: I\t[I-nsubj,borrow-subj(wish/10,owner/4,conj),'
+    ...             'g1(nsubj)]')
+    ['borrow-subj', 'f', 'g1', 'n2', 'n6']
+
+    """
+    names = set()
+    for line in pprint.split('\n'):
+        m = RULE_FIELD_RE.search(line)
+        if not m:
+            continue
+        rules = m.group(1)
+        root = ROOT_FIELD_RE.match(rules)
+        if root:
+            rules = rules[root.end() + 1:]
+        for field in split_fields(rules):
+            name = field.split('(', 1)[0].strip()
+            if RULE_NAME_RE.match(name):
+                names.add(name)
+    return sorted(names)
+
+
+def language_of(sentid):
+    """
+    Take the language from a sentence ID such as en-ud-train.conllu_12
+    or a_tree-hi-s4-root; IDs without one are English.
+
+    """
+    m = LANGUAGE_RE.search(sentid)
+    if m:
+        return m.group(1)
+    return DEFAULT_LANGUAGE
+
+
+def intern(index, value):
+    i = index.get(value)
+    if i is None:
+        i = index[value] = len(index)
+    return i
+
+
+def names_of(index):
+    return sorted(index, key=index.get)
+
+
+class RuleColumns(agreement.AnswerColumns):
+    """
+    Define answer columns that also keep the rule features of items.
+
+    The rules of item i are item_rules[rule_offsets[i]:rule_offsets[i+1]].
+    item_combinations[i] and item_languages[i] index the sorted rule
+    names of item i and its language.
+
+    """
+    def __init__(self):
+        agreement.AnswerColumns.__init__(self)
+        self.rule_index = {}
+        self.combination_index = {}
+        self.language_index = {}
+        self.rule_offsets = array('i', [0])
+        self.item_rules = array('i')
+        self.item_combinations = array('i')
+        self.item_languages = array('i')
+
+    def add_item(self, hit_id, key, question=None):
+        n_items = len(self.item_index)
+        item = agreement.AnswerColumns.add_item(self, hit_id, key, question)
+        if item == n_items:
+            pprint = (question or {}).get('pprint')
+            names = []
+            if pprint:
+                names = parse_rules(pprint.replace('\\t', '\t')
+                                          .replace('\\n', '\n'))
+            self.item_rules.extend(intern(self.rule_index, name)
+                                   for name in names)
+            self.rule_offsets.append(len(self.item_rules))
+            self.item_combinations.append(intern(
+                self.combination_index, ' '.join(names) or NO_RULES))
+            self.item_languages.append(intern(self.language_index,
+                                              language_of(key[0])))
+        return item
+
+
+def item_totals(columns):
+    """
+    Return the number of judgements and of correct judgements per item.
+    When a worker answered an item more than once, the last answer
+    counts, as in the agreement statistics.
+
+    """
+    items, _, answers = columns.last_arrays()
+    n_items = len(columns.item_hits)
+    judgements = np.bincount(items, minlength=n_items)
+    correct = np.bincount(items, answers == 1, minlength=n_items)
+    return judgements, correct
+
+
+def aggregate(groups, n_groups, judgements, correct):
+    """
+    Sum item totals per group. groups[j] is the group of the item at
+    entry j of judgements / correct. Return a structured array of the
+    items, judgements, correct judgements, accuracy (correct judgements
+    over judgements) and precision (items judged correct by a majority
+    over items) of each group.
+
+    """
+    rated = judgements > 0
+    majority = 2 * correct > judgements
+    table = np.zeros(n_groups, dtype=[('items', np.int64),
+                                      ('judgements', np.int64),
+                                      ('correct', np.int64),
+                                      ('accuracy', np.float64),
+                                      ('precision', np.float64)])
+    table['items'] = np.bincount(groups, rated, minlength=n_groups)
+    table['judgements'] = np.bincount(groups, judgements, minlength=n_groups)
+    table['correct'] = np.bincount(groups, correct, minlength=n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table['accuracy'] = table['correct'] / table['judgements'].astype(
+            np.float64)
+        table['precision'] = (np.bincount(groups, majority, minlength=n_groups)
+                              / table['items'].astype(np.float64))
+    return table
+
+
+def rule_tables(columns):
+    """
+    Aggregate worker correctness by rule, rule combination, language and
+    (language, rule). Return a dict from each of these to a pair of
+    group names and aggregate() table.
+
+    """
+    judgements, correct = item_totals(columns)
+    offsets = agreement.to_numpy(columns.rule_offsets, np.int32)
+    rules = agreement.to_numpy(columns.item_rules, np.int32)
+    languages = agreement.to_numpy(columns.item_languages, np.int32)
+    combinations = agreement.to_numpy(columns.item_combinations, np.int32)
+    # item of each (item, rule) entry
+    rule_items = np.repeat(np.arange(len(judgements)), np.diff(offsets))
+    rule_names = names_of(columns.rule_index)
+    language_names = names_of(columns.language_index)
+    n_rules, n_languages = len(rule_names), len(language_names)
+    return {
+        'rule': (rule_names,
+                 aggregate(rules, n_rules, judgements[rule_items],
+                           correct[rule_items])),
+        'combination': (names_of(columns.combination_index),
+                        aggregate(combinations, len(columns.combination_index),
+                                  judgements, correct)),
+        'language': (language_names,
+                     aggregate(languages, n_languages, judgements, correct)),
+        'language-rule': (['%s %s' %(language, rule)
+                           for language in language_names
+                           for rule in rule_names],
+                          aggregate(languages[rule_items] * n_rules + rules,
+                                    n_languages * n_rules,
+                                    judgements[rule_items],
+                                    correct[rule_items])),
+    }
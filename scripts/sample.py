@@ -5,25 +5,19 @@ import sys
 import os
 import timeit
 import random
+import argparse
+from multiprocessing import Pool
 import numpy as np
 import codecs
 from concrete.util.file_io import CommunicationReader
 from predpatt import CommUtil
+from block_index import load_block_index, read_blocks
+from utils import reservoir_sample_l, merge_reservoirs
 
 
 def reservoir_sample(l, k):
-    ret = []
-    for i, item in enumerate(l):
-        if i % 1000 == 0:
-            print '+',
-            sys.stdout.flush()
-        if i < k:
-            ret.append(item)
-        else:
-            j = random.randint(1, i + 1)
-            if j <= k:
-                ret[j - 1] = item
-    print '\n#######%d' %(i + 1)
+    ret, n = reservoir_sample_l(l, k)
+    print '#######%d' %(n)
     return ret
 
 
@@ -88,6 +82,44 @@ def multi_sample(k, fl, path, out, mod):
         sys.stdout.flush()
 
 
+def sample_file(task):
+    """Reservoir-sample one file of multi_sample_parallel in a worker."""
+    k, filepath, seed = task
+    start_time = timeit.default_timer()
+    ret = reservoir_sample_l(gen_ud(filepath), k, random.Random(seed))
+    end_time = timeit.default_timer()
+    print "%s => %d sentences, time elasped: %.2fm" %(
+        os.path.basename(filepath), ret[1], (end_time - start_time) / 60.)
+    sys.stdout.flush()
+    return ret
+
+
+def multi_sample_parallel(k, fl, path, output, workers=4, seed=0):
+    """
+    Draw one sample of k sentences over all files in the list fl.
+    Files are sampled concurrently and their reservoirs merged in list
+    order. Every file gets its own seed derived from *seed*, so the
+    sample doesn't depend on how work is scheduled.
+
+    """
+    filenames = [l.strip() for l in open(fl) if l.strip()]
+    rng = random.Random(seed)
+    tasks = [(k, os.path.join(path, filename), rng.getrandbits(32))
+             for filename in filenames]
+    pool = Pool(workers)
+    try:
+        merged = ([], 0)
+        for reservoir in pool.imap(sample_file, tasks):
+            merged = merge_reservoirs(merged, reservoir, k, rng)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    print "Sampled %d of %d sentences from %d files." %(
+        len(merged[0]), merged[1], len(filenames))
+    dump(merged[0], output)
+
+
 def sub_sample(n, count_file, files_dir):
     """
     Draw samples from a multinomial distribution based on the
@@ -106,21 +138,50 @@ def sub_sample(n, count_file, files_dir):
     # draw count of each sample
     ret = np.random.multinomial(n, pvals, size=1)
 
-    # sample n_sample sentences from each file
+    # sample n_sample sentences from each file, seeking straight to them
+    # through the block index instead of reading the whole file
     results = []
     for filename, n_sample in zip(filenames, ret[0]):
         if n_sample == 0:
             continue
         filepath = os.path.join(files_dir, filename.split('.')[0])
-        with open(filepath) as f:
-            sentences = f.read().decode('utf-8').split('\n\n')
-            results += random.sample(sentences, n_sample)
+        index = load_block_index(filepath)
+        ids = random.sample(xrange(len(index)), n_sample)
+        results += [block.decode('utf-8')
+                    for block in read_blocks(filepath, index, ids)]
     print '\n\n'.join(results)
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Sample sentences, either sub_sample: n count_file '
+        'files_dir, or with --workers multi_sample_parallel: k filelist '
+        'path output.')
+    parser.add_argument('args', nargs='+',
+                        help='arguments of sub_sample, or of '
+                             'multi_sample_parallel with --workers.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='sample the files of filelist into one sample '
+                             'with this many processes.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed of --workers.')
+    args = parser.parse_args(argv)
+    expected = 4 if args.workers > 0 else 3
+    if len(args.args) != expected:
+        parser.error('expected %d arguments, got %d' %(expected,
+                                                       len(args.args)))
+    return args
+
+
 if __name__ == '__main__':
-    sys.stdout = codecs.getwriter('utf8')(sys.stdout)
-    sub_sample(*sys.argv[1:])
+    args = parse_args()
+    if args.workers > 0:
+        k, filelist, path, output = args.args
+        multi_sample_parallel(int(k), filelist, path, output, args.workers,
+                              args.seed)
+    else:
+        sys.stdout = codecs.getwriter('utf8')(sys.stdout)
+        sub_sample(*args.args)
 
     # k, filepath, output = sys.argv[1:]
     # sample(int(k), filepath, output)
@@ -130,3 +191,4 @@ if __name__ == '__main__':
     # multi_sample(int(k), filelist, path, out, int(mod))
     # end_time = timeit.default_timer()
     # print "\nTotal Time elasped: %.2fm"%((end_time-start_time)/60.)
+
@@ -5,12 +5,27 @@
 import random
 import sys
 import os
+from utils import gen_conllu_blocks, reservoir_sample_l
 
 
-def sample(filepath, n=100):
-    blocks = ['# %s_%07d\n%s' %(os.path.basename(filepath), i, b) for i, b in
-              enumerate(open(filepath).read().split('\n\n'), 1)]
-    print '\n\n'.join(random.sample(blocks, n))
+def sample_blocks(filepath, n=100, seed=None):
+    """
+    Draw n blocks of filepath uniformly, streaming the file once. Each
+    block is prefixed with a comment naming the file and the block
+    number, and blocks are returned in file order. Return the blocks and
+    the number of blocks in the file.
+
+    """
+    blocks = enumerate(gen_conllu_blocks(filepath), 1)
+    sampled, n_blocks = reservoir_sample_l(blocks, n, random.Random(seed))
+    name = os.path.basename(filepath)
+    return [u'# %s_%07d\n%s' %(name, i, u'\n'.join(block))
+            for i, block in sorted(sampled)], n_blocks
+
+
+def sample(filepath, n=100, seed=None):
+    blocks, _ = sample_blocks(filepath, n, seed)
+    print u'\n\n'.join(blocks).encode('utf-8')
 
 
 if __name__ == '__main__':
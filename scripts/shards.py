@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Writers of HIT rows.
+
+CsvWriter writes every row into a single csv file. ShardedCsvWriter
+splits the rows into shards of at most shard_rows rows each,
+
+    hits.csv -> hits.00000.csv, hits.00001.csv, ...
+
+optionally gzip-compressed, or into the output itself (hits.csv, or
+hits.csv.gz when compressed) when shard_rows is 0, and keeps a
+checkpoint beside the output (hits.csv.checkpoint.json) so an
+interrupted run can resume after the last checkpointed sentence: the
+checkpoint counts the sentences written, and the label of the last one
+is checked when skipping them. A shard is written as <shard>.part and
+renamed once it is full. The checkpoint records the shard being
+written, its size in bytes at that point, and the questions of the
+partial row, so resuming truncates the shard to where the checkpoint
+was taken. Compressed shards are closed and reopened as a new gzip
+member at each checkpoint, so the truncated file is still valid.
+
+"""
+
+import os
+import csv
+import json
+import gzip
+
+HEADER = ['json_variables']
+
+
+class CsvWriter:
+    """
+    Define the writer of a single csv file of HIT rows.
+
+    """
+    done = False
+
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.writer = csv.writer(self.f, delimiter=',', quoting=csv.QUOTE_ALL)
+        self.writer.writerow(HEADER)
+        self.sentences = 0
+        self.slabel = None
+        # questions of the row being filled
+        self.pending = []
+
+    def writerow(self, line):
+        self.writer.writerow([line])
+
+    def end_sentence(self, slabel):
+        pass
+
+    def close(self):
+        self.f.close()
+
+
+def checkpoint_path(path):
+    return path + '.checkpoint.json'
+
+
+def shard_path(path, shard, compress, sharded=True):
+    if not sharded:
+        return path + ('.gz' if compress and not path.endswith('.gz') else '')
+    root, ext = os.path.splitext(path)
+    return '%s.%05d%s%s' %(root, shard, ext or '.csv',
+                           '.gz' if compress else '')
+
+
+class ShardedCsvWriter:
+    """
+    Define the checkpointing writer of sharded csv files of HIT rows.
+
+    settings are stored in the checkpoint and must match when resuming.
+    A checkpoint is taken every checkpoint_every sentences and when the
+    writer is closed.
+
+    """
+    def __init__(self, path, shard_rows, compress=False, checkpoint_every=1000,
+                 settings=None):
+        self.path = path
+        self.shard_rows = shard_rows
+        self.compress = compress
+        self.checkpoint_every = checkpoint_every
+        self.settings = dict(settings or {}, shard_rows=shard_rows,
+                             compress=compress)
+        self.shard = 0
+        self.rows = 0
+        self.sentences = 0
+        self.slabel = None
+        self.pending = []
+        self.done = False
+        self.last_checkpoint = 0
+        self.out = self.raw = self.writer = None
+
+    @classmethod
+    def open(cls, path, shard_rows, compress=False, checkpoint_every=1000,
+             settings=None, resume=False):
+        """
+        Open a writer, resuming from the checkpoint of path when asked to
+        and one exists. A resumed writer that is done has nothing left to
+        write.
+
+        """
+        writer = cls(path, shard_rows, compress, checkpoint_every, settings)
+        offset = 0
+        if resume and os.path.isfile(checkpoint_path(path)):
+            with open(checkpoint_path(path)) as f:
+                state = json.load(f)
+            old = state['settings']
+            if old != writer.settings:
+                changed = sorted(key for key in set(old) | set(writer.settings)
+                                 if old.get(key) != writer.settings.get(key))
+                raise ValueError('%s was written with different settings: %s'
+                                 %(path, ', '.join('%s=%r' %(key, old.get(key))
+                                                   for key in changed)))
+            writer.shard = state['shard']
+            writer.rows = state['rows']
+            writer.sentences = state['sentences']
+            writer.slabel = state['slabel']
+            writer.pending = state['pending']
+            writer.done = state['done']
+            writer.last_checkpoint = writer.sentences
+            offset = state['offset']
+        elif os.path.isfile(checkpoint_path(path)):
+            os.remove(checkpoint_path(path))
+        if not writer.done:
+            writer._discard_after()
+            writer._open_shard(offset)
+        return writer
+
+    def _shard_path(self, shard):
+        return shard_path(self.path, shard, self.compress,
+                          bool(self.shard_rows))
+
+    def _part_path(self, shard):
+        return self._shard_path(shard) + '.part'
+
+    def _discard_after(self):
+        """Drop the shards written after the checkpoint."""
+        part = self._part_path(self.shard)
+        current = self._shard_path(self.shard)
+        if os.path.isfile(current) and not os.path.isfile(part):
+            # the shard was finished after the checkpoint
+            os.rename(current, part)
+        if not self.shard_rows:
+            return
+        shard = self.shard + 1
+        while True:
+            paths = [path for path in (self._shard_path(shard),
+                                       self._part_path(shard))
+                     if os.path.isfile(path)]
+            if not paths:
+                break
+            for path in paths:
+                os.remove(path)
+            shard += 1
+
+    def _open_shard(self, offset):
+        self.raw = open(self._part_path(self.shard), 'r+b' if offset else 'wb')
+        self.raw.truncate(offset)
+        self.raw.seek(offset)
+        self._open_member()
+        if offset == 0:
+            self.writer.writerow(HEADER)
+
+    def _open_member(self):
+        if self.compress:
+            self.out = gzip.GzipFile(filename='', mode='wb', fileobj=self.raw,
+                                     mtime=0)
+        else:
+            self.out = self.raw
+        self.writer = csv.writer(self.out, delimiter=',',
+                                 quoting=csv.QUOTE_ALL)
+
+    def _close_shard(self):
+        if self.compress:
+            self.out.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+
+    def writerow(self, line):
+        self.writer.writerow([line])
+        self.rows += 1
+        if self.shard_rows and self.rows == self.shard_rows:
+            self._close_shard()
+            os.rename(self._part_path(self.shard),
+                      self._shard_path(self.shard))
+            self.shard += 1
+            self.rows = 0
+            self._open_shard(0)
+
+    def end_sentence(self, slabel):
+        self.sentences += 1
+        self.slabel = slabel
+        if self.sentences - self.last_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Make the shard durable and record where to resume."""
+        if self.compress:
+            self.out.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        offset = self.raw.tell()
+        if self.compress:
+            self._open_member()
+        self._save_state(offset)
+        self.last_checkpoint = self.sentences
+
+    def _save_state(self, offset):
+        state = {'shard': self.shard, 'rows': self.rows, 'offset': offset,
+                 'sentences': self.sentences, 'slabel': self.slabel,
+                 'pending': self.pending, 'done': self.done,
+                 'settings': self.settings}
+        path = checkpoint_path(self.path)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    def close(self):
+        """Finish the last shard and mark the run as done."""
+        if self.done:
+            return
+        self.done = True
+        self._close_shard()
+        if self.rows or self.shard == 0:
+            os.rename(self._part_path(self.shard),
+                      self._shard_path(self.shard))
+        else:
+            os.remove(self._part_path(self.shard))
+        self._save_state(None)
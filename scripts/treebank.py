@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Compiled treebanks: CoNLL-U files pre-parsed into arrays, so that
+reloading them doesn't tokenize text or split columns again.
+
+    python scripts/treebank.py samples/sample.conllu samples/sample.tb
+    python scripts/gen_hits.py samples/sample.tb hits.csv
+
+A compiled treebank is a directory of
+
+    meta.json           format version and counts
+    offsets.npy         first token of every sentence, plus the end
+    forms.npy           string index of the form of every token
+    tags.npy            string index of the tag of every token
+    govs.npy            governor of every token, 0-based (-1 is the root)
+    rels.npy            string index of the relation of every token
+    sent_ids.npy        string index of the ID of every sentence
+    strings.bin         utf-8 interned strings, back to back
+    string_offsets.npy  start of every string in strings.bin, plus the end
+
+Multi-word token lines are left out, as load_conllu does. Every file is
+memory-mapped when loaded and the UDParse of a sentence is only built
+when it is asked for.
+
+"""
+
+import os
+import json
+import mmap
+import shutil
+import argparse
+from array import array
+import numpy as np
+from predpatt.UDParse import DepTriple, UDParse
+from utils import gen_conllu_blocks, conllu_sent_id
+
+FORMAT_VERSION = 1
+META = 'meta.json'
+
+
+def is_treebank(path):
+    """Tell whether path is a compiled treebank."""
+    return os.path.isfile(os.path.join(path, META))
+
+
+def compile_treebank(filename, path):
+    """
+    Compile the CoNLL-U file filename into a treebank at path. Return the
+    numbers of sentences and tokens.
+
+    """
+    index = {}
+    strings = []
+
+    def intern(s):
+        i = index.get(s)
+        if i is None:
+            i = index[s] = len(strings)
+            strings.append(s)
+        return i
+
+    offsets = array('l', [0])
+    forms, tags, govs, rels = array('i'), array('i'), array('i'), array('i')
+    sent_ids = array('i')
+    for sent_num, block in enumerate(gen_conllu_blocks(filename), 1):
+        for line in block:
+            if line.startswith('#'):
+                continue
+            line = line.split('\t')
+            if '-' in line[0]:
+                continue
+            assert len(line) == 10, line
+            forms.append(intern(line[1]))
+            tags.append(intern(line[3]))
+            govs.append(int(line[6]) - 1)
+            rels.append(intern(line[7]))
+        offsets.append(len(forms))
+        sent_ids.append(intern(conllu_sent_id(block, sent_num)))
+
+    # written next to path and moved in place once complete
+    tmp = path.rstrip('/') + '.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    encoded = [s.encode('utf-8') for s in strings]
+    string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=string_offsets[1:])
+    with open(os.path.join(tmp, 'strings.bin'), 'wb') as f:
+        f.write(''.join(encoded))
+    for name, values, dtype in (('offsets', offsets, np.int64),
+                                ('forms', forms, np.int32),
+                                ('tags', tags, np.int32),
+                                ('govs', govs, np.int32),
+                                ('rels', rels, np.int32),
+                                ('sent_ids', sent_ids, np.int32),
+                                ('string_offsets', string_offsets, np.int64)):
+        np.save(os.path.join(tmp, name + '.npy'),
+                np.asarray(values, dtype=dtype))
+    meta = {'version': FORMAT_VERSION, 'source': os.path.abspath(filename),
+            'sentences': len(sent_ids), 'tokens': len(forms),
+            'strings': len(strings)}
+    with open(os.path.join(tmp, META), 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+    return meta['sentences'], meta['tokens']
+
+
+class Treebank:
+    """
+    Define a memory-mapped compiled treebank.
+
+    Sentences are numbered from 0 in file order. Strings are decoded the
+    first time they are used and kept for later sentences.
+
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, META)) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != FORMAT_VERSION:
+            raise ValueError('%s has format version %s, expected %d.' %(
+                path, self.meta['version'], FORMAT_VERSION))
+        self.path = path
+        for name in ('offsets', 'forms', 'tags', 'govs', 'rels', 'sent_ids',
+                     'string_offsets'):
+            # plain ndarray views of the maps slice faster than np.memmap
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'),
+                                        mmap_mode='r').view(np.ndarray))
+        with open(os.path.join(path, 'strings.bin'), 'rb') as f:
+            # mmap can't map an empty file
+            if os.fstat(f.fileno()).st_size:
+                self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.blob = ''
+        self._strings = [None] * self.meta['strings']
+
+    def __len__(self):
+        return len(self.sent_ids)
+
+    def strings(self, ids):
+        """Return the strings of a list of string indices."""
+        strings = self._strings
+        for i in ids:
+            if strings[i] is None:
+                strings[i] = self.blob[
+                    int(self.string_offsets[i]):
+                    int(self.string_offsets[i + 1])].decode('utf-8')
+        return [strings[i] for i in ids]
+
+    def sent_id(self, sent):
+        return self.strings([int(self.sent_ids[sent])])[0]
+
+    def tokens(self, sent):
+        start, end = self.offsets[sent:sent + 2]
+        return self.strings(self.forms[start:end].tolist())
+
+    def sentence_lines(self, sent):
+        """
+        Return a line of the form, tag, governor and relation of every
+        token, as conllu_block_lines does, e.g. to key the extraction
+        cache.
+
+        """
+        start, end = self.offsets[sent:sent + 2]
+        return [u'\t'.join((form, tag, unicode(gov), rel))
+                for form, tag, gov, rel
+                in zip(self.strings(self.forms[start:end].tolist()),
+                       self.strings(self.tags[start:end].tolist()),
+                       self.govs[start:end].tolist(),
+                       self.strings(self.rels[start:end].tolist()))]
+
+    def parse(self, sent):
+        """Build the UDParse of sentence sent, as load_conllu would."""
+        start, end = self.offsets[sent:sent + 2]
+        rels = self.strings(self.rels[start:end].tolist())
+        triples = [DepTriple(rel, gov, dep) for dep, (rel, gov)
+                   in enumerate(zip(rels, self.govs[start:end].tolist()))]
+        return UDParse(self.strings(self.forms[start:end].tolist()),
+                       tuple(self.strings(self.tags[start:end].tolist())),
+                       triples)
+
+    def gen_sentences(self):
+        """Yield the (sent_id, sentence number) pair of every sentence."""
+        for sent in xrange(len(self)):
+            yield self.sent_id(sent), sent
+
+    def __iter__(self):
+        """Yield (sent_id, UDParse) pairs like load_conllu."""
+        for sent_id, sent in self.gen_sentences():
+            yield sent_id, self.parse(sent)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compile a CoNLL-U file into a binary treebank.')
+    parser.add_argument('filename', help='path to the CoNLL-U file.')
+    parser.add_argument('output', nargs='?', default=None,
+                        help='path of the compiled treebank, '
+                             '<filename without .conllu>.tb by default.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    output = args.output or os.path.splitext(args.filename)[0] + '.tb'
+    n_sentences, n_tokens = compile_treebank(args.filename, output)
+    print '%s: %d sentences, %d tokens' %(output, n_sentences, n_tokens)
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 # encoding: utf-8
-import codecs
+import io
+import re
+import math
+import random
+import itertools
 from predpatt.UDParse import DepTriple, UDParse
 
 html_escape_table = {
@@ -21,9 +25,134 @@ REPLACEMENTS = {'-LRB-': '(',
                 '-RCB-': '}'}
 
 
+# Only the single-character entries of html_escape_table can ever match.
+html_escape_re = re.compile('|'.join(re.escape(c) for c in html_escape_table
+                                     if len(c) == 1))
+# unicode.split() also splits on U+00A0, U+3000, ...
+space_re = re.compile(r'\s', re.UNICODE)
+
+
+def _escape_match(m):
+    return html_escape_table[m.group()]
+
+
 def html_escape(text):
     """Produce entities within text."""
-    return "".join(html_escape_table.get(c, c) for c in text)
+    return html_escape_re.sub(_escape_match, text)
+
+
+class HTMLEscaper(dict):
+    """
+    Memo of html_escape, so that each distinct token or phrase of a
+    sentence is escaped once. Look texts up with escaper[text].
+
+    """
+    def __missing__(self, text):
+        ret = self[text] = html_escape(text)
+        return ret
+
+
+def gen_chunks(iterable, size):
+    """Group the items of iterable into lists of at most size items."""
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def gen_ranges(numbers):
+    """
+    Group increasing integers into (start, stop) ranges of consecutive
+    ones.
+
+    >>> list(gen_ranges([1, 2, 3, 7, 9, 10]))
+    [(1, 4), (7, 8), (9, 11)]
+
+    """
+    start = stop = None
+    for n in numbers:
+        if n != stop:
+            if start is not None:
+                yield start, stop
+            start = n
+        stop = n + 1
+    if start is not None:
+        yield start, stop
+
+
+def skip_first(iterable, n, label, key):
+    """
+    Return an iterator over the items of iterable after the first n,
+    checking that the key of the n-th one is label.
+
+    """
+    it = iter(iterable)
+    skipped, last = 0, None
+    for last in itertools.islice(it, n):
+        skipped += 1
+    if skipped < n:
+        raise ValueError('the input has %d items, not %d.' %(skipped, n))
+    if n and key(last) != label:
+        raise ValueError('item %d of the input is %s, not %s.' %(
+            n, key(last), label))
+    return it
+
+
+def _uniform(rng):
+    """Draw from the open interval (0, 1)."""
+    u = rng.random()
+    while u == 0.0:
+        u = rng.random()
+    return u
+
+
+def reservoir_sample_l(l, k, rng=random):
+    """
+    Reservoir sampling with Algorithm L (Li, 1994). Instead of drawing a
+    random number for every item, draw how many items to skip before the
+    next replacement, so the number of random draws is O(k log(n/k)).
+    Return the reservoir and the number of items seen.
+
+    """
+    it = iter(l)
+    ret = list(itertools.islice(it, k))
+    n = len(ret)
+    if n < k or k == 0:
+        return ret, n + sum(1 for _ in it)
+    # w is kept as its log: log(1 - w) = log(-expm1(log_w)) stays finite
+    # and precise when w itself would round to 1
+    log_w = math.log(_uniform(rng)) / k
+    end = object()
+    while True:
+        skip = int(math.floor(math.log(_uniform(rng)) /
+                              math.log(-math.expm1(log_w))))
+        n += sum(1 for _ in itertools.islice(it, skip))
+        item = next(it, end)
+        if item is end:
+            return ret, n
+        n += 1
+        ret[rng.randrange(k)] = item
+        log_w += math.log(_uniform(rng)) / k
+
+
+def merge_reservoirs(a, b, k, rng=random):
+    """
+    Merge two (reservoir, n_seen) samples of disjoint streams into a
+    uniform sample of size k of the combined stream. The share of each
+    side follows the hypergeometric distribution of drawing k items
+    without replacement from the n_a + n_b items seen.
+
+    """
+    (ra, na), (rb, nb) = a, b
+    size = min(k, na + nb)
+    from_a = 0
+    for i in xrange(size):
+        if rng.random() * (na + nb - i) < na - from_a:
+            from_a += 1
+    ret = rng.sample(ra, from_a) + rng.sample(rb, size - from_a)
+    return ret, na + nb
 
 
 def ptb2text(x):
@@ -36,33 +165,102 @@ def ptb2text(x):
     return ' '.join(REPLACEMENTS.get(y, y) for y in x.split())
 
 
-def load_conllu(filename):
-    sent_num = 1
-    with codecs.open(filename, encoding='utf-8') as f:
-        for block in f.read().split('\n\n'):
-            block = block.strip()
-            if not block:
-                continue
-            lines = []
-            sent_id = 'sent_%s' % sent_num
-            has_sent_id = 0
-            for line in block.split('\n'):
-                if line.startswith('#'):
-                    if line.startswith('# sent_id'):
-                        sent_id = line[10:].strip()
-                        has_sent_id = 1
-                    else:
-                        if not has_sent_id:   # don't take subsequent comments as sent_id
-                            sent_id = line[1:].strip()
-                    continue
-                line = line.split('\t') # data appears to use '\t'
-                if '-' in line[0]:      # skip multi-tokens, e.g., on Spanish UD bank
-                    continue
-                assert len(line) == 10, line
-                lines.append(line)
-            [_, tokens, _, tags, _, _, gov, gov_rel, _, _] = zip(*lines)
-            triples = [DepTriple(rel, int(gov)-1, dep) for dep, (rel, gov) in enumerate(zip(gov_rel, gov))]
-            parse = UDParse(list(tokens), tags, triples)
-            yield sent_id, parse
-            sent_num += 1
+def ptb2tokens(tokens):
+    """Token-wise ptb2text(' '.join(tokens)).split(' ').
+
+    Tokens are mapped one by one instead of rejoining and splitting the
+    sentence. Empty tokens or tokens containing whitespace, which the
+    rejoin would split or drop, take the original path.
+
+    >>> ptb2tokens(['three', '-LRB-', '3', '-RRB-', '.'])
+    ['three', '(', '3', ')', '.']
+    >>> ptb2tokens([u'10\\u00a0000', u'-RRB-'])
+    [u'10', u'000', u')']
+
+    """
+    if '' in tokens or space_re.search('\x00'.join(tokens)):
+        return ptb2text(' '.join(tokens)).split(' ')
+    return [REPLACEMENTS.get(y, y) for y in tokens]
+
+
+def gen_conllu_blocks(filename):
+    """Stream a CoNLL-U file one sentence block at a time.
+
+    Lines are read lazily, so memory is bounded by the longest sentence
+    rather than by the size of the file. Each block is a list of its
+    non-empty lines.
+    """
+    block = []
+    with io.open(filename, encoding='utf-8', newline='\n') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line.strip():
+                block.append(line)
+            elif block:
+                yield block
+                block = []
+    if block:
+        yield block
+
+
+def conllu_sent_id(block, sent_num):
+    """Take the sentence id of a block from its comments."""
+    sent_id = 'sent_%s' % sent_num
+    has_sent_id = 0
+    for line in block:
+        if not line.startswith('#'):
+            continue
+        if line.startswith('# sent_id'):
+            sent_id = line[10:].strip()
+            has_sent_id = 1
+        else:
+            if not has_sent_id:   # don't take subsequent comments as sent_id
+                sent_id = line[1:].strip()
+    return sent_id
+
+
+def conllu_block_tokens(block):
+    """Take the word forms of a block the way parse_conllu_block does."""
+    return [line.split('\t', 2)[1] for line in block
+            if not line.startswith('#') and '-' not in line.split('\t', 1)[0]]
+
+
+def conllu_block_lines(block):
+    """
+    Return a line of the form, tag, governor and relation of every token
+    of a block, as Treebank.sentence_lines does, e.g. to key the
+    extraction cache. Comments and multi-word tokens are left out.
+
+    """
+    ret = []
+    for line in block:
+        if line.startswith('#'):
+            continue
+        line = line.split('\t')
+        if '-' in line[0]:
+            continue
+        ret.append(u'\t'.join((line[1], line[3], unicode(int(line[6]) - 1),
+                               line[7])))
+    return ret
+
 
+def parse_conllu_block(block, sent_num):
+    """Build a (sent_id, UDParse) pair from the lines of one block."""
+    lines = []
+    for line in block:
+        if line.startswith('#'):
+            continue
+        line = line.split('\t') # data appears to use '\t'
+        if '-' in line[0]:      # skip multi-tokens, e.g., on Spanish UD bank
+            continue
+        assert len(line) == 10, line
+        lines.append(line)
+    [_, tokens, _, tags, _, _, gov, gov_rel, _, _] = zip(*lines)
+    triples = [DepTriple(rel, int(gov)-1, dep) for dep, (rel, gov) in enumerate(zip(gov_rel, gov))]
+    parse = UDParse(list(tokens), tags, triples)
+    return conllu_sent_id(block, sent_num), parse
+
+
+def load_conllu(filename):
+    for sent_num, block in enumerate(gen_conllu_blocks(filename), 1):
+        yield parse_conllu_block(block, sent_num)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Worker quality by Dawid-Skene expectation maximization.
+
+Every worker has a confusion matrix, confusion[w, k, l] being the
+probability that worker w answers l on an item whose true answer is k,
+and the true answers have class priors. EM alternates between the
+posterior of the true answer of every item (E step) and the priors and
+confusion matrices that maximize the expected likelihood (M step),
+starting from the majority vote.
+
+Both steps run on the sparse (item, worker, answer) judgement columns:
+the E step sums the log confusion of each judgement into its item and
+the M step sums the item posteriors of each judgement into its
+(worker, answer) cell, each a bincount per class. A worker's
+reliability is the chance they answer correctly, averaged over the
+class priors.
+
+"""
+
+import csv
+import numpy as np
+import agreement
+
+# least class prior, so that a class no item leans to keeps a finite log
+PRIOR_FLOOR = 1e-6
+
+
+class WorkerQuality:
+    """
+    Define the Dawid-Skene estimates of a result batch.
+
+    posteriors[i, k] is the probability that the true answer of item i
+    is k; items without judgements keep the priors. worker_ids and
+    item_keys name the rows of confusion and posteriors.
+
+    """
+    def __init__(self, priors, confusion, posteriors, judgements,
+                 log_likelihood, iterations, worker_ids, item_keys):
+        self.priors = priors
+        self.confusion = confusion
+        self.posteriors = posteriors
+        self.judgements = judgements
+        self.log_likelihood = log_likelihood
+        self.iterations = iterations
+        self.worker_ids = worker_ids
+        self.item_keys = item_keys
+
+    def reliabilities(self):
+        """Return the chance of a correct answer of every worker."""
+        return np.einsum('k,wkk->w', self.priors, self.confusion)
+
+    def labels(self):
+        """Return the most likely true answer of every item."""
+        return self.posteriors.argmax(axis=1)
+
+    def write_workers(self, path):
+        n_classes = len(self.priors)
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['worker_id', 'judgements', 'reliability'] +
+                            ['p_%d_given_%d' %(l, k)
+                             for k in xrange(n_classes)
+                             for l in xrange(n_classes)])
+            for w, reliability in enumerate(self.reliabilities()):
+                writer.writerow([self.worker_ids[w], self.judgements[w],
+                                 '%.6f' %(reliability)] +
+                                ['%.6f' %(p) for p in
+                                 self.confusion[w].ravel()])
+
+    def write_labels(self, path):
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['sentenceID', 'item', 'label'] +
+                            ['p_%d' %(k) for k in xrange(len(self.priors))])
+            for i, (sentid, item) in enumerate(self.item_keys):
+                writer.writerow([sentid.encode('utf-8'), item.encode('utf-8'),
+                                 self.posteriors[i].argmax()] +
+                                ['%.6f' %(p) for p in self.posteriors[i]])
+
+
+def logsumexp(x):
+    """Log of the sum of exp(x) over the last axis, without overflow."""
+    top = x.max(axis=-1)
+    return top + np.log(np.exp(x - top[..., None]).sum(axis=-1))
+
+
+def dawid_skene(items, workers, answers, n_items, n_workers, n_classes=2,
+                max_iter=100, tol=1e-6, smoothing=0.1):
+    """
+    Run EM over judgement columns, with at most one judgement per item
+    and worker. smoothing is a pseudo-count added to every confusion
+    cell, which keeps workers with few judgements away from 0 and 1.
+    Stop when the log-likelihood gains less than tol relative to its
+    size. Return the priors, confusion matrices, item posteriors,
+    log-likelihood and number of iterations. Without judgements, the
+    priors, confusion rows and posteriors are uniform and no iteration
+    is run.
+
+    """
+    items = np.asarray(items, dtype=np.intp)
+    workers = np.asarray(workers, dtype=np.intp)
+    answers = np.asarray(answers, dtype=np.intp)
+    rated = np.bincount(items, minlength=n_items) > 0
+    if not rated.any():
+        return (np.full(n_classes, 1. / n_classes),
+                np.full((n_workers, n_classes, n_classes), 1. / n_classes),
+                np.full((n_items, n_classes), 1. / n_classes), 0., 0)
+    cells = workers * n_classes + answers
+
+    # majority vote, with ties split evenly
+    posteriors = np.zeros((n_items, n_classes))
+    for k in xrange(n_classes):
+        posteriors[:, k] = np.bincount(items, answers == k, minlength=n_items)
+    posteriors[~rated] = 1.
+    posteriors /= posteriors.sum(axis=1)[:, None]
+
+    log_likelihood, iterations = -np.inf, 0
+    for iterations in xrange(1, max_iter + 1):
+        # M step
+        priors = np.maximum(posteriors[rated].mean(axis=0), PRIOR_FLOOR)
+        priors /= priors.sum()
+        weights = posteriors[items]
+        counts = np.empty((n_workers, n_classes, n_classes))
+        for k in xrange(n_classes):
+            counts[:, k, :] = np.bincount(
+                cells, weights[:, k],
+                minlength=n_workers * n_classes).reshape(n_workers, n_classes)
+        counts += smoothing
+        confusion = counts / counts.sum(axis=2)[:, :, None]
+
+        # E step
+        log_confusion = np.log(confusion)[workers, :, answers]
+        scores = np.tile(np.log(priors), (n_items, 1))
+        for k in xrange(n_classes):
+            scores[:, k] += np.bincount(items, log_confusion[:, k],
+                                        minlength=n_items)
+        norm = logsumexp(scores)
+        posteriors = np.exp(scores - norm[:, None])
+
+        previous, log_likelihood = log_likelihood, norm[rated].sum()
+        if log_likelihood - previous <= tol * abs(log_likelihood):
+            break
+    return priors, confusion, posteriors, log_likelihood, iterations
+
+
+def estimate(results, max_iter=100, tol=1e-6, smoothing=0.1):
+    """
+    Estimate worker quality from the Sentence objects of load_result,
+    or from answer columns. When a worker answered an item more than
+    once, the last answer counts.
+
+    """
+    if isinstance(results, agreement.AnswerColumns):
+        columns = results
+    else:
+        columns = agreement.AnswerColumns.from_results(results)
+    items, workers, answers = columns.last_arrays()
+    n_items, n_workers = len(columns.item_hits), len(columns.worker_index)
+    n_classes = max(2, int(answers.max()) + 1 if len(answers) else 2)
+    priors, confusion, posteriors, log_likelihood, iterations = dawid_skene(
+        items, workers, answers, n_items, n_workers, n_classes, max_iter,
+        tol, smoothing)
+    return WorkerQuality(priors, confusion, posteriors,
+                         np.bincount(workers, minlength=n_workers),
+                         log_likelihood, iterations,
+                         sorted(columns.worker_index,
+                                key=columns.worker_index.get),
+                         sorted(columns.item_index, key=columns.item_index.get))
+
+
+def read_reliabilities(path):
+    """Read the worker reliabilities written by write_workers."""
+    with open(path, 'rb') as f:
+        return {row['worker_id']: float(row['reliability'])
+                for row in csv.DictReader(f)}
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+HIT generation as it was before the optimizations, the reference the
+regression tests compare the current scripts against byte for byte.
+
+The code is that of the first release of gen_hits.py and utils.py, with
+the command line replaced by the arguments of write_hits.
+
+"""
+
+import csv
+import json
+import codecs
+from predpatt.patt import PredPatt, Argument, PredPattOpts
+from predpatt.UDParse import DepTriple, UDParse
+try:
+    from predpatt.util.linear import construct_pred_from_flat
+except ImportError:
+    construct_pred_from_flat = False
+
+
+html_escape_table = {
+    "&": "&amp;",
+    '"': "&quot;",
+    "'": "&apos;",
+    '`': "&apos;",
+    ">": "&gt;",
+    "<": "&lt;",
+    "-LRB-": '(',
+    "-RRB-": ')'}
+
+REPLACEMENTS = {'-LRB-': '(',
+                '-RRB-': ')',
+                '-LSB-': '[',
+                '-RSB-': ']',
+                '-LCB-': '{',
+                '-RCB-': '}'}
+
+arg_color_list = ['#fb8072', '#ffffb3', '#8dd3c7',
+                  '#80b1d3', '#fdb462', '#b3de69',
+                  '#fccde5', '#d9d9d9']
+COLORS = {'pred': '#dab3ff', 'arg': arg_color_list, 'special': '#ffffff'}
+corpula = ('<span id=\\"rcorner\\" style=\\"background-color:%s\\">'
+           'is/are</span>' %(COLORS['special']))
+opts = PredPattOpts(simple=False,
+                    cut=False,
+                    resolve_relcl=True,
+                    resolve_amod=True,
+                    resolve_poss=True,
+                    resolve_appos=True,
+                    resolve_conj=True)
+
+
+def html_escape(text):
+    """Produce entities within text."""
+    return "".join(html_escape_table.get(c, c) for c in text)
+
+
+def ptb2text(x):
+    """Convert special PTB tokens back to normal."""
+    return ' '.join(REPLACEMENTS.get(y, y) for y in x.split())
+
+
+def load_conllu(filename):
+    sent_num = 1
+    with codecs.open(filename, encoding='utf-8') as f:
+        for block in f.read().split('\n\n'):
+            block = block.strip()
+            if not block:
+                continue
+            lines = []
+            sent_id = 'sent_%s' % sent_num
+            has_sent_id = 0
+            for line in block.split('\n'):
+                if line.startswith('#'):
+                    if line.startswith('# sent_id'):
+                        sent_id = line[10:].strip()
+                        has_sent_id = 1
+                    else:
+                        if not has_sent_id:
+                            sent_id = line[1:].strip()
+                    continue
+                line = line.split('\t')
+                if '-' in line[0]:
+                    continue
+                assert len(line) == 10, line
+                lines.append(line)
+            [_, tokens, _, tags, _, _, gov, gov_rel, _, _] = zip(*lines)
+            triples = [DepTriple(rel, int(gov)-1, dep) for dep, (rel, gov)
+                       in enumerate(zip(gov_rel, gov))]
+            parse = UDParse(list(tokens), tags, triples)
+            yield sent_id, parse
+            sent_num += 1
+
+
+def extract_predpattern(filename, reference, ft="conll"):
+    if ft == "conll":
+        for y in extract_pp_from_conll(filename):
+            yield y
+    else:
+        if construct_pred_from_flat:
+            for y in extract_pp_from_linear(filename, reference):
+                yield y
+
+
+def extract_pp_from_conll(filename):
+    for slabel, parse in load_conllu(filename):
+        parse.tokens = ptb2text(' '.join(parse.tokens)).split(' ')
+        ppatt = PredPatt(parse, opts=opts)
+        sent = " ".join([t.text for t in ppatt.token])
+        if ppatt:
+            yield slabel, sent, ppatt.instances
+
+
+def extract_pp_from_linear(filename, reference):
+    sent_list = open(reference).read().strip().split("\n")
+    linear_list = open(filename).read().strip().split("\n")
+    assert len(sent_list) == len(linear_list)
+    for i in xrange(len(sent_list)):
+        sent = sent_list[i]
+        linear = linear_list[i]
+        try:
+            predicates = construct_pred_from_flat(linear.split())
+        except Exception:
+            continue
+        yield "mt/ie-%d" % (i+1), sent, predicates
+
+
+def highlight_sentence(sent_tokens, pred):
+    def highlight(tokens, style):
+        if len(tokens) == 0:
+            return None
+        last_index = -1
+        for tk in tokens:
+            index = tk.position
+            text = sent_tokens[index]
+            if last_index == -1:
+                sent_tokens[index] = ('<span id=\\"rcorner\\" style=\\"'
+                                      '%s\\">%s'
+                                      %(style, text))
+            else:
+                span = index - last_index
+                if span != 1:
+                    sent_tokens[last_index] += '</span>'
+                    sent_tokens[index] = ('<span id=\\"rcorner\\" style=\\"'
+                                          '%s\\">%s'
+                                          %(style, text))
+            last_index = index
+        sent_tokens[last_index] += '</span>'
+
+    if pred.type != 'poss':
+        style = ("width:100px;height:100px;padding:1px;border:5px solid %s;"
+                 %COLORS['pred'])
+        highlight(pred.tokens, style)
+    for arg_i, arg in enumerate(sort_by_position(pred.arguments)):
+        arg_i = arg_i % len(COLORS['arg'])
+        style = "background-color:%s" %COLORS['arg'][arg_i]
+        highlight(arg.tokens, style)
+
+    return ' '.join(sent_tokens)
+
+
+def format_poss(pred, placeholder):
+    poss = ('<span id=\\"rcorner\\" style=\\"background-color:%s\\">'
+            'has/have</span>' %(COLORS['special']))
+    if placeholder:
+        ret = ' '.join([pred.arguments[0].name, poss,
+                        pred.arguments[1].name])
+    else:
+        arg_0 = format_arg(pred, pred.arguments[0], 0)
+        arg_1 = format_arg(pred, pred.arguments[1], 1)
+        ret = ' '.join([arg_0, poss, arg_1])
+    return ret
+
+
+def preprocess_modpred(pred, placeholder):
+    arg0 = None
+    other_args = []
+    for arg in pred.arguments:
+        if arg.root == pred.root.gov:
+            arg0 = arg
+        else:
+            other_args.append(arg)
+    if arg0 is not None:
+        arg_0 = (arg0.name if placeholder
+                 else format_arg(pred, arg0, 0))
+        ret = [arg_0, corpula]
+    else:
+        arg_0 = (args[0].name if placeholder
+                 else format_arg(pred, args[0], 0))
+        ret = [arg_0, corpula]
+    return ret
+
+
+def sort_by_position(x):
+    return list(sorted(x, key=lambda y: y.position))
+
+
+def format_pred(pred, placeholder):
+    ret = []
+    args = pred.arguments
+
+    if pred.type in {'poss'}:
+        return format_poss(pred, placeholder)
+
+    arg_i = 0
+
+    if pred.type in {'amod', 'appos'}:
+        ret += preprocess_modpred(pred, placeholder)
+        arg_i = 1
+
+    last_pred_token_pos, last_pred_token_index = -1, -1
+    last_token_type = None
+    for idx, y in enumerate(sort_by_position(pred.tokens + args)):
+        if isinstance(y, Argument):
+            if placeholder:
+                arg = y.name
+            else:
+                arg = format_arg(pred, y, arg_i)
+                arg_i += 1
+            ret.append(arg)
+            last_token_type = "Argument"
+        else:
+            text = html_escape(y.text)
+            if last_pred_token_pos == -1:
+                text = ('<span id=\\"rcorner\\" style=\\"'
+                        'width:100px;height:100px;padding:1px;border:5px'
+                        ' solid %s;\\">%s' %(COLORS['pred'], text))
+                ret.append(text)
+            else:
+                if last_token_type == "Argument":
+                    ret[last_pred_token_index] += '</span>'
+                    text = ('<span id=\\"rcorner\\" style=\\"'
+                            'width:100px;height:100px;padding:1px;border:5px'
+                            ' solid %s;\\">%s' %(COLORS['pred'], text))
+                    ret.append(text)
+                else:
+                    ret.append(text)
+            last_token_type = "Predicate"
+            last_pred_token_pos = y.position
+            last_pred_token_index = len(ret) - 1
+    ret[last_pred_token_index] += '</span>'
+    return ' '.join(ret)
+
+
+def format_arg(pred, arg, arg_i):
+    something = ('<span id=\\"rcorner\\" style=\\"background-color:%s\\">'
+                 'SOMETHING</span>' %(COLORS['special']))
+    arg_phrase = html_escape(' '.join(tk.text for tk in arg.tokens))
+    arg_phrase = ('<span id=\\"rcorner\\" style=\\"background-color:%s\\">'
+                  '%s</span>' %(COLORS['arg'][arg_i], arg_phrase))
+    if ((arg.root.gov_rel in {'ccomp', 'csubj', 'xcomp'}) and
+            arg.root.gov in pred.tokens and pred.type == 'normal'):
+        s = something + ' := ' + arg_phrase
+    else:
+        s = arg_phrase
+    return s
+
+
+def create_a_hit_element(qid, slabel, sent, html_sent, pred):
+    pprint = pred.format(C=lambda x, _: x, track_rule=True)
+    for a, b in (('\t', '\\t'), ('\n', '\\n')):
+        pprint = pprint.replace(a, b)
+    e = {}
+    e['questionID'] = 'q_%d' %qid
+    e['sentenceID'] = slabel
+    e['sentence'] = html_escape(sent)
+    e['html_sentence'] = html_sent
+    e['pred_id'] = pred.identifier()
+    e['pprint'] = html_escape(pprint)
+    e['predicate'] = '<div class=\\"statement_for_predicate\\">'
+    e['predicate'] += format_pred(pred, False) + '</div>'
+    return e
+
+
+def write_hits(filename, output, reference=None):
+    """Write the HITs of filename to output, as gen_hits.py used to."""
+    ft = "conll" if reference is None else "linear"
+    f = open(output, 'wb')
+    writer = csv.writer(f, delimiter=',', quoting=csv.QUOTE_ALL)
+    writer.writerow(['json_variables'])
+    row = []
+    for slabel, sent, instances in extract_predpattern(filename, reference,
+                                                       ft):
+        tokens = [html_escape(text) for text in sent.split()]
+        for pred in instances:
+            if pred.type != 'normal':
+                continue
+            if ft == "conll":
+                html_sent = highlight_sentence(tokens[:], pred)
+            else:
+                html_sent = " ".join(tokens)
+            if html_sent is None:
+                continue
+            e = create_a_hit_element(len(row) + 1, slabel, sent, html_sent,
+                                     pred)
+            row.append(e)
+            if len(row) == 5:
+                writer.writerow([json.dumps(row, sort_keys=True)])
+                row = []
+    f.close()
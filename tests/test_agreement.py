@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Check the agreement statistics against values computed by hand, and the
+incremental statistics against a full recomputation.
+
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS), 'scripts'))
+
+import agreement
+
+# (hit, item, worker, answer). In h1 workers A, B and C answer every
+# item. In h2 A answers both items, D only i5 and E only i6, so D and E
+# share no item.
+JUDGEMENTS = [
+    ('h1', 'i1', 'A', 1), ('h1', 'i1', 'B', 1), ('h1', 'i1', 'C', 1),
+    ('h1', 'i2', 'A', 1), ('h1', 'i2', 'B', 0), ('h1', 'i2', 'C', 1),
+    ('h1', 'i3', 'A', 0), ('h1', 'i3', 'B', 0), ('h1', 'i3', 'C', 1),
+    ('h1', 'i4', 'A', 1), ('h1', 'i4', 'B', 1), ('h1', 'i4', 'C', 0),
+    ('h2', 'i5', 'A', 1), ('h2', 'i5', 'D', 1),
+    ('h2', 'i6', 'A', 0), ('h2', 'i6', 'E', 0),
+]
+# P_i = 1, 1/3, 1/3, 1/3, 1, 1 and p = (6/16, 10/16), so
+# (2/3 - 17/32) / (1 - 17/32)
+FLEISS = 13 / 45.
+# 8 agreeing pairs out of 14
+PAIRWISE = 4 / 7.
+# A-B 1/2, A-C -1/3, B-C -1/2; A-D and A-E always agree on a single
+# answer and get 1
+KAPPAS = [-1 / 2., -1 / 3., 1 / 2., 1., 1.]
+
+
+def add_judgements(stats, judgements):
+    for hit_id, key, workerid, answer in judgements:
+        stats.add(stats.add_item(hit_id, ('s', key)), workerid, answer)
+    return stats
+
+
+def random_judgements(seed, n_hits=40, n_workers=6):
+    """Judgements of HITs of varied shapes, some answered twice."""
+    rng = np.random.RandomState(seed)
+    ret = []
+    for hit in xrange(n_hits):
+        n_items = rng.randint(1, 6)
+        workers = rng.choice(n_workers * 3, rng.randint(1, n_workers),
+                             replace=False)
+        for item in xrange(n_items):
+            for worker in workers:
+                if rng.rand() < 0.8:
+                    ret.append(('h%d' %(hit), 'h%d-%d' %(hit, item),
+                                'w%d' %(worker), rng.randint(0, 3)))
+    repeated = rng.choice(len(ret), len(ret) // 10, replace=False)
+    ret += [ret[j][:3] + (rng.randint(0, 3),) for j in repeated]
+    return ret
+
+
+class TestFixedMatrix(unittest.TestCase):
+
+    def setUp(self):
+        self.matrix = agreement.AnswerMatrix.from_columns(
+            add_judgements(agreement.AnswerColumns(), JUDGEMENTS))
+
+    def test_fleiss_kappa(self):
+        self.assertAlmostEqual(
+            agreement.fleiss_kappa(self.matrix.category_counts()), FLEISS)
+
+    def test_pairwise_agreement(self):
+        self.assertAlmostEqual(
+            agreement.pairwise_agreement(self.matrix.category_counts()),
+            PAIRWISE)
+
+    def test_cohen_kappas(self):
+        np.testing.assert_allclose(sorted(self.matrix.cohen_kappas()),
+                                   KAPPAS)
+
+    def test_incremental_cohen_kappas(self):
+        stats = add_judgements(agreement.AgreementStats(), JUDGEMENTS)
+        np.testing.assert_allclose(sorted(stats.cohen_kappas()), KAPPAS)
+
+    def test_hit_statistics(self):
+        stats = agreement.unit_statistics(self.matrix, unit='hit')
+        fleiss, pairwise, cohen = agreement.metrics_of_sums(
+            stats.sum(axis=0)[None])
+        self.assertAlmostEqual(fleiss[0], FLEISS)
+        self.assertAlmostEqual(pairwise[0], PAIRWISE)
+        self.assertAlmostEqual(cohen[0], np.mean(KAPPAS))
+
+    def test_last_answer_wins(self):
+        judgements = JUDGEMENTS + [('h1', 'i2', 'B', 1), ('h1', 'i2', 'B', 0)]
+        for stats in (agreement.AnswerColumns(), agreement.AgreementStats()):
+            matrix = agreement.as_answer_matrix(add_judgements(stats,
+                                                               judgements))
+            np.testing.assert_array_equal(matrix.category_counts(),
+                                          self.matrix.category_counts())
+            np.testing.assert_allclose(sorted(matrix.cohen_kappas()), KAPPAS)
+
+
+class TestIncremental(unittest.TestCase):
+
+    def assertSameStats(self, stats, columns):
+        matrix = agreement.AnswerMatrix.from_columns(columns)
+        counts = stats.category_counts()
+        np.testing.assert_array_equal(
+            counts[:, :matrix.n_categories], matrix.category_counts())
+        self.assertAlmostEqual(agreement.fleiss_kappa(counts),
+                               agreement.fleiss_kappa(
+                                   matrix.category_counts()))
+        self.assertAlmostEqual(agreement.pairwise_agreement(counts),
+                               agreement.pairwise_agreement(
+                                   matrix.category_counts()))
+        np.testing.assert_allclose(sorted(stats.cohen_kappas()),
+                                   sorted(matrix.cohen_kappas()))
+
+    def test_batches(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'stats.pkl')
+            for seed in xrange(5):
+                judgements = random_judgements(seed)
+                columns = add_judgements(agreement.AnswerColumns(),
+                                         judgements)
+                # batches that arrive over time, saved in between
+                for start in xrange(0, len(judgements), 50):
+                    stats = add_judgements(agreement.AgreementStats.load(path),
+                                           judgements[start:start + 50])
+                    stats.save(path)
+                self.assertSameStats(agreement.AgreementStats.load(path),
+                                     columns)
+                os.remove(path)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Check that the two result loaders of analyze.py agree.
+
+"""
+
+import os
+import sys
+import unittest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TESTS)
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+import agreement
+from analyze import (load_result, load_result_columns, predicate_key,
+                     PayloadTable)
+
+PILOT = os.path.join(ROOT, 'data', 'results', 'pilot.csv')
+
+
+class TestLoaders(unittest.TestCase):
+
+    def test_same_items(self):
+        from_results = agreement.AnswerColumns.from_results(
+            load_result(PILOT))
+        columns = load_result_columns(PILOT)
+        self.assertEqual(sorted(columns.item_index),
+                         sorted(from_results.item_index))
+        self.assertEqual(
+            agreement.fleiss_kappa(agreement.AnswerMatrix.from_columns(
+                columns).category_counts()),
+            agreement.fleiss_kappa(agreement.AnswerMatrix.from_columns(
+                from_results).category_counts()))
+
+    def test_predicates(self):
+        # questions decoded lazily through the payload table
+        for sent in load_result(PILOT).itervalues():
+            for key, pred in sent.predicates.iteritems():
+                self.assertEqual(predicate_key(pred.question), key)
+                self.assertEqual(pred.question['sentenceID'], sent.sentid)
+
+
+class TestPayloadTable(unittest.TestCase):
+
+    def test_lru(self):
+        table = PayloadTable(cache_size=2)
+        hits = [table.add('[{"q": %d}, {"q": %d}]' %(i, -i))
+                for i in xrange(3)]
+        for hit in hits + hits[::-1]:
+            self.assertEqual(table.question(hit, 1), {'q': -hit})
+        # the two most recently used payloads are kept
+        self.assertEqual(list(table._decoded), [1, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Check the commits, the recency bookkeeping and the keys of the extraction
+cache.
+
+"""
+
+import os
+import sys
+import glob
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TESTS)
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+from gen_hits import opts
+from cache import ExtractionCache, cache_key
+from treebank import Treebank, compile_treebank
+from utils import gen_conllu_blocks, conllu_block_lines
+
+SAMPLES = sorted(glob.glob(os.path.join(ROOT, 'samples', '*.conllu')))
+
+
+class TestExtractionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def stored(self):
+        """The keys another process sees in the cache file."""
+        conn = sqlite3.connect(self.path)
+        try:
+            return sorted(key for key, in conn.execute(
+                'SELECT key FROM extractions'))
+        finally:
+            conn.close()
+
+    def test_commit_every(self):
+        cache = ExtractionCache(self.path, commit_every=3,
+                                commit_seconds=3600)
+        cache.put('a', {})
+        cache.put('b', {})
+        self.assertEqual(self.stored(), [])
+        cache.put('c', {})
+        self.assertEqual(self.stored(), ['a', 'b', 'c'])
+        cache.put('d', {})
+        cache.close()
+        self.assertEqual(self.stored(), ['a', 'b', 'c', 'd'])
+
+    def test_commit_seconds(self):
+        cache = ExtractionCache(self.path, commit_every=1000,
+                                commit_seconds=0)
+        cache.put('a', {})
+        self.assertEqual(self.stored(), ['a'])
+        cache.close()
+
+    def test_recency(self):
+        cache = ExtractionCache(self.path, commit_every=1000,
+                                commit_seconds=3600)
+        for key in 'abc':
+            cache.put(key, {'key': key})
+        cache.close()
+        # reading a makes b the least recently used entry
+        cache = ExtractionCache(self.path, commit_every=1000,
+                                commit_seconds=3600)
+        self.assertEqual(cache.get('a'), {'key': 'a'})
+        cache.close()
+        cache = ExtractionCache(self.path, commit_every=1000,
+                                commit_seconds=3600)
+        cache.max_bytes = cache.size - 1
+        cache.put('c', {'key': 'c'})
+        cache.close()
+        self.assertEqual(self.stored(), ['a', 'c'])
+
+
+class TestCacheKey(unittest.TestCase):
+
+    def test_same_key_for_conllu_and_treebank(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for filename in SAMPLES:
+                path = os.path.join(tmpdir, os.path.basename(filename))
+                compile_treebank(filename, path)
+                treebank = Treebank(path)
+                keys = [cache_key(treebank.sentence_lines(sent), opts)
+                        for _, sent in treebank.gen_sentences()]
+                self.assertEqual(
+                    [cache_key(conllu_block_lines(block), opts)
+                     for block in gen_conllu_blocks(filename)], keys)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_comments_are_not_keyed(self):
+        block = [u'# sent_id = 1', u'1\tHi\thi\tINTJ\tUH\t_\t0\troot\t_\t_']
+        self.assertEqual(
+            cache_key(conllu_block_lines(block), opts),
+            cache_key(conllu_block_lines([u'# sent_id = 2'] + block[1:]),
+                      opts))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Check that the HITs and the escaping of the current scripts are byte for
+byte those of the original gen_hits.py on every sample treebank.
+
+    python -m unittest discover -s tests
+
+"""
+
+import os
+import csv
+import sys
+import json
+import glob
+import shutil
+import tempfile
+import unittest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TESTS)
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+import baseline
+import gen_hits
+from payloads import expand_row
+from treebank import compile_treebank
+from utils import load_conllu, html_escape, HTMLEscaper, ptb2tokens
+
+SAMPLES = sorted(glob.glob(os.path.join(ROOT, 'samples', '*.conllu')))
+
+
+def read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+class TestEscape(unittest.TestCase):
+
+    def test_ptb2tokens(self):
+        for filename in SAMPLES:
+            for _, parse in load_conllu(filename):
+                tokens = list(parse.tokens)
+                self.assertEqual(
+                    ptb2tokens(tokens),
+                    baseline.ptb2text(' '.join(tokens)).split(' '))
+
+    def test_html_escape(self):
+        for filename in SAMPLES:
+            for _, parse in load_conllu(filename):
+                sent = ' '.join(ptb2tokens(list(parse.tokens)))
+                self.assertEqual(html_escape(sent),
+                                 baseline.html_escape(sent))
+
+    def test_escaper_phrases(self):
+        # gen_hits escapes the phrases of a sentence token by token
+        for filename in SAMPLES:
+            for _, parse in load_conllu(filename):
+                tokens = ptb2tokens(list(parse.tokens))
+                escape = HTMLEscaper()
+                for i in xrange(len(tokens)):
+                    for j in xrange(i + 1, min(i + 6, len(tokens)) + 1):
+                        self.assertEqual(
+                            ' '.join(escape[t] for t in tokens[i:j]),
+                            baseline.html_escape(' '.join(tokens[i:j])))
+
+
+class TestLines(unittest.TestCase):
+
+    def test_stripped_like_the_whole_file(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'lines.txt')
+            for text in ('', '\n\n', 'a', '\n\n  a b \n\nc\n \n\n',
+                         'a\n \t\nb\t\n', ' a\r\n\r\nb \r\n\r\n'):
+                with open(path, 'wb') as f:
+                    f.write(text)
+                self.assertEqual(list(gen_hits.gen_lines(path)),
+                                 text.strip().split('\n'), repr(text))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestExtract(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def extract(self, filename, *options):
+        output = self.path('out.csv')
+        gen_hits.extract(gen_hits.parse_args([filename, output] +
+                                             list(options)))
+        return output
+
+    def expected(self, filename):
+        expected = self.path('expected.csv')
+        baseline.write_hits(filename, expected)
+        return expected
+
+    def assertSameHits(self, *options):
+        for filename in SAMPLES:
+            self.assertEqual(read(self.extract(filename, *options)),
+                             read(self.expected(filename)),
+                             '%s differs with %s' %(os.path.basename(filename),
+                                                    ' '.join(options)))
+
+    def test_serial(self):
+        self.assertSameHits()
+
+    def test_workers(self):
+        self.assertSameHits('--workers', '2', '--chunk-size', '7')
+
+    def test_cache(self):
+        # the first run fills the cache, the second reads from it
+        cache = self.path('cache.db')
+        self.assertSameHits('--cache', cache)
+        self.assertSameHits('--cache', cache)
+        self.assertSameHits('--cache', cache, '--workers', '2')
+
+    def test_treebank(self):
+        for filename in SAMPLES:
+            path = self.path(os.path.basename(filename) + '.tb')
+            compile_treebank(filename, path)
+            for options in ([], ['--workers', '2']):
+                self.assertEqual(read(self.extract(path, *options)),
+                                 read(self.expected(filename)),
+                                 '%s differs with %s' %(path,
+                                                        ' '.join(options)))
+
+    def test_compact(self):
+        def rows(output):
+            with open(output, 'rb') as f:
+                lines = list(csv.reader(f))[1:]
+            return [json.loads(line) for line, in lines]
+
+        for filename in SAMPLES:
+            compact = rows(self.extract(filename, '--compact'))
+            self.assertEqual([expand_row(row) for row in compact],
+                             rows(self.expected(filename)), filename)
+
+    def test_resume_with_other_settings(self):
+        filename = SAMPLES[0]
+        self.extract(filename, '--shard-rows', '10')
+        for options in (['--compact'], ['--dedup', self.path('dedup.db')]):
+            self.assertRaises(ValueError, self.extract, filename,
+                              '--shard-rows', '10', '--resume', *options)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Check the error handling of the MTurk client against mock_mturk.py.
+
+"""
+
+import os
+import sys
+import json
+import threading
+import unittest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS), 'scripts'))
+
+from mturk import Client, RequestError
+from mock_mturk import MockServer, MockService
+
+QUESTIONS = json.dumps([{'questionID': 'q_1', 'sentenceID': 's1',
+                         'pred_id': 'normal-1', 'predicate': 'p'}])
+HIT_PARAMS = {'MaxAssignments': 3, 'Reward': '0.10', 'Title': 't'}
+
+
+class TestClient(unittest.TestCase):
+
+    def setUp(self):
+        self.service = MockService(n_workers=5)
+        self.server = MockServer(('localhost', 0), self.service)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.endpoint = 'http://localhost:%d' %(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self, **kw):
+        return Client(self.endpoint, rate=1000, backoff=0, **kw)
+
+    def test_duplicate_token(self):
+        client = self.client()
+        hit_id = client.create_hit(QUESTIONS, HIT_PARAMS)
+        self.assertEqual(client.create_hit(QUESTIONS, HIT_PARAMS), hit_id)
+        self.assertEqual(len(self.service.hits), 1)
+
+    def test_other_request_errors(self):
+        # a message that mentions existing HITs is not a duplicate
+        with self.assertRaises(RequestError) as cm:
+            self.client().call('DeleteHIT', {'HITId': 'HIT with ID ABC'})
+        self.assertEqual(cm.exception.error_type, 'RequestError')
+        self.assertEqual(cm.exception.code, '')
+
+    def test_retries_keep_the_error(self):
+        self.service.fault_rate = 1.0
+        with self.assertRaises(RequestError) as cm:
+            self.client(retries=2).call('CreateHIT', {})
+        self.assertIn('failed after 3 attempts', str(cm.exception))
+        self.assertIn(cm.exception.error_type,
+                      ('ServiceFault', 'ThrottlingException'))
+        self.assertTrue(cm.exception.fault)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Check the Dawid-Skene estimates on small answer columns.
+
+"""
+
+import os
+import sys
+import unittest
+import numpy as np
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS), 'scripts'))
+
+import agreement
+import worker_quality
+
+
+def columns_of(judgements):
+    columns = agreement.AnswerColumns()
+    for key, workerid, answer in judgements:
+        columns.add(columns.add_item('h', ('s', key)), workerid, answer)
+    return columns
+
+
+class TestDawidSkene(unittest.TestCase):
+
+    def setUp(self):
+        self.errstate = np.seterr(all='raise')
+
+    def tearDown(self):
+        np.seterr(**self.errstate)
+
+    def test_no_judgements(self):
+        quality = worker_quality.estimate(agreement.AnswerColumns())
+        np.testing.assert_allclose(quality.priors, [0.5, 0.5])
+        self.assertEqual(quality.iterations, 0)
+        priors, confusion, posteriors, _, _ = worker_quality.dawid_skene(
+            [], [], [], 3, 2)
+        np.testing.assert_allclose(posteriors, 0.5)
+        np.testing.assert_allclose(confusion, 0.5)
+
+    def test_single_class(self):
+        quality = worker_quality.estimate(columns_of(
+            [('i%d' %(i), w, 1) for i in xrange(4) for w in 'ab']))
+        self.assertTrue(np.isfinite(quality.log_likelihood))
+        self.assertTrue(quality.priors.min() > 0)
+        np.testing.assert_array_equal(quality.labels(), 1)
+
+    def test_reliable_worker(self):
+        # a and b agree on every item, c answers the opposite on half
+        truth = [0, 1, 1, 0, 1, 0, 0, 1]
+        judgements = []
+        for i, answer in enumerate(truth):
+            judgements += [('i%d' %(i), 'a', answer),
+                           ('i%d' %(i), 'b', answer),
+                           ('i%d' %(i), 'c', answer if i % 2 else 1 - answer)]
+        quality = worker_quality.estimate(columns_of(judgements))
+        np.testing.assert_array_equal(quality.labels(), truth)
+        reliability = dict(zip(quality.worker_ids, quality.reliabilities()))
+        self.assertGreater(reliability['a'], 0.9)
+        self.assertLess(reliability['c'], 0.6)
+
+
+if __name__ == '__main__':
+    unittest.main()